@@ -0,0 +1,53 @@
+"""
+create credit_ledger table for idempotent payment crediting
+
+Revision ID: 20251016_120000
+Revises: performance_indexes_v2
+Create Date: 2025-10-16 12:00:00
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = "20251016_120000"
+down_revision = "performance_indexes_v2"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector: Inspector, table: str) -> bool:
+    return table in inspector.get_table_names()
+
+
+def upgrade() -> None:
+    bind: Connection = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # One row per provider payment id: a redelivered webhook hits the unique constraint and credits nothing
+    if not _has_table(inspector, "credit_ledger"):
+        op.create_table(
+            "credit_ledger",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column("payment_id", sa.String(), nullable=False, unique=True),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+            sa.Column("amount", sa.Float(), nullable=False),
+            sa.Column("source", sa.String(), nullable=False, server_default="yookassa"),
+            sa.Column("package_id", sa.String(), nullable=True),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.text("NOW()")),
+        )
+    op.create_index("ix_credit_ledger_user_id", "credit_ledger", ["user_id"], if_not_exists=True)
+
+
+def downgrade() -> None:
+    try:
+        op.drop_index("ix_credit_ledger_user_id", table_name="credit_ledger")
+    except Exception:
+        pass
+    try:
+        op.drop_table("credit_ledger")
+    except Exception:
+        pass
@@ -0,0 +1,40 @@
+"""
+add chat_contexts.token_count
+
+Revision ID: 20251016_130000
+Revises: 20251016_120000
+Create Date: 2025-10-16 13:00:00
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = "20251016_130000"
+down_revision = "20251016_120000"
+branch_labels = None
+depends_on = None
+
+
+def _has_column(inspector: Inspector, table: str, column: str) -> bool:
+    return any(col["name"] == column for col in inspector.get_columns(table))
+
+
+def upgrade() -> None:
+    bind: Connection = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # Token count is computed once at insert; old rows stay NULL and are counted lazily by the context assembler
+    if not _has_column(inspector, "chat_contexts", "token_count"):
+        op.add_column("chat_contexts", sa.Column("token_count", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    bind: Connection = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    if _has_column(inspector, "chat_contexts", "token_count"):
+        op.drop_column("chat_contexts", "token_count")
@@ -0,0 +1,53 @@
+"""
+create chat_summaries table for rolling context summaries
+
+Revision ID: 20251016_140000
+Revises: 20251016_130000
+Create Date: 2025-10-16 14:00:00
+"""
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.reflection import Inspector
+
+# revision identifiers, used by Alembic.
+revision = "20251016_140000"
+down_revision = "20251016_130000"
+branch_labels = None
+depends_on = None
+
+
+def _has_table(inspector: Inspector, table: str) -> bool:
+    return table in inspector.get_table_names()
+
+
+def upgrade() -> None:
+    bind: Connection = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # One summary per chat link; context rows up to covered_until_order are already folded into it
+    if not _has_table(inspector, "chat_summaries"):
+        op.create_table(
+            "chat_summaries",
+            sa.Column("id", sa.Integer(), primary_key=True),
+            sa.Column(
+                "chat_bot_instance_id",
+                sa.Integer(),
+                sa.ForeignKey("chat_bot_instances.id", ondelete="CASCADE"),
+                nullable=False,
+                unique=True,
+            ),
+            sa.Column("summary", sa.Text(), nullable=False),
+            sa.Column("covered_until_order", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("token_count", sa.Integer(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(timezone=True), server_default=sa.text("NOW()")),
+        )
+
+
+def downgrade() -> None:
+    try:
+        op.drop_table("chat_summaries")
+    except Exception:
+        pass
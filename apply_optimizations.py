@@ -72,7 +72,7 @@ def main():
     # Шаг 3: Проверка наличия оптимизированных файлов
     logger.info(f"\n[{steps_completed+1}/{total_steps}] Проверка оптимизированных модулей...")
     files_to_check = [
-        "utils_optimized.py",
+        "llm_stream.py",
         "alembic/versions/20241228_add_performance_indexes.py",
         "ANALYSIS_AND_FIX_PLAN.md"
     ]
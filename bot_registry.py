@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Общий реестр инициализированных telegram.Bot по токену (LRU).
+
+Все боты используют один HTTPXRequest (один пул keep-alive соединений, HTTP/2)
+к api.telegram.org, поэтому getMe выполняется один раз на токен, а не на апдейт,
+и у каждого бота нет собственного пула на CONNECTION_POOL_SIZE соединений.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class _SharedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который не закрывается при shutdown() отдельного бота.
+    Транспорт общий, закрывается только через close() при остановке приложения."""
+
+    async def shutdown(self) -> None:
+        return
+
+    async def close(self) -> None:
+        await super().shutdown()
+
+
+class BotRegistry:
+    """LRU-кеш инициализированных Bot, разделяющих один HTTP-транспорт."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max(1, max_size)
+        self._bots: "OrderedDict[str, Bot]" = OrderedDict()
+        # Закреплённые боты (главный бот приложения) — не вытесняются
+        self._pinned: Dict[str, Bot] = {}
+        # Инициализация в процессе: параллельные апдейты одного токена ждут одну задачу
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._request: Optional[_SharedHTTPXRequest] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_request(self) -> _SharedHTTPXRequest:
+        if self._request is None:
+            self._request = _SharedHTTPXRequest(
+                connection_pool_size=config.TELEGRAM_HTTP_POOL_SIZE,
+                read_timeout=30.0,
+                write_timeout=30.0,
+                connect_timeout=30.0,
+                pool_timeout=30.0,
+                http_version=config.TELEGRAM_HTTP_VERSION,
+            )
+        return self._request
+
+    def pin(self, token: str, bot: Bot) -> None:
+        """Регистрирует уже инициализированного бота (например, application.bot) без вытеснения."""
+        self._pinned[token] = bot
+
+    def peek(self, token: str) -> Optional[Bot]:
+        return self._pinned.get(token) or self._bots.get(token)
+
+    async def get(self, token: str) -> Bot:
+        """Возвращает инициализированного Bot для токена, создавая его при необходимости."""
+        bot = self._pinned.get(token)
+        if bot is not None:
+            self.hits += 1
+            return bot
+        bot = self._bots.get(token)
+        if bot is not None:
+            self._bots.move_to_end(token)
+            self.hits += 1
+            return bot
+
+        task = self._pending.get(token)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._create(token))
+            self._pending[token] = task
+            task.add_done_callback(lambda _t, _tok=token: self._pending.pop(_tok, None))
+        return await asyncio.shield(task)
+
+    async def _create(self, token: str) -> Bot:
+        request = self._get_request()
+        bot = Bot(token=token, request=request, get_updates_request=request)
+        # initialize() делает getMe — один раз на токен
+        await bot.initialize()
+        self._bots[token] = bot
+        self._bots.move_to_end(token)
+        while len(self._bots) > self.max_size:
+            evicted_token, _ = self._bots.popitem(last=False)
+            self.evictions += 1
+            logger.debug(f"bot_registry: evicted bot ...{evicted_token[-6:]}")
+        return bot
+
+    def evict(self, token: str) -> None:
+        """Убирает бота из реестра (например, после смены/отзыва токена)."""
+        self._bots.pop(token, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._bots),
+            "pinned": len(self._pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def close(self) -> None:
+        """Закрывает общий транспорт. Вызывается при остановке приложения."""
+        logger.info(f"bot_registry: shutting down, stats={self.stats()}")
+        self._bots.clear()
+        self._pinned.clear()
+        if self._request is not None:
+            try:
+                await self._request.close()
+            except Exception as e:
+                logger.warning(f"bot_registry: failed to close shared transport: {e}")
+            self._request = None
+
+
+bot_registry = BotRegistry(config.BOT_REGISTRY_MAX_SIZE)
+
+
+async def get_bot(token: str) -> Bot:
+    return await bot_registry.get(token)
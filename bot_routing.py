@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Таблица маршрутизации вебхуков: token -> неизменяемая запись BotRoute.
+
+Загружается целиком при старте и точечно инвалидируется при записи
+(set_bot_instance_token, /botsettings, mute/unmute, установка вебхука).
+Проверки секрета и ACL в вебхуке не ходят в БД.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BotRoute:
+    """Снимок BotInstance, достаточный для маршрутизации и ACL без обращения к БД."""
+    bot_instance_id: int
+    telegram_bot_id: Optional[str]
+    telegram_username: Optional[str]
+    status: Optional[str]
+    webhook_secret: Optional[str]
+    access_level: str
+    owner_telegram_id: Optional[int]
+    whitelist: FrozenSet[int]
+    media_reaction: str
+    muted_chat_ids: FrozenSet[str]
+
+    @property
+    def is_active(self) -> bool:
+        return self.status == 'active'
+
+    def is_allowed(self, actor_id: int) -> bool:
+        """ACL: админы системы и владелец — всегда; далее по access_level."""
+        try:
+            actor_id = int(actor_id)
+        except (TypeError, ValueError):
+            return False
+        if actor_id in (getattr(config, 'ADMIN_USER_ID', []) or []):
+            return True
+        if self.owner_telegram_id and actor_id == self.owner_telegram_id:
+            return True
+        if self.access_level == 'public':
+            return True
+        if self.access_level == 'whitelist':
+            return actor_id in self.whitelist
+        return False
+
+
+# token -> BotRoute
+_routes: Dict[str, BotRoute] = {}
+# token -> monotonic-время, до которого токен считается неизвестным
+_missing: Dict[str, float] = {}
+_lock = threading.Lock()
+# Увеличивается при каждой инвалидации: загрузка, начатая до неё, не должна перезаписать свежие данные
+_generation = 0
+# Что инвалидировали, пока идёт load_all: эти записи из полной загрузки устарели.
+# None — загрузка не идёт; ключ '*' в токенах — был invalidate_all
+_invalidated_during_load: Optional[Dict[str, set]] = None
+
+
+def _parse_whitelist(raw: Optional[str]) -> FrozenSet[int]:
+    try:
+        wl = json.loads(raw or '[]')
+        return frozenset(int(x) for x in wl if str(x).strip())
+    except Exception as e:
+        logger.warning(f"bot_routing: failed to parse whitelist JSON: {e}")
+        return frozenset()
+
+
+def _build_route(instance, muted_chat_ids) -> BotRoute:
+    owner = getattr(instance, 'owner', None)
+    persona = getattr(instance, 'persona_config', None)
+    return BotRoute(
+        bot_instance_id=instance.id,
+        telegram_bot_id=instance.telegram_bot_id,
+        telegram_username=instance.telegram_username,
+        status=instance.status,
+        webhook_secret=instance.webhook_secret,
+        access_level=(instance.access_level or 'owner_only').lower(),
+        owner_telegram_id=int(owner.telegram_id) if owner and owner.telegram_id else None,
+        whitelist=_parse_whitelist(instance.whitelisted_users_json),
+        media_reaction=(getattr(persona, 'media_reaction', None) or 'text_only'),
+        muted_chat_ids=frozenset(muted_chat_ids or ()),
+    )
+
+
+def _query_routes(token: Optional[str] = None) -> Dict[str, BotRoute]:
+    """Читает BotInstance (+owner, persona, заглушенные чаты) из БД. Синхронная."""
+    import db  # локальный импорт, чтобы избежать циклов
+    from sqlalchemy.orm import selectinload
+
+    with db.get_db() as db_session:
+        q = (
+            db_session.query(db.BotInstance)
+            .options(selectinload(db.BotInstance.owner), selectinload(db.BotInstance.persona_config))
+            .filter(db.BotInstance.bot_token.isnot(None))
+        )
+        if token is not None:
+            q = q.filter(db.BotInstance.bot_token == token)
+        instances = q.all()
+        if not instances:
+            return {}
+
+        muted_q = db_session.query(db.ChatBotInstance.bot_instance_id, db.ChatBotInstance.chat_id).filter(
+            db.ChatBotInstance.is_muted == True,
+            db.ChatBotInstance.active == True,
+        )
+        if token is not None:
+            muted_q = muted_q.filter(db.ChatBotInstance.bot_instance_id == instances[0].id)
+        muted: Dict[int, set] = {}
+        for bot_instance_id, chat_id in muted_q.all():
+            muted.setdefault(bot_instance_id, set()).add(str(chat_id))
+
+        return {inst.bot_token: _build_route(inst, muted.get(inst.id)) for inst in instances}
+
+
+def load_all() -> int:
+    """Полная загрузка таблицы при старте. Возвращает количество записей."""
+    global _invalidated_during_load
+    with _lock:
+        generation = _generation
+        _invalidated_during_load = {'tokens': set(), 'ids': set()}
+    try:
+        routes = _query_routes()
+    except Exception:
+        with _lock:
+            _invalidated_during_load = None
+        raise
+    with _lock:
+        invalidated = _invalidated_during_load
+        _invalidated_during_load = None
+        if generation == _generation:
+            _routes.clear()
+            _routes.update(routes)
+            _missing.clear()
+        elif '*' not in invalidated['tokens']:
+            # Пока грузили, что-то инвалидировали: записи, прочитанные до инвалидации, пропускаем
+            # (их лениво перечитает get_route), из остальных добавляем только то, чего ещё нет
+            for token, route in routes.items():
+                if token in invalidated['tokens'] or route.bot_instance_id in invalidated['ids']:
+                    continue
+                _routes.setdefault(token, route)
+    logger.info(f"bot_routing: loaded {len(routes)} bot routes")
+    return len(routes)
+
+
+def _load_one(token: str) -> Optional[BotRoute]:
+    with _lock:
+        generation = _generation
+    route = _query_routes(token).get(token)
+    with _lock:
+        if generation == _generation:
+            if route:
+                _routes[token] = route
+                _missing.pop(token, None)
+            else:
+                _missing[token] = time.monotonic() + config.BOT_ROUTING_NEGATIVE_TTL
+    return route
+
+
+def peek(token: str) -> Optional[BotRoute]:
+    """Возвращает запись только из памяти (без БД)."""
+    return _routes.get(token)
+
+
+async def get_route(token: str) -> Optional[BotRoute]:
+    """Запись для токена; при промахе — один запрос в БД вне event loop."""
+    route = _routes.get(token)
+    if route is not None:
+        return route
+    expires = _missing.get(token)
+    if expires is not None and expires > time.monotonic():
+        return None
+    return await asyncio.to_thread(_load_one, token)
+
+
+def invalidate(token: Optional[str] = None, bot_instance_id: Optional[int] = None) -> None:
+    """Сбрасывает запись по токену и/или id BotInstance. Следующий апдейт перечитает её из БД."""
+    global _generation
+    with _lock:
+        _generation += 1
+        if _invalidated_during_load is not None:
+            if token is not None:
+                _invalidated_during_load['tokens'].add(token)
+            if bot_instance_id is not None:
+                _invalidated_during_load['ids'].add(bot_instance_id)
+        if token is not None:
+            _routes.pop(token, None)
+            _missing.pop(token, None)
+        if bot_instance_id is not None:
+            for key in [k for k, r in _routes.items() if r.bot_instance_id == bot_instance_id]:
+                _routes.pop(key, None)
+    logger.debug(f"bot_routing: invalidated token=...{(token or '')[-6:]} bot_instance_id={bot_instance_id}")
+
+
+def invalidate_all() -> None:
+    global _generation
+    with _lock:
+        _generation += 1
+        if _invalidated_during_load is not None:
+            _invalidated_during_load['tokens'].add('*')
+        _routes.clear()
+        _missing.clear()
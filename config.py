@@ -31,6 +31,16 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 OPENROUTER_MODEL_NAME = os.getenv("OPENROUTER_MODEL_NAME", "google/gemini-2.5-pro")
 GEMINI_MODEL_NAME_FOR_API = os.getenv("GEMINI_MODEL_NAME_FOR_API", "gemini-2.5-flash-lite")
 
+# Планировщик ключей (key_scheduler.py): бюджет одного ключа и cooldown после 429/503
+GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", "15"))  # запросов в минуту на ключ
+GEMINI_KEY_TPM = float(os.getenv("GEMINI_KEY_TPM", "250000"))  # токенов в минуту на ключ
+LLM_KEY_DEFAULT_RPM = float(os.getenv("LLM_KEY_DEFAULT_RPM", "60"))  # для прочих сервисов в таблице api_keys
+LLM_KEY_DEFAULT_TPM = float(os.getenv("LLM_KEY_DEFAULT_TPM", "1000000"))
+KEY_COOLDOWN_SECONDS = float(os.getenv("KEY_COOLDOWN_SECONDS", "20"))  # первая пауза, дальше удваивается
+KEY_COOLDOWN_MAX_SECONDS = float(os.getenv("KEY_COOLDOWN_MAX_SECONDS", "300"))
+KEY_SCHEDULER_FLUSH_INTERVAL = float(os.getenv("KEY_SCHEDULER_FLUSH_INTERVAL", "30"))  # сек между записью счётчиков в БД
+KEY_SCHEDULER_RELOAD_INTERVAL = float(os.getenv("KEY_SCHEDULER_RELOAD_INTERVAL", "300"))  # сек между перечитыванием ключей
+
 # Бесплатные ответы на фото: включите, чтобы фото всегда шли в бесплатную Gemini и кредиты не списывались
 # Можно переопределить через переменные окружения.
 FREE_IMAGE_RESPONSES = os.getenv("FREE_IMAGE_RESPONSES", "true").lower() in ("1", "true", "yes", "y")
@@ -171,10 +181,123 @@ CACHE_TTL_PERSONA = int(os.getenv("CACHE_TTL_PERSONA", "600"))  # 10 минут
 CACHE_TTL_MENU = int(os.getenv("CACHE_TTL_MENU", "1800"))  # 30 минут
 CACHE_TTL_CONTEXT = int(os.getenv("CACHE_TTL_CONTEXT", "120"))  # 2 минуты
 CACHE_TTL_PROMPT = int(os.getenv("CACHE_TTL_PROMPT", "3600"))  # 1 час
+BOT_ROUTING_NEGATIVE_TTL = int(os.getenv("BOT_ROUTING_NEGATIVE_TTL", "30"))  # сколько помнить неизвестный токен вебхука
+# Шина инвалидации кешей между репликами/воркерами (Postgres LISTEN/NOTIFY)
+INVALIDATION_BUS_ENABLED = os.getenv("INVALIDATION_BUS_ENABLED", "true").lower() in ("1", "true", "yes")
+INVALIDATION_BUS_CHANNEL = os.getenv("INVALIDATION_BUS_CHANNEL", "cache_invalidation")
+INVALIDATION_BUS_BATCH_SIZE = int(os.getenv("INVALIDATION_BUS_BATCH_SIZE", "100"))  # событий в одной отправке
 
 # --- Performance Settings (OPTIMIZED) ---
 # Настройки для оптимизации производительности
 MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "75"))  # Увеличено до 75
+UPDATE_QUEUE_MAX_DEPTH = int(os.getenv("UPDATE_QUEUE_MAX_DEPTH", "1000"))  # всего апдейтов в очереди+в работе, дальше 503
+UPDATE_LANE_MAX_DEPTH = int(os.getenv("UPDATE_LANE_MAX_DEPTH", "30"))  # апдейтов в очереди одного чата, дальше 429
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "4096"))  # окно последних update_id на бота для отсева повторов
+UPDATE_BACKPRESSURE_RETRY_AFTER = int(os.getenv("UPDATE_BACKPRESSURE_RETRY_AFTER", "2"))  # Retry-After (сек) при отказе
 CONNECTION_POOL_SIZE = int(os.getenv("CONNECTION_POOL_SIZE", "150"))  # Увеличено до 150
 HTTP_CLIENT_TIMEOUT = int(os.getenv("HTTP_CLIENT_TIMEOUT", "25"))  # Уменьшено до 25 секунд
 LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")  # WARNING в продакшене для меньшего I/O
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # доступ к /metrics (X-Metrics-Token или ?token=); пусто — 403
+# Режим супервизора: WORKERS > 1 — main.py запускает N процессов-воркеров за фронт-роутером (шардинг по chat_id)
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "0"))  # 0 = PORT+1, PORT+2, ...
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", "5"))  # сек между проверками /readyz
+WORKER_HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", "2"))
+WORKER_START_TIMEOUT = float(os.getenv("WORKER_START_TIMEOUT", "120"))  # ожидание готовности воркера при rolling restart
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "20"))  # graceful stop, затем kill
+WORKER_RESTART_BACKOFF_BASE = float(os.getenv("WORKER_RESTART_BACKOFF_BASE", "1"))  # пауза перед перезапуском упавшего воркера, удваивается
+WORKER_RESTART_BACKOFF_MAX = float(os.getenv("WORKER_RESTART_BACKOFF_MAX", "60"))
+WORKER_STABLE_UPTIME = float(os.getenv("WORKER_STABLE_UPTIME", "60"))  # сек здоровой работы, после которых счётчик падений сбрасывается
+WORKER_MAX_CONSECUTIVE_CRASHES = int(os.getenv("WORKER_MAX_CONSECUTIVE_CRASHES", "10"))  # дальше воркер помечается failed
+# Общий реестр Bot для привязанных ботов: один HTTP/2 keep-alive транспорт на всех
+BOT_REGISTRY_MAX_SIZE = int(os.getenv("BOT_REGISTRY_MAX_SIZE", "500"))  # LRU: сколько инициализированных Bot держать
+TELEGRAM_HTTP_POOL_SIZE = int(os.getenv("TELEGRAM_HTTP_POOL_SIZE", str(CONNECTION_POOL_SIZE)))  # соединений к api.telegram.org на всех
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "2")  # "2" или "1.1"
+# Общие HTTP/2 клиенты к LLM-провайдерам (llm_clients.py): таймауты по фазам и пул keep-alive
+LLM_HTTP_CONNECT_TIMEOUT = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", "5"))
+LLM_HTTP_WRITE_TIMEOUT = float(os.getenv("LLM_HTTP_WRITE_TIMEOUT", "10"))
+LLM_HTTP_POOL_TIMEOUT = float(os.getenv("LLM_HTTP_POOL_TIMEOUT", "5"))  # ожидание свободного соединения из пула
+GEMINI_HTTP_READ_TIMEOUT = float(os.getenv("GEMINI_HTTP_READ_TIMEOUT", "30"))
+OPENROUTER_HTTP_READ_TIMEOUT = float(os.getenv("OPENROUTER_HTTP_READ_TIMEOUT", "90"))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))  # на провайдера; HTTP/2 мультиплексирует запросы
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))  # сек простоя до закрытия соединения
+LLM_STREAMING_ENABLED = os.getenv("LLM_STREAMING_ENABLED", "true").lower() == "true"  # стриминг ответа LLM: первая часть уходит в чат до конца генерации
+# Шлюз к LLM (llm_gateway.py): адаптивный лимит параллельности, circuit breaker, бюджет ретраев
+LLM_GATEWAY_INITIAL_LIMIT = float(os.getenv("LLM_GATEWAY_INITIAL_LIMIT", "20"))  # одновременных запросов на провайдера/модель
+LLM_GATEWAY_MIN_LIMIT = float(os.getenv("LLM_GATEWAY_MIN_LIMIT", "2"))
+LLM_GATEWAY_MAX_LIMIT = float(os.getenv("LLM_GATEWAY_MAX_LIMIT", "100"))
+LLM_GATEWAY_DECREASE = float(os.getenv("LLM_GATEWAY_DECREASE", "0.7"))  # множитель лимита при перегрузке
+LLM_GATEWAY_LATENCY_TARGET = float(os.getenv("LLM_GATEWAY_LATENCY_TARGET", "20"))  # сек; медленнее — считаем перегрузкой
+LLM_GATEWAY_QUEUE_TIMEOUT = float(os.getenv("LLM_GATEWAY_QUEUE_TIMEOUT", "15"))  # сек ожидания места в лимите
+LLM_GATEWAY_MAX_RETRIES = int(os.getenv("LLM_GATEWAY_MAX_RETRIES", "2"))  # ретраи при 429/503 (в рамках бюджета)
+LLM_GATEWAY_RETRY_BACKOFF = float(os.getenv("LLM_GATEWAY_RETRY_BACKOFF", "1.0"))  # сек * номер попытки + jitter
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1"))  # ретраев на один обычный запрос
+LLM_RETRY_BUDGET_MIN_PER_SEC = float(os.getenv("LLM_RETRY_BUDGET_MIN_PER_SEC", "0.2"))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))  # последних вызовов в окне
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+LLM_BREAKER_FAILURE_RATIO = float(os.getenv("LLM_BREAKER_FAILURE_RATIO", "0.5"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "15"))
+# Hedging запросов к Gemini: дубликат на другой ключ, если ответа нет дольше p90
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.9"))  # порог ожидания перед дубликатом
+LLM_HEDGE_BUDGET_RATIO = float(os.getenv("LLM_HEDGE_BUDGET_RATIO", "0.1"))  # не больше 10% дубликатов от запросов
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))  # до стольких замеров hedging не включается
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))  # последних успешных ответов для p90
+# Маршрутизация между провайдерами (llm_router): кандидаты "провайдер:модель" через запятую, в порядке предпочтения
+LLM_ROUTES_PAID = os.getenv("LLM_ROUTES_PAID", f"openrouter:{OPENROUTER_MODEL_NAME},gemini:{GEMINI_MODEL_NAME_FOR_API}")
+LLM_ROUTES_PAID_IMAGE = os.getenv("LLM_ROUTES_PAID_IMAGE", f"openrouter:{OPENROUTER_IMAGE_MODEL_NAME},gemini:{GEMINI_MODEL_NAME_FOR_API}")
+LLM_ROUTES_FREE = os.getenv("LLM_ROUTES_FREE", f"gemini:{GEMINI_MODEL_NAME_FOR_API}")
+LLM_ROUTE_FAILOVER_ENABLED = os.getenv("LLM_ROUTE_FAILOVER_ENABLED", "true").lower() == "true"
+LLM_ROUTE_P95_BUDGET = float(os.getenv("LLM_ROUTE_P95_BUDGET", "25"))  # сек; p95 выше — кандидат уходит в конец списка
+LLM_ROUTE_MAX_FAILURE_RATIO = float(os.getenv("LLM_ROUTE_MAX_FAILURE_RATIO", "0.3"))  # доля сбоев в окне breaker'а
+LLM_ROUTE_COST_CEILING = float(os.getenv("LLM_ROUTE_COST_CEILING", "1.0"))  # запасной кандидат не дороже основного * ceiling
+# Локальный префильтр перед LLM-проверкой «отвечать ли» в группах (group_relevance)
+GROUP_PREFILTER_ENABLED = os.getenv("GROUP_PREFILTER_ENABLED", "true").lower() == "true"
+GROUP_PREFILTER_POSITIVE = float(os.getenv("GROUP_PREFILTER_POSITIVE", "4.5"))  # скор не ниже — отвечаем без LLM
+GROUP_PREFILTER_NEGATIVE = float(os.getenv("GROUP_PREFILTER_NEGATIVE", "-2.0"))  # скор не выше — молчим без LLM
+GROUP_PREFILTER_NAME_SIMILARITY = float(os.getenv("GROUP_PREFILTER_NAME_SIMILARITY", "0.8"))  # порог difflib для имени с опечаткой
+GROUP_DECISION_WINDOW_MS = int(os.getenv("GROUP_DECISION_WINDOW_MS", "400"))  # окно сбора сообщений группы в одну LLM-проверку; 0 — выкл.
+GROUP_DECISION_MAX_BATCH = int(os.getenv("GROUP_DECISION_MAX_BATCH", "10"))  # сообщений в одной проверке не больше
+# Сборка контекста по бюджету токенов (context_window)
+LLM_CONTEXT_TOKEN_BUDGET = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "16000"))  # окно на запрос по умолчанию (промпт + история + ответ)
+# Бюджеты отдельных моделей: "модель=токены,модель=токены", например "google/gemini-2.5-pro=32000"
+LLM_CONTEXT_TOKEN_BUDGETS = {
+    name.strip(): int(value)
+    for name, _, value in (item.partition("=") for item in os.getenv("LLM_CONTEXT_TOKEN_BUDGETS", "").split(",") if "=" in item)
+    if name.strip() and value.strip().isdigit()
+}
+LLM_CONTEXT_OUTPUT_RESERVE = int(os.getenv("LLM_CONTEXT_OUTPUT_RESERVE", "1024"))  # токенов оставляем под ответ
+LLM_CONTEXT_MIN_HISTORY_TOKENS = int(os.getenv("LLM_CONTEXT_MIN_HISTORY_TOKENS", "1000"))  # минимум под историю при длинном промпте
+# Сворачивание старого контекста в конспект (context_summarizer)
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() == "true"
+CONTEXT_SUMMARY_KEEP_RECENT = int(os.getenv("CONTEXT_SUMMARY_KEEP_RECENT", "30"))  # последних сообщений остаются сырыми (горизонт)
+CONTEXT_SUMMARY_MIN_BATCH = int(os.getenv("CONTEXT_SUMMARY_MIN_BATCH", "20"))  # сворачиваем, когда за горизонтом накопилось столько
+CONTEXT_SUMMARY_MAX_FOLD = int(os.getenv("CONTEXT_SUMMARY_MAX_FOLD", "120"))  # сообщений в одном запросе к модели не больше
+CONTEXT_SUMMARY_INTERVAL = float(os.getenv("CONTEXT_SUMMARY_INTERVAL", "60"))  # сек между проходами
+CONTEXT_SUMMARY_MAX_PER_CYCLE = int(os.getenv("CONTEXT_SUMMARY_MAX_PER_CYCLE", "20"))  # чатов за проход
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "3000"))  # длина конспекта
+# Явный кеш контекста Gemini (gemini_cache): системный промпт персоны загружается один раз как cachedContents
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))  # сек жизни кеша у провайдера
+GEMINI_CONTEXT_CACHE_REFRESH_BEFORE = float(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_BEFORE", "300"))  # продлеваем, если до истечения меньше
+GEMINI_CONTEXT_CACHE_IDLE = float(os.getenv("GEMINI_CONTEXT_CACHE_IDLE", "1800"))  # не использовался дольше — не продлеваем
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))  # меньше — провайдер кеш не создаст
+GEMINI_CONTEXT_CACHE_INTERVAL = float(os.getenv("GEMINI_CONTEXT_CACHE_INTERVAL", "60"))  # сек между проходами продления/удаления
+# Корень API для cachedContents; по умолчанию — из GEMINI_API_BASE_URL_TEMPLATE (…/v1beta)
+GEMINI_API_ROOT = os.getenv("GEMINI_API_ROOT", GEMINI_API_BASE_URL_TEMPLATE.split("/models/")[0])
+# Кеш закодированных сообщений истории (llm_payload): предел по памяти на процесс
+LLM_PAYLOAD_FRAGMENT_CACHE_MB = float(os.getenv("LLM_PAYLOAD_FRAGMENT_CACHE_MB", "16"))  # ключ (текст) + JSON-фрагмент
+# Подготовка фото перед vision-запросом (media_preprocess)
+MEDIA_IMAGE_PREPROCESS_ENABLED = os.getenv("MEDIA_IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"
+MEDIA_IMAGE_TARGET_PX = int(os.getenv("MEDIA_IMAGE_TARGET_PX", "768"))  # длинная сторона по умолчанию (один тайл Gemini)
+# Цели отдельных моделей: "модель=пиксели,модель=пиксели", например "google/gemini-2.5-pro=1024"
+MEDIA_IMAGE_TARGETS = {
+    name.strip(): int(value)
+    for name, _, value in (item.partition("=") for item in os.getenv("MEDIA_IMAGE_TARGETS", "").split(",") if "=" in item)
+    if name.strip() and value.strip().isdigit()
+}
+MEDIA_IMAGE_JPEG_QUALITY = int(os.getenv("MEDIA_IMAGE_JPEG_QUALITY", "80"))  # стартовое качество перекодирования
+MEDIA_IMAGE_MIN_QUALITY = int(os.getenv("MEDIA_IMAGE_MIN_QUALITY", "50"))  # ниже не опускаемся ради бюджета
+MEDIA_IMAGE_MAX_BYTES = int(os.getenv("MEDIA_IMAGE_MAX_BYTES", "300000"))  # бюджет размера JPEG
+MEDIA_IMAGE_CACHE_MB = float(os.getenv("MEDIA_IMAGE_CACHE_MB", "32"))  # кеш готовых картинок по file_unique_id
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Фоновое сворачивание старого контекста чата в конспект.
+
+Раньше у ChatBotInstance хранилось до MAX_CONTEXT_MESSAGES_STORED (400) сырых
+сообщений, и до 200 из них уходили в модель на каждом ходе: в «зрелых» чатах
+промпт состоял в основном из давно прошедшей переписки.
+
+Теперь сообщения старше горизонта (всё, кроме последних
+CONTEXT_SUMMARY_KEEP_RECENT) фоновая задача сворачивает в одну запись
+ChatSummary на чат. Конспект обновляется инкрементально: в Gemini уходят
+прежний конспект и только новые «состарившиеся» сообщения, а covered_until_order
+запоминает, докуда контекст уже свёрнут. get_context_for_chat_bot подставляет
+конспект первой (закреплённой) записью истории вместо сырого хвоста.
+
+Обрабатываются только чаты, где с прошлого прохода был ответ бота
+(note_activity), — без сканирования всей таблицы chat_contexts. Конспект
+пишется условным UPDATE по прежнему covered_until_order, поэтому два процесса
+не перезапишут работу друг друга.
+"""
+
+import asyncio
+import collections
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+import config
+from utils import count_openai_compatible_tokens
+
+logger = logging.getLogger(__name__)
+
+_SYSTEM_PROMPT = (
+    "Ты ведёшь долговременную память персонажа о разговоре в чате. Тебе дают текущий конспект "
+    "и новые сообщения, которые в него ещё не вошли. Верни обновлённый конспект: факты о собеседниках "
+    "(имена, предпочтения, события, договорённости), важные темы и то, что персонаж о себе рассказал. "
+    "Пиши кратко, по-русски, от третьего лица, без приветствий и оценок. "
+    'Ответ — JSON-массив из одной строки: ["конспект"].'
+)
+
+# chat_bot_instance_id с новыми ответами бота с прошлого прохода
+_active: Set[int] = set()
+
+stats_counters: Dict[str, int] = collections.Counter()
+
+
+def note_activity(chat_bot_instance_id: Optional[int]) -> None:
+    """Отмечает чат для следующего прохода (вызывается после сохранения ответа бота)."""
+    if config.CONTEXT_SUMMARY_ENABLED and chat_bot_instance_id:
+        _active.add(chat_bot_instance_id)
+
+
+def _load_pending(chat_bot_instance_id: int) -> Optional[Tuple[str, int, List[Tuple[int, str, str]]]]:
+    """(прежний конспект, covered_until_order, сообщения к сворачиванию) или None. Синхронная."""
+    from db import get_db, ChatContext, ChatSummary  # local import: db импортирует много модулей
+
+    with get_db() as session:
+        row = session.query(ChatSummary.summary, ChatSummary.covered_until_order)\
+                     .filter(ChatSummary.chat_bot_instance_id == chat_bot_instance_id)\
+                     .first()
+        previous, covered = (row.summary, row.covered_until_order) if row else ("", 0)
+        rows = session.query(ChatContext.message_order, ChatContext.role, ChatContext.content)\
+                      .filter(ChatContext.chat_bot_instance_id == chat_bot_instance_id,
+                              ChatContext.message_order > covered)\
+                      .order_by(ChatContext.message_order.asc())\
+                      .all()
+    foldable = len(rows) - config.CONTEXT_SUMMARY_KEEP_RECENT
+    if foldable < config.CONTEXT_SUMMARY_MIN_BATCH:
+        return None
+    to_fold = [(order, role, content) for order, role, content in rows[:min(foldable, config.CONTEXT_SUMMARY_MAX_FOLD)]]
+    return previous, covered, to_fold
+
+
+def _build_messages(previous: str, rows: List[Tuple[int, str, str]]) -> List[Dict[str, str]]:
+    lines = []
+    for _, role, content in rows:
+        speaker = "Персонаж" if role == "assistant" else "Собеседник"
+        text = str(content or "").strip()
+        if len(text) > 500:
+            text = text[:500] + "..."
+        lines.append(f"{speaker}: {text}")
+    body = (
+        f"Текущий конспект:\n{previous or '(пока пусто)'}\n\n"
+        f"Новые сообщения (от старых к новым):\n" + "\n".join(lines)
+    )
+    return [{"role": "user", "content": body}]
+
+
+def _save(chat_bot_instance_id: int, old_covered: int, new_covered: int, summary: str) -> bool:
+    """Условная запись конспекта: только если его не обновили и контекст не очистили. Синхронная."""
+    from sqlalchemy import update
+    from db import get_db, dialect_insert, ChatContext, ChatSummary, CONTEXT_SUMMARY_HEADER
+
+    token_count = count_openai_compatible_tokens(f"{CONTEXT_SUMMARY_HEADER}\n{summary}")
+    with get_db() as session:
+        # /reset или повторное добавление персоны могли удалить контекст, пока шёл запрос к модели
+        still_there = session.query(ChatContext.id)\
+                             .filter(ChatContext.chat_bot_instance_id == chat_bot_instance_id,
+                                     ChatContext.message_order == new_covered)\
+                             .first()
+        if still_there is None:
+            return False
+        result = session.execute(
+            update(ChatSummary)
+            .where(ChatSummary.chat_bot_instance_id == chat_bot_instance_id,
+                   ChatSummary.covered_until_order == old_covered)
+            .values(summary=summary, covered_until_order=new_covered, token_count=token_count)
+        )
+        saved = result.rowcount == 1
+        if not saved and old_covered == 0:
+            result = session.execute(
+                dialect_insert(session, ChatSummary)
+                .values(chat_bot_instance_id=chat_bot_instance_id, summary=summary,
+                        covered_until_order=new_covered, token_count=token_count)
+                .on_conflict_do_nothing(index_elements=["chat_bot_instance_id"])
+            )
+            saved = result.rowcount == 1
+        session.commit()
+    return saved
+
+
+async def summarize_chat(chat_bot_instance_id: int) -> bool:
+    """Сворачивает состарившиеся сообщения одного чата. True — конспект обновлён."""
+    from handlers import call_gemini  # local import: handlers тяжёлый и импортирует db
+
+    pending = await asyncio.to_thread(_load_pending, chat_bot_instance_id)
+    if pending is None:
+        return False
+    previous, covered, rows = pending
+    result, _ = await call_gemini(_SYSTEM_PROMPT, _build_messages(previous, rows), max_retries=0)
+    if not isinstance(result, list) or not result:
+        stats_counters["llm_errors"] += 1
+        logger.warning(f"context_summarizer: no summary for CBI {chat_bot_instance_id}: {str(result)[:120]}")
+        return False
+    summary = "\n".join(str(part).strip() for part in result if str(part).strip())[:config.CONTEXT_SUMMARY_MAX_CHARS]
+    if not summary:
+        return False
+    saved = await asyncio.to_thread(_save, chat_bot_instance_id, covered, rows[-1][0], summary)
+    if saved:
+        stats_counters["summaries"] += 1
+        stats_counters["messages_folded"] += len(rows)
+        logger.info(f"context_summarizer: folded {len(rows)} messages of CBI {chat_bot_instance_id} (up to order {rows[-1][0]})")
+        if len(rows) >= config.CONTEXT_SUMMARY_MAX_FOLD:
+            # сворачивали не всё — остаток в следующий проход
+            _active.add(chat_bot_instance_id)
+    else:
+        stats_counters["save_conflicts"] += 1
+    return saved
+
+
+async def run_summarizer() -> None:
+    """Фоновая задача: раз в CONTEXT_SUMMARY_INTERVAL обрабатывает отмеченные чаты."""
+    while True:
+        try:
+            await asyncio.sleep(config.CONTEXT_SUMMARY_INTERVAL)
+            batch = list(_active)[:config.CONTEXT_SUMMARY_MAX_PER_CYCLE]
+            for chat_bot_instance_id in batch:
+                _active.discard(chat_bot_instance_id)
+                try:
+                    await summarize_chat(chat_bot_instance_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    stats_counters["errors"] += 1
+                    logger.warning(f"context_summarizer: CBI {chat_bot_instance_id} failed: {e}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats_counters["errors"] += 1
+            logger.warning(f"context_summarizer: cycle failed: {e}")
+
+
+def stats() -> Dict[str, int]:
+    return dict(stats_counters, pending_chats=len(_active))
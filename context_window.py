@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Сборка истории для LLM по бюджету токенов.
+
+Раньше в модель уходили последние MAX_CONTEXT_MESSAGES_SENT_TO_LLM (200) строк
+контекста целиком. Строка может быть до 4000 символов, поэтому промпт прыгал от
+пары сотен токенов до сотен тысяч, а от его размера зависят и латентность, и
+стоимость в кредитах.
+
+Теперь у каждой строки ChatContext при вставке сохраняется token_count, а fit()
+берёт самые новые сообщения, пока они помещаются в бюджет модели за вычетом
+системного промпта и резерва под ответ (LLM_CONTEXT_OUTPUT_RESERVE). Бюджет
+модели — LLM_CONTEXT_TOKEN_BUDGETS или LLM_CONTEXT_TOKEN_BUDGET по умолчанию.
+Выбранный бюджет по паре (персона, модель) виден в /metrics.
+
+fit() вызывается в get_llm_response для каждого кандидата маршрута: при
+переключении на другую модель история пересобирается под её бюджет.
+"""
+
+import collections
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+from utils import count_openai_compatible_tokens
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены на сообщение (роль, разделители)
+_MESSAGE_OVERHEAD = 4
+
+stats_counters: Dict[str, int] = collections.Counter()
+# (persona_id, модель) -> последний выбранный бюджет и заполнение
+_last_budgets: Dict[Tuple[Any, str], Dict[str, int]] = {}
+
+
+def token_budget(model: str) -> int:
+    """Полный бюджет окна модели (промпт + история + ответ)."""
+    return config.LLM_CONTEXT_TOKEN_BUDGETS.get(model, config.LLM_CONTEXT_TOKEN_BUDGET)
+
+
+def history_budget(model: str, system_prompt: str) -> int:
+    """Сколько токенов остаётся под историю после системного промпта и резерва под ответ."""
+    available = token_budget(model) - count_openai_compatible_tokens(system_prompt or "") - config.LLM_CONTEXT_OUTPUT_RESERVE
+    return max(available, config.LLM_CONTEXT_MIN_HISTORY_TOKENS)
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Токены сообщения: сохранённый token_count или подсчёт (кешируется в utils)."""
+    tokens = message.get("token_count")
+    if tokens is None:
+        stats_counters["counted_on_the_fly"] += 1
+        tokens = count_openai_compatible_tokens(str(message.get("content") or ""))
+    return int(tokens) + _MESSAGE_OVERHEAD
+
+
+def fit(
+    messages: List[Dict[str, Any]],
+    model: str,
+    system_prompt: str,
+    persona_id: Optional[Any] = None,
+) -> List[Dict[str, str]]:
+    """Самые новые сообщения, помещающиеся в бюджет модели, в хронологическом порядке.
+
+    Последнее сообщение (текущий запрос пользователя) берётся всегда, закреплённые
+    (pinned — конспект context_summarizer) идут первыми и не обрезаются. На выходе
+    только role/content — провайдеры отправляют словари как есть.
+    """
+    budget = history_budget(model, system_prompt)
+    pinned = [message for message in messages if message.get("pinned")]
+    used = sum(message_tokens(message) for message in pinned)
+    chosen: List[Dict[str, Any]] = []
+    for message in reversed(messages):
+        if message.get("pinned"):
+            continue
+        tokens = message_tokens(message)
+        if chosen and used + tokens > budget:
+            break
+        chosen.append(message)
+        used += tokens
+    chosen.reverse()
+    # заметка о паузе без сообщения после неё бессмысленна
+    while len(chosen) > 1 and chosen[0].get("role") == "system":
+        used -= message_tokens(chosen.pop(0))
+    chosen = pinned + chosen
+
+    dropped = len(messages) - len(chosen)
+    stats_counters["calls"] += 1
+    if dropped:
+        stats_counters["trimmed_calls"] += 1
+        stats_counters["messages_dropped"] += dropped
+        logger.debug(f"context_window: {model}: kept {len(chosen)}/{len(messages)} messages, {used}/{budget} tokens")
+    key = (persona_id, model)
+    _last_budgets.pop(key, None)
+    if len(_last_budgets) >= 1000:
+        _last_budgets.pop(next(iter(_last_budgets)))
+    _last_budgets[key] = {
+        "budget": token_budget(model),
+        "history_budget": budget,
+        "history_tokens": used,
+        "messages": len(chosen),
+        "dropped": dropped,
+    }
+    return [{"role": message["role"], "content": message["content"]} for message in chosen]
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "counters": dict(stats_counters),
+        "budgets": {f"{persona_id}:{model}": values for (persona_id, model), values in list(_last_budgets.items())[-50:]},
+    }
@@ -3,7 +3,10 @@ import json
 import logging
 from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, UniqueConstraint, func, BIGINT, select, update as sql_update, delete, Float
 from sqlalchemy.orm import sessionmaker, relationship, Session, joinedload, selectinload, noload
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy import event as sa_event, inspect as sa_inspect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
 from sqlalchemy.orm import declarative_base
 from contextlib import contextmanager # Р”РћР‘РђР’Р›Р•Рќ РРњРџРћР Рў
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError, ProgrammingError
@@ -21,6 +24,8 @@ from config import (
     ADMIN_USER_ID
 )
 import config
+import invalidation_bus
+from utils import count_openai_compatible_tokens
 
 # --- Default Templates ---
 
@@ -331,6 +336,8 @@ class ChatContext(Base):
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Токены content, считаются один раз при вставке (NULL у старых строк)
+    token_count = Column(Integer, nullable=True)
 
     # РЎРІСЏР·Р°РЅРЅР°СЏ СЃС‚РѕСЂРѕРЅР° РґР»СЏ back_populates
     chat_bot_instance = relationship("ChatBotInstance", back_populates="context")
@@ -339,6 +346,23 @@ class ChatContext(Base):
         content_preview = (self.content[:50] + '...') if len(self.content) > 50 else self.content
         return f"<ChatContext(id={self.id}, cbi_id={self.chat_bot_instance_id}, role='{self.role}', order={self.message_order}, content='{content_preview}')>"
 
+# Заголовок записи-конспекта в истории для LLM
+CONTEXT_SUMMARY_HEADER = "[краткое содержание более раннего разговора]"
+
+class ChatSummary(Base):
+    """Свёрнутая в конспект старая часть контекста чата (ведёт context_summarizer)."""
+    __tablename__ = 'chat_summaries'
+    id = Column(Integer, primary_key=True)
+    chat_bot_instance_id = Column(Integer, ForeignKey('chat_bot_instances.id', ondelete='CASCADE'), nullable=False, unique=True)
+    summary = Column(Text, nullable=False)
+    # сообщения с message_order <= covered_until_order уже вошли в конспект
+    covered_until_order = Column(Integer, nullable=False, default=0)
+    token_count = Column(Integer, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ChatSummary(cbi_id={self.chat_bot_instance_id}, covered_until={self.covered_until_order})>"
+
 # --- NEW: API Key Management ---
 class ApiKey(Base):
     __tablename__ = 'api_keys'
@@ -354,6 +378,20 @@ class ApiKey(Base):
         key_preview = self.api_key[:4] + '...' + self.api_key[-4:] if self.api_key and len(self.api_key) > 8 else 'invalid_key'
         return f"<ApiKey(id={self.id}, service='{self.service}', key='{key_preview}', active={self.is_active})>"
 
+# --- Credit ledger (idempotent payment crediting) ---
+class CreditLedger(Base):
+    __tablename__ = 'credit_ledger'
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(String, nullable=False, unique=True)  # id платежа у провайдера: повторный вебхук не начислит второй раз
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    amount = Column(Float, nullable=False)
+    source = Column(String, nullable=False, default='yookassa')
+    package_id = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<CreditLedger(id={self.id}, payment_id='{self.payment_id}', user_id={self.user_id}, amount={self.amount})>"
+
 # --- Database Setup ---
 engine = None
 SessionLocal = None
@@ -491,6 +529,25 @@ def get_db():
     finally:
         db.close()
 
+def schema_is_current() -> bool:
+    """True, if alembic_version in the DB matches the migration heads (create_all can be skipped)."""
+    if engine is None:
+        return False
+    try:
+        import os
+        from alembic.script import ScriptDirectory
+        script_dir = ScriptDirectory(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic"))
+        heads = set(script_dir.get_heads())
+        with engine.connect() as conn:
+            current = {row[0] for row in conn.exec_driver_sql("SELECT version_num FROM alembic_version")}
+        if current and current == heads:
+            logger.info(f"Schema is at alembic head {sorted(heads)}; skipping create_all.")
+            return True
+        logger.info(f"Schema revision {sorted(current)} != heads {sorted(heads)}; running create_all.")
+    except Exception as e:
+        logger.info(f"Could not compare alembic revision ({e}); running create_all.")
+    return False
+
 def create_tables():
     """Creates database tables based on the defined models IF THEY DON'T EXIST."""
     if engine is None:
@@ -510,6 +567,49 @@ def create_tables():
         logger.critical(f"FATAL: Failed to create/verify database tables for {db_log_url_on_error}: {e}", exc_info=True)
         raise
 
+# --- Cache invalidation events (invalidation_bus) ---
+# Коммит, изменивший персону, бота/мьют в чате или баланс, рассылает событие остальным
+# процессам. Хук на уровне Session покрывает все ORM-записи (визард, /botsettings, списание).
+
+def _state_get(obj, key):
+    # Без ленивой загрузки: внутри flush нельзя ходить в БД за связями
+    return sa_inspect(obj).dict.get(key)
+
+def _related_id(obj, relation, attr='id'):
+    related = _state_get(obj, relation)
+    return _state_get(related, attr) if related is not None else None
+
+@sa_event.listens_for(Session, "after_flush")
+def _collect_invalidation_events(session, flush_context):
+    events = session.info.setdefault('_invalidation_events', set())
+    changed = list(session.new) + [o for o in session.dirty if session.is_modified(o)] + list(session.deleted)
+    for obj in changed:
+        if isinstance(obj, PersonaConfig):
+            events.add((invalidation_bus.EVENT_PERSONA_CHANGED, (
+                ('persona_id', _state_get(obj, 'id')),
+                ('owner_telegram_id', _related_id(obj, 'owner', 'telegram_id')),
+                ('bot_instance_id', _related_id(obj, 'bot_instance')),
+            )))
+        elif isinstance(obj, BotInstance):
+            events.add((invalidation_bus.EVENT_BOT_CHANGED, (('bot_instance_id', _state_get(obj, 'id')),)))
+        elif isinstance(obj, ChatBotInstance):
+            events.add((invalidation_bus.EVENT_BOT_CHANGED, (
+                ('bot_instance_id', _state_get(obj, 'bot_instance_id')),
+                ('chat_id', _state_get(obj, 'chat_id')),
+            )))
+        elif isinstance(obj, User) and sa_inspect(obj).attrs.credits.history.has_changes():
+            events.add((invalidation_bus.EVENT_CREDITS_CHANGED, (('telegram_user_id', _state_get(obj, 'telegram_id')),)))
+
+@sa_event.listens_for(Session, "after_commit")
+def _publish_invalidation_events(session):
+    events = session.info.pop('_invalidation_events', None)
+    for event_name, fields in events or ():
+        invalidation_bus.publish(event_name, **dict(fields))
+
+@sa_event.listens_for(Session, "after_rollback")
+def _drop_invalidation_events(session):
+    session.info.pop('_invalidation_events', None)
+
 # --- Prompt Template Migration Helper ---
 def migrate_persona_prompt_templates(mode: str = "force") -> int:
     """
@@ -679,28 +779,6 @@ def get_all_active_chat_bot_instances(db: Session) -> List[ChatBotInstance]:
         logger.error(f"DB error getting all active instances: {e}", exc_info=True)
         return []
 
-def get_next_api_key(db: Session, service: str = 'gemini') -> Optional[ApiKey]:
-    """
-    Р’РѕР·РІСЂР°С‰Р°РµС‚ СЃР»РµРґСѓСЋС‰РёР№ РґРѕСЃС‚СѓРїРЅС‹Р№ API-РєР»СЋС‡ РґР»СЏ СѓРєР°Р·Р°РЅРЅРѕРіРѕ СЃРµСЂРІРёСЃР° РїРѕ РїСЂРёРЅС†РёРїСѓ LRU.
-    РСЃРїРѕР»СЊР·СѓРµС‚ Р±Р»РѕРєРёСЂРѕРІРєСѓ СЃС‚СЂРѕРєРё (FOR UPDATE), С‡С‚РѕР±С‹ РёР·Р±РµР¶Р°С‚СЊ РіРѕРЅРѕРє РїСЂРё РѕРґРЅРѕРІСЂРµРјРµРЅРЅС‹С… Р·Р°РїСЂРѕСЃР°С….
-    РљРѕРјРјРёС‚ РґРѕР»Р¶РµРЅ Р±С‹С‚СЊ РІС‹РїРѕР»РЅРµРЅ РІ РІС‹Р·С‹РІР°СЋС‰РµРј РєРѕРґРµ РїРѕСЃР»Рµ РёСЃРїРѕР»СЊР·РѕРІР°РЅРёСЏ РєР»СЋС‡Р°.
-    """
-    # ОПТИМИЗИРОВАНО: Убрана блокировка with_for_update для ускорения
-    try:
-        key_obj = db.query(ApiKey).filter(
-            ApiKey.service == service,
-            ApiKey.is_active == True
-        ).order_by(ApiKey.last_used_at.asc()).first()
-
-        if key_obj:
-            key_obj.last_used_at = datetime.now(timezone.utc)
-            key_obj.requests_count = (key_obj.requests_count or 0) + 1
-            logger.info(f"API Key Rotation: selected key ID {key_obj.id} for service '{service}'.")
-            return key_obj
-    except SQLAlchemyError as e:
-        logger.error(f"Database error selecting next API key for '{service}': {e}", exc_info=True)
-    return None
-
 def delete_persona_config(db: Session, persona_id: int, owner_id: int) -> bool:
     """Deletes a PersonaConfig by its ID and owner's internal ID, and commits."""
     logger.warning(f"--- delete_persona_config: Attempting to delete PersonaConfig ID={persona_id} owned by User ID={owner_id} ---")
@@ -714,11 +792,15 @@ def delete_persona_config(db: Session, persona_id: int, owner_id: int) -> bool:
 
         if persona:
             persona_name = persona.name
+            bound_instance_id = persona.bot_instance.id if persona.bot_instance else None
+            bound_token = persona.bot_instance.bot_token if persona.bot_instance else None
             logger.info(f"Found PersonaConfig {persona_id} ('{persona_name}'). Proceeding with deletion.")
             # РџСЂРѕСЃС‚Рѕ СѓРґР°Р»СЏРµРј PersonaConfig. РљР°СЃРєР°РґРЅС‹Рµ РїСЂР°РІРёР»Р° СѓРґР°Р»СЏС‚ СЃРІСЏР·Р°РЅРЅС‹Рµ СЃСѓС‰РЅРѕСЃС‚Рё.
             logger.debug(f"Calling db.delete() for persona {persona_id}. Cascade will handle related entities. Attempting commit...")
             db.delete(persona)
             db.commit()
+            if bound_instance_id:
+                invalidate_bot_route(bot_instance_id=bound_instance_id, evict_token=bound_token)
             logger.info(f"Successfully committed deletion of PersonaConfig {persona_id} (Name: '{persona_name}')")
             return True
         else:
@@ -735,8 +817,95 @@ def delete_persona_config(db: Session, persona_id: int, owner_id: int) -> bool:
         db.rollback()
         return False
 
+def dialect_insert(db: Session, model):
+    """
+    INSERT construct for the session's dialect (postgresql or sqlite).
+    Both support on_conflict_do_nothing(), which the generic sqlalchemy.insert() lacks.
+    """
+    if db.get_bind().dialect.name == 'sqlite':
+        return sqlite_insert(model)
+    return pg_insert(model)
+
+# --- Payment Operations ---
+
+def apply_payment_credit(db: Session, payment_id: str, telegram_user_id: int, amount: float, package_id: Optional[str] = None, source: str = 'yookassa') -> Tuple[str, Optional[float]]:
+    """
+    Idempotently credits a payment and commits.
+    A credit_ledger row keyed by payment_id and an atomic `credits = credits + :amount` run in one transaction,
+    so webhook redeliveries never credit twice and concurrent balance changes are not lost.
+    Returns (status, new_balance): credited | duplicate | user_not_found | error.
+    """
+    try:
+        user_id = db.query(User.id).filter(User.telegram_id == telegram_user_id).scalar()
+        if user_id is None:
+            return "user_not_found", None
+
+        ledger_id = db.execute(
+            dialect_insert(db, CreditLedger)
+            .values(payment_id=str(payment_id), user_id=user_id, amount=float(amount), source=source, package_id=package_id)
+            .on_conflict_do_nothing(index_elements=['payment_id'])
+            .returning(CreditLedger.id)
+        ).scalar()
+        if ledger_id is None:
+            db.rollback()
+            logger.info(f"Payment {payment_id} already credited (ledger hit), skipping.")
+            return "duplicate", None
+
+        new_balance = db.execute(
+            sql_update(User)
+            .where(User.id == user_id)
+            .values(credits=User.credits + float(amount))
+            .returning(User.credits)
+        ).scalar()
+        db.commit()
+        # bulk UPDATE мимо ORM: хук сессии его не видит, публикуем явно
+        invalidation_bus.publish(invalidation_bus.EVENT_CREDITS_CHANGED, telegram_user_id=telegram_user_id)
+        return "credited", float(new_balance or 0)
+    except SQLAlchemyError as e:
+        logger.error(f"DB error crediting payment {payment_id} for user {telegram_user_id}: {e}", exc_info=True)
+        db.rollback()
+        return "error", None
+
+def debit_credits(db: Session, user: User, cost: float) -> Optional[float]:
+    """
+    Atomically debits `cost` credits: `credits = credits - :cost WHERE credits >= :cost`.
+    Runs in the caller's transaction (the caller commits), so a concurrent payment credit
+    or a debit from another chat of the same owner is never overwritten by a stale ORM value.
+    Returns the new balance, or None if the balance is insufficient.
+    """
+    new_balance = db.execute(
+        sql_update(User)
+        .where(User.id == user.id, User.credits >= float(cost))
+        .values(credits=User.credits - float(cost))
+        .returning(User.credits)
+    ).scalar()
+    if new_balance is None:
+        return None
+    # Обновляем объект без пометки dirty — иначе flush записал бы баланс обратно поверх чужих изменений
+    set_committed_value(user, 'credits', float(new_balance))
+    # bulk UPDATE мимо ORM: after_flush его не видит, событие публикуется после коммита вызывающего
+    db.info.setdefault('_invalidation_events', set()).add(
+        (invalidation_bus.EVENT_CREDITS_CHANGED, (('telegram_user_id', user.telegram_id),))
+    )
+    return float(new_balance)
+
 # --- Bot Instance Operations ---
 
+def invalidate_bot_route(token: Optional[str] = None, bot_instance_id: Optional[int] = None, evict_token: Optional[str] = None) -> None:
+    """
+    Drops the in-memory webhook route (bot_routing) after BotInstance/ACL writes.
+    evict_token: a token that is no longer bound (rebound or deleted) - its initialized Bot is dropped from bot_registry.
+    """
+    try:
+        import bot_routing  # local import to avoid cycles
+        bot_routing.invalidate(token=token, bot_instance_id=bot_instance_id)
+        if evict_token:
+            bot_routing.invalidate(token=evict_token)
+            from bot_registry import bot_registry  # local import: bot_registry тянет telegram
+            bot_registry.evict(evict_token)
+    except Exception as e:
+        logger.warning(f"Failed to invalidate bot route (bot_instance_id={bot_instance_id}): {e}")
+
 def create_bot_instance(db: Session, owner_id: int, persona_config_id: int, name: str = None) -> BotInstance:
     """Creates a new BotInstance and commits."""
     logger.info(f"Creating BotInstance for persona_id {persona_config_id}, owner_id {owner_id}")
@@ -799,11 +968,16 @@ def set_bot_instance_token(db: Session, owner_id: int, persona_config_id: int, t
         if instance:
             # РћР±РЅРѕРІР»СЏРµРј СЃСѓС‰РµСЃС‚РІСѓСЋС‰РёР№
             logger.info(f"Updating existing BotInstance {instance.id} for persona {persona_config_id}.")
+            old_token = instance.bot_token
             instance.bot_token = token
             instance.telegram_bot_id = str(bot_id)
             instance.telegram_username = bot_username
             instance.status = "active"
             db.commit()
+            invalidate_bot_route(
+                token=token, bot_instance_id=instance.id,
+                evict_token=old_token if old_token and old_token != token else None,
+            )
             try:
                 db.refresh(instance)
             except SQLAlchemyError:
@@ -823,6 +997,7 @@ def set_bot_instance_token(db: Session, owner_id: int, persona_config_id: int, t
             try:
                 db.add(new_instance)
                 db.commit()
+                invalidate_bot_route(token=token)
                 try:
                     db.refresh(new_instance)
                 except SQLAlchemyError:
@@ -951,17 +1126,37 @@ def unlink_bot_instance_from_chat(db: Session, chat_id: Union[str, int], bot_ins
 # --- Context Operations ---
 
 def get_context_for_chat_bot(db: Session, chat_bot_instance_id: int) -> List[Dict[str, Any]]:
-    """Retrieves the last N messages for the LLM context, including timestamps."""
+    """Retrieves the last N messages for the LLM context, including timestamps.
+
+    If the chat has a rolling summary, only messages after it are loaded and the
+    summary goes first as a pinned entry (context_window never trims it).
+    """
     try:
-        # РўРµРїРµСЂСЊ РІС‹Р±РёСЂР°РµРј С‚Р°РєР¶Рµ Рё timestamp
-        context_records = db.query(ChatContext.role, ChatContext.content, ChatContext.timestamp)\
-                            .filter(ChatContext.chat_bot_instance_id == chat_bot_instance_id)\
-                            .order_by(ChatContext.message_order.desc())\
-                            .limit(MAX_CONTEXT_MESSAGES_SENT_TO_LLM)\
-                            .all()
-
-        # Р’РѕР·РІСЂР°С‰Р°РµРј СЃРїРёСЃРѕРє СЃР»РѕРІР°СЂРµР№ СЃ С‚СЂРµРјСЏ РєР»СЋС‡Р°РјРё
-        return [{"role": role, "content": content, "timestamp": timestamp} for role, content, timestamp in reversed(context_records)]
+        summary = db.query(ChatSummary.summary, ChatSummary.covered_until_order, ChatSummary.token_count)\
+                    .filter(ChatSummary.chat_bot_instance_id == chat_bot_instance_id)\
+                    .first()
+
+        query = db.query(ChatContext.role, ChatContext.content, ChatContext.timestamp, ChatContext.token_count)\
+                  .filter(ChatContext.chat_bot_instance_id == chat_bot_instance_id)
+        if summary is not None:
+            query = query.filter(ChatContext.message_order > summary.covered_until_order)
+        context_records = query.order_by(ChatContext.message_order.desc())\
+                               .limit(MAX_CONTEXT_MESSAGES_SENT_TO_LLM)\
+                               .all()
+
+        history = [
+            {"role": role, "content": content, "timestamp": timestamp, "token_count": token_count}
+            for role, content, timestamp, token_count in reversed(context_records)
+        ]
+        if summary is not None and summary.summary:
+            history.insert(0, {
+                "role": "user",
+                "content": f"{CONTEXT_SUMMARY_HEADER}\n{summary.summary}",
+                "timestamp": None,
+                "token_count": summary.token_count,
+                "pinned": True,
+            })
+        return history
     except SQLAlchemyError as e:
         logger.error(f"DB error getting context for instance {chat_bot_instance_id}: {e}", exc_info=True)
         return []
@@ -1014,7 +1209,8 @@ def add_message_to_context(db: Session, chat_bot_instance_id: int, role: str, co
             message_order=max_order + 1,
             role=role,
             content=content,
-            timestamp=datetime.now(timezone.utc)
+            timestamp=datetime.now(timezone.utc),
+            token_count=count_openai_compatible_tokens(content),
         )
         db.add(new_message)
         logger.debug(f"Prepared new context message (order {max_order + 1}, role {role}) for instance {chat_bot_instance_id}. Pending commit.")
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+Явный кеш контекста Gemini (cachedContents) для системных промптов персон.
+
+Раньше системный промпт персоны (DEFAULT_SYSTEM_PROMPT_TEMPLATE + поля из
+мастера, несколько тысяч токенов) заново уходил в send_to_google_gemini на
+каждом ходе. Неявный кеш префиксов (prompt_layout) срабатывает не всегда и
+не гарантирует скидку.
+
+Теперь при GEMINI_CONTEXT_CACHE_ENABLED системный промпт загружается к
+провайдеру один раз на (ключ API, персона, версия промпта) — версия это хеш
+текста, — а запросы ссылаются на него полем cachedContent вместо
+system_instruction. Кеш у Gemini привязан к проекту ключа, поэтому ключ входит
+в идентификатор записи.
+
+Локальный реестр помнит имя кеша и срок жизни:
+- run_maintainer() продлевает (PATCH ttl) используемые кеши за
+  GEMINI_CONTEXT_CACHE_REFRESH_BEFORE до истечения, а простаивающие дольше
+  GEMINI_CONTEXT_CACHE_IDLE удаляет — хранение кеша платное;
+- версий у персоны может быть несколько (system включает правила типа чата и
+  настроение): они живут параллельно, переключение личка/группа не создаёт
+  кеш заново;
+- сохранение персоны в мастере (событие persona_changed из invalidation_bus, в
+  том числе пришедшее от других процессов) сразу снимает её записи и удаляет
+  кеши у провайдера;
+- если провайдер не нашёл кеш (404 или ошибка про cachedContent: истёк,
+  удалён другим процессом), запись забывается, и запрос повторяется с обычным
+  system_instruction.
+
+Промпты короче GEMINI_CONTEXT_CACHE_MIN_TOKENS не кешируются: у Gemini есть
+минимальный размер кеша. Для офлайн-замеров есть scripts/fake_gemini_server.py.
+"""
+
+import asyncio
+import collections
+import hashlib
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+import llm_clients
+from utils import count_openai_compatible_tokens
+
+logger = logging.getLogger(__name__)
+
+# Ответ на запрос с cachedContent, после которого кеш считаем потерянным: 404,
+# либо 400/403 с упоминанием cachedContent в тексте ошибки. Прочие 400/403
+# (битый запрос, ключ) к кешу отношения не имеют.
+_CACHE_ERROR_STATUSES = (400, 403)
+_CACHE_ERROR_MARKERS = ("cachedcontent", "cached content")
+
+# Не ссылаемся на кеш, которому осталось жить меньше (сек): запрос может не успеть
+_EXPIRY_MARGIN = 30.0
+# Пауза перед повторной попыткой создать кеш после ошибки (сек)
+_CREATE_BACKOFF = 600.0
+
+
+class CacheEntry:
+    """Кеш одной версии системного промпта персоны у провайдера."""
+
+    __slots__ = ("name", "api_key", "persona_id", "version", "tokens", "expires_at", "last_used", "hits")
+
+    def __init__(self, name: str, api_key: str, persona_id: Any, version: str, tokens: Optional[int]):
+        now = time.monotonic()
+        self.name = name
+        self.api_key = api_key
+        self.persona_id = persona_id
+        self.version = version
+        self.tokens = tokens
+        self.expires_at = now + config.GEMINI_CONTEXT_CACHE_TTL
+        self.last_used = now
+        self.hits = 0
+
+
+# (отпечаток ключа, persona_id, версия) -> запись
+_entries: Dict[Tuple[str, Any, str], CacheEntry] = {}
+# создание в процессе: параллельные запросы ждут одну задачу
+_creating: Dict[Tuple[str, Any, str], "asyncio.Future[Optional[CacheEntry]]"] = {}
+# после ошибки создания не пробуем до этого момента
+_failed_until: Dict[Tuple[str, Any, str], float] = {}
+# (api_key, имя) к удалению у провайдера
+_doomed: List[Tuple[str, str]] = []
+# invalidate_persona вызывается и из потоков (коммит в asyncio.to_thread)
+_lock = threading.Lock()
+
+stats_counters: Dict[str, int] = collections.Counter()
+
+
+def is_cache_miss(status_code: int, error_text: Optional[str]) -> bool:
+    """Провайдер отверг запрос из-за cachedContent (истёк, удалён, чужой)."""
+    if status_code == 404:
+        return True
+    if status_code in _CACHE_ERROR_STATUSES:
+        text = (error_text or "").lower()
+        return any(marker in text for marker in _CACHE_ERROR_MARKERS)
+    return False
+
+
+def _fingerprint(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def prompt_version(system_prompt: str) -> str:
+    return hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _headers(api_key: str) -> Dict[str, str]:
+    return {"Content-Type": "application/json", "x-goog-api-key": api_key}
+
+
+def _ttl() -> str:
+    return f"{int(config.GEMINI_CONTEXT_CACHE_TTL)}s"
+
+
+async def _create(api_key: str, persona_id: Any, version: str, system_prompt: str) -> Optional[CacheEntry]:
+    body = {
+        "model": f"models/{config.GEMINI_MODEL_NAME_FOR_API}",
+        "displayName": f"persona-{persona_id}-{version}",
+        "systemInstruction": {"parts": [{"text": system_prompt}]},
+        "ttl": _ttl(),
+    }
+    client = llm_clients.get_client(llm_clients.PROVIDER_GEMINI)
+    try:
+        resp = await client.post(f"{config.GEMINI_API_ROOT}/cachedContents", headers=_headers(api_key), json=body)
+    except Exception as e:
+        stats_counters["create_errors"] += 1
+        logger.warning(f"gemini_cache: create for persona {persona_id} failed: {e}")
+        return None
+    if resp.status_code != 200:
+        stats_counters["create_errors"] += 1
+        logger.warning(f"gemini_cache: create for persona {persona_id} returned {resp.status_code}: {resp.text[:200]}")
+        return None
+    data = resp.json()
+    name = data.get("name")
+    if not name:
+        stats_counters["create_errors"] += 1
+        return None
+    stats_counters["created"] += 1
+    tokens = (data.get("usageMetadata") or {}).get("totalTokenCount")
+    logger.info(f"gemini_cache: created {name} for persona {persona_id} (version {version}, {tokens} tokens)")
+    return CacheEntry(name, api_key, persona_id, version, tokens)
+
+
+async def _create_and_register(key: Tuple[str, Any, str], api_key: str, persona_id: Any, version: str, system_prompt: str) -> Optional[CacheEntry]:
+    try:
+        entry = await _create(api_key, persona_id, version, system_prompt)
+    finally:
+        _creating.pop(key, None)
+    if entry is None:
+        _failed_until[key] = time.monotonic() + _CREATE_BACKOFF
+        return None
+    with _lock:
+        # Прежние версии не трогаем: у одной персоны их несколько одновременно
+        # (личка/группа, настроение). Ненужные снимет простой в maintain(),
+        # правку персоны — invalidate_persona.
+        _entries[key] = entry
+    stats_counters["misses"] += 1
+    return entry
+
+
+async def cached_content_name(api_key: Optional[str], system_prompt: str, persona_id: Any) -> Optional[str]:
+    """Имя cachedContents для этого промпта или None (кеш выключен, промпт мал, ошибка)."""
+    if not config.GEMINI_CONTEXT_CACHE_ENABLED or persona_id is None or not api_key or not system_prompt:
+        return None
+    version = prompt_version(system_prompt)
+    key = (_fingerprint(api_key), persona_id, version)
+    now = time.monotonic()
+
+    entry = _entries.get(key)
+    if entry is not None:
+        if entry.expires_at - now > _EXPIRY_MARGIN:
+            entry.last_used = now
+            entry.hits += 1
+            stats_counters["hits"] += 1
+            return entry.name
+        with _lock:
+            _entries.pop(key, None)
+        stats_counters["expired"] += 1
+
+    if _failed_until.get(key, 0.0) > now:
+        return None
+    if count_openai_compatible_tokens(system_prompt) < config.GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        stats_counters["too_small"] += 1
+        return None
+
+    pending = _creating.get(key)
+    if pending is None:
+        pending = _creating[key] = asyncio.ensure_future(_create_and_register(key, api_key, persona_id, version, system_prompt))
+    else:
+        stats_counters["hits"] += 1
+    # отмена одного запроса не должна отменять создание для остальных, кто его ждёт
+    entry = await asyncio.shield(pending)
+    if entry is None:
+        return None
+    entry.last_used = time.monotonic()
+    return entry.name
+
+
+def forget(name: Optional[str]) -> None:
+    """Провайдер не принял кеш — запись забываем, следующий запрос создаст новый."""
+    if not name:
+        return
+    with _lock:
+        for key in [k for k, entry in _entries.items() if entry.name == name]:
+            del _entries[key]
+    stats_counters["lost"] += 1
+    logger.info(f"gemini_cache: {name} rejected by provider, forgotten")
+
+
+def invalidate_persona(persona_id: Any) -> int:
+    """Снимает все кеши персоны (персону изменили в мастере). Удаление у провайдера — в run_maintainer."""
+    if persona_id is None:
+        return 0
+    with _lock:
+        keys = [k for k in _entries if str(k[1]) == str(persona_id)]
+        for key in keys:
+            entry = _entries.pop(key)
+            _doomed.append((entry.api_key, entry.name))
+        for key in [k for k in _failed_until if str(k[1]) == str(persona_id)]:
+            del _failed_until[key]
+    if keys:
+        stats_counters["invalidated"] += len(keys)
+        logger.info(f"gemini_cache: persona {persona_id} changed, {len(keys)} cache(s) dropped")
+    return len(keys)
+
+
+async def _delete(api_key: str, name: str) -> None:
+    client = llm_clients.get_client(llm_clients.PROVIDER_GEMINI)
+    try:
+        resp = await client.delete(f"{config.GEMINI_API_ROOT}/{name}", headers=_headers(api_key))
+        if resp.status_code in (200, 404):
+            stats_counters["deleted"] += 1
+        else:
+            stats_counters["delete_errors"] += 1
+            logger.debug(f"gemini_cache: delete {name} returned {resp.status_code}")
+    except Exception as e:
+        stats_counters["delete_errors"] += 1
+        logger.debug(f"gemini_cache: delete {name} failed: {e}")
+
+
+async def _refresh(entry: CacheEntry) -> None:
+    client = llm_clients.get_client(llm_clients.PROVIDER_GEMINI)
+    try:
+        resp = await client.patch(
+            f"{config.GEMINI_API_ROOT}/{entry.name}",
+            params={"updateMask": "ttl"},
+            headers=_headers(entry.api_key),
+            json={"ttl": _ttl()},
+        )
+    except Exception as e:
+        stats_counters["refresh_errors"] += 1
+        logger.debug(f"gemini_cache: refresh {entry.name} failed: {e}")
+        return
+    if resp.status_code == 200:
+        entry.expires_at = time.monotonic() + config.GEMINI_CONTEXT_CACHE_TTL
+        stats_counters["refreshed"] += 1
+    elif resp.status_code == 404:
+        forget(entry.name)
+    else:
+        stats_counters["refresh_errors"] += 1
+        logger.debug(f"gemini_cache: refresh {entry.name} returned {resp.status_code}")
+
+
+async def maintain() -> None:
+    """Один проход: удаляет снятые и простаивающие кеши, продлевает используемые перед истечением."""
+    now = time.monotonic()
+    to_refresh: List[CacheEntry] = []
+    with _lock:
+        for key, entry in list(_entries.items()):
+            if now - entry.last_used > config.GEMINI_CONTEXT_CACHE_IDLE:
+                del _entries[key]
+                _doomed.append((entry.api_key, entry.name))
+                stats_counters["idle_dropped"] += 1
+            elif entry.expires_at - now < config.GEMINI_CONTEXT_CACHE_REFRESH_BEFORE:
+                to_refresh.append(entry)
+        doomed = list(_doomed)
+        _doomed.clear()
+        for key in [k for k, until in _failed_until.items() if until <= now]:
+            del _failed_until[key]
+    for api_key, name in doomed:
+        await _delete(api_key, name)
+    for entry in to_refresh:
+        await _refresh(entry)
+
+
+async def run_maintainer() -> None:
+    """Фоновая задача: продление и удаление кешей; при остановке удаляет все свои кеши."""
+    while True:
+        try:
+            await asyncio.sleep(config.GEMINI_CONTEXT_CACHE_INTERVAL)
+            await maintain()
+        except asyncio.CancelledError:
+            # хранение кеша платное — не оставляем его жить до TTL после остановки
+            with _lock:
+                doomed = list(_doomed) + [(entry.api_key, entry.name) for entry in _entries.values()]
+                _doomed.clear()
+                _entries.clear()
+            for api_key, name in doomed:
+                await _delete(api_key, name)
+            raise
+        except Exception as e:
+            stats_counters["errors"] += 1
+            logger.warning(f"gemini_cache: maintenance failed: {e}")
+
+
+def stats() -> Dict[str, Any]:
+    now = time.monotonic()
+    with _lock:
+        entries = list(_entries.values())
+    return {
+        "enabled": config.GEMINI_CONTEXT_CACHE_ENABLED,
+        "counters": dict(stats_counters),
+        "entries": len(entries),
+        "cached_tokens": sum(entry.tokens or 0 for entry in entries),
+        "caches": [
+            {
+                "persona_id": entry.persona_id,
+                "version": entry.version,
+                "tokens": entry.tokens,
+                "hits": entry.hits,
+                "expires_in_sec": round(entry.expires_at - now, 1),
+            }
+            for entry in entries[-50:]
+        ],
+    }
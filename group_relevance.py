@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Решение «отвечать ли в группе» для режима mentioned_or_contextual.
+
+Раньше каждое сообщение без упоминания бота уходило в Gemini с
+format_should_respond_prompt: выбор ключа, закрытие/переоткрытие сессии и иногда
+ретрай. В активных группах это удваивало или утраивало трафик к LLM ради
+сообщений, на которые мы в основном не отвечаем.
+
+Теперь сначала считается дешёвый локальный скор по сигналам:
+- имя персоны с опечаткой или в другом падеже («алису», «алиска»);
+- вопрос (знак '?');
+- обращение во втором лице («ты», «вы», «you»);
+- сколько прошло с последней реплики бота;
+- доля реплик бота в последних сообщениях треда;
+- короткие реплики без содержания («ок», «лол»).
+
+Скор не ниже GROUP_PREFILTER_POSITIVE — отвечаем без LLM, не выше
+GROUP_PREFILTER_NEGATIVE — молчим без LLM, между ними — обычная LLM-проверка.
+Каждое решение пишется одной JSON-строкой в логгер group_relevance.decisions
+(со скором, сигналами и ответом LLM, если он был), чтобы пороги можно было
+подбирать офлайн.
+
+Окно решений (GROUP_DECISION_WINDOW_MS): всплеск сообщений в группе раньше
+стоил по LLM-проверке на каждое. Апдейты одного чата обрабатываются строго по
+очереди (update_scheduler), поэтому ждать соседей внутри обработчика бесполезно:
+вебхук отмечает текстовые сообщения групп в note_incoming() ещё при постановке в
+очередь. Первое сообщение, дошедшее до LLM-проверки, ждёт конца окна, забирает
+все сообщения чата из окна и одним вызовом выбирает, на какое (если на какое-то)
+отвечать. Решение сохраняется для каждого сообщения пачки, и их обработчики
+берут его из cached_decision() без своей проверки.
+"""
+
+import asyncio
+import collections
+import difflib
+import json
+import logging
+import re
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+decision_logger = logging.getLogger(__name__ + ".decisions")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SECOND_PERSON_RE = re.compile(
+    r"(?i)\b(ты|тебя|тебе|тобой|твой|твоя|твоё|твое|твои|вы|вас|вам|вами|ваш|ваша|you|your|u)\b"
+)
+_FILLER_RE = re.compile(r"(?i)^\W*(ок|окей|ok|лол|lol|ага|угу|да|нет|ха+|хах[ах]*|\)+|\++)\W*$")
+
+# Сколько последних сообщений истории смотреть для доли реплик бота
+_THREAD_WINDOW = 10
+# Слов сообщения, сравниваемых с именем (длинные простыни не разбираем целиком)
+_MAX_WORDS = 60
+
+stats_counters: Dict[str, int] = collections.Counter()
+
+
+class RelevanceScore:
+    """Локальная оценка сообщения: score, сработавшие сигналы и вердикт (True/False/None — нужен LLM)."""
+
+    __slots__ = ("score", "signals", "verdict")
+
+    def __init__(self, score: float, signals: Dict[str, float], verdict: Optional[bool]):
+        self.score = score
+        self.signals = signals
+        self.verdict = verdict
+
+
+def _name_matches(words: List[str], persona_name: str) -> bool:
+    """Нечёткое совпадение имени: опечатки (difflib) и окончания (общий префикс)."""
+    for name_part in _WORD_RE.findall(persona_name.lower()):
+        if len(name_part) < 3:
+            continue
+        for word in words:
+            if abs(len(word) - len(name_part)) > 3:
+                continue
+            prefix = 0
+            for a, b in zip(word, name_part):
+                if a != b:
+                    break
+                prefix += 1
+            if prefix >= max(3, len(name_part) - 2):
+                return True
+            if difflib.SequenceMatcher(None, word, name_part).ratio() >= config.GROUP_PREFILTER_NAME_SIMILARITY:
+                return True
+    return False
+
+
+def _seconds_since_bot_spoke(history: List[Dict[str, Any]], now: datetime) -> Optional[float]:
+    for msg in reversed(history):
+        if msg.get("role") != "assistant":
+            continue
+        ts = msg.get("timestamp")
+        if not isinstance(ts, datetime):
+            return None
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return max(0.0, (now - ts).total_seconds())
+    return None
+
+
+def score_message(
+    message_text: str,
+    persona_name: str,
+    history: List[Dict[str, Any]],
+    now: Optional[datetime] = None,
+) -> RelevanceScore:
+    """Считает скор сообщения группы. history — как из get_context_for_chat_bot (без текущего сообщения)."""
+    now = now or datetime.now(timezone.utc)
+    text = (message_text or "").strip()
+    words = [w.lower() for w in _WORD_RE.findall(text)[:_MAX_WORDS]]
+    signals: Dict[str, float] = {}
+
+    if persona_name and _name_matches(words, persona_name):
+        signals["name_fuzzy"] = 3.0
+    if "?" in text:
+        signals["question"] = 1.0
+    if _SECOND_PERSON_RE.search(text):
+        signals["second_person"] = 1.5
+
+    since = _seconds_since_bot_spoke(history, now)
+    if since is None:
+        signals["bot_silent"] = -1.5
+    elif since <= 60:
+        signals["bot_spoke_recently"] = 1.5
+    elif since <= 300:
+        signals["bot_spoke_recently"] = 0.5
+    elif since >= 3600:
+        signals["bot_silent"] = -1.0
+
+    recent = history[-_THREAD_WINDOW:]
+    if recent:
+        bot_share = sum(1 for msg in recent if msg.get("role") == "assistant") / len(recent)
+        if bot_share >= 0.4:
+            signals["bot_thread_share"] = 1.0
+        elif bot_share == 0:
+            signals["bot_thread_share"] = -1.0
+        if recent[-1].get("role") == "assistant":
+            signals["follows_bot"] = 1.0
+
+    if not words or _FILLER_RE.match(text):
+        signals["filler"] = -1.5
+
+    score = round(sum(signals.values()), 2)
+    if score >= config.GROUP_PREFILTER_POSITIVE:
+        verdict: Optional[bool] = True
+        stats_counters["positive"] += 1
+    elif score <= config.GROUP_PREFILTER_NEGATIVE:
+        verdict = False
+        stats_counters["negative"] += 1
+    else:
+        verdict = None
+        stats_counters["uncertain"] += 1
+    return RelevanceScore(score, signals, verdict)
+
+
+def log_decision(chat_id: str, persona_id: Any, result: RelevanceScore, llm_answer: Optional[str] = None) -> None:
+    """Одна JSON-строка на решение — материал для офлайн-подбора порогов."""
+    if llm_answer is not None:
+        stats_counters["llm_checked"] += 1
+    decision_logger.info(json.dumps({
+        "chat_id": chat_id,
+        "persona_id": persona_id,
+        "score": result.score,
+        "signals": result.signals,
+        "verdict": result.verdict,
+        "llm_answer": llm_answer,
+    }, ensure_ascii=False))
+
+
+# --- Окно решений по чату ---
+
+# Сколько помнить отмеченные сообщения и решения (сек)
+_WINDOW_TTL = 120.0
+# chat_id -> (время прихода, message_id, текст)
+_incoming: Dict[str, Deque[Tuple[float, int, str]]] = {}
+# (chat_id, persona_id, message_id) -> (время решения, отвечать ли)
+_decisions: Dict[Tuple[str, Any, int], Tuple[float, bool]] = {}
+_notes_since_sweep = 0
+
+
+def _sweep(now: float) -> None:
+    for chat_key in [key for key, queue in _incoming.items() if not queue or now - queue[-1][0] > _WINDOW_TTL]:
+        del _incoming[chat_key]
+    for key in [key for key, (decided_at, _) in _decisions.items() if now - decided_at > _WINDOW_TTL]:
+        del _decisions[key]
+
+
+def note_incoming(chat_id: Any, message_id: Optional[int], text: str) -> None:
+    """Отмечает текстовое сообщение группы в момент прихода (повторная отметка того же id игнорируется)."""
+    global _notes_since_sweep
+    if config.GROUP_DECISION_WINDOW_MS <= 0 or chat_id is None or message_id is None:
+        return
+    now = time.monotonic()
+    queue = _incoming.get(str(chat_id))
+    if queue is None:
+        queue = _incoming[str(chat_id)] = deque(maxlen=max(1, config.GROUP_DECISION_MAX_BATCH) * 4)
+    if any(mid == message_id for _, mid, _ in queue):
+        return
+    queue.append((now, message_id, text or ""))
+    _notes_since_sweep += 1
+    if _notes_since_sweep >= 500:
+        _notes_since_sweep = 0
+        _sweep(now)
+
+
+async def collect_window(chat_id: Any, message_id: int, text: str) -> List[Tuple[int, str]]:
+    """Ждёт конца окна, начатого этим сообщением, и возвращает сообщения чата из окна (включая его)."""
+    note_incoming(chat_id, message_id, text)
+    queue = _incoming.get(str(chat_id))
+    if config.GROUP_DECISION_WINDOW_MS <= 0 or not queue:
+        return [(message_id, text)]
+    window = config.GROUP_DECISION_WINDOW_MS / 1000.0
+    arrived = next((t for t, mid, _ in queue if mid == message_id), time.monotonic())
+    delay = arrived + window - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    batch = [(mid, txt) for t, mid, txt in list(queue) if arrived <= t <= arrived + window and txt.strip()]
+    batch = batch[:max(1, config.GROUP_DECISION_MAX_BATCH)]
+    if not any(mid == message_id for mid, _ in batch):
+        batch.insert(0, (message_id, text))
+    return batch
+
+
+def format_batch(batch: List[Tuple[int, str]]) -> str:
+    """Сообщения пачки с номерами для persona.BATCH_SHOULD_RESPOND_TEMPLATE."""
+    return "\n".join(f"{num}. {txt.strip()[:300]}" for num, (_, txt) in enumerate(batch, start=1))
+
+
+def parse_batch_answer(answer: str, batch: List[Tuple[int, str]]) -> Optional[int]:
+    """message_id выбранного сообщения по ответу модели ('2', 'Ответить на 3', 'Нет').
+
+    Промпт пачки просит номер: ответ без номера (в том числе «да») не выбирает ни одно сообщение.
+    """
+    match = re.search(r"\b\d+\b", answer or "")
+    if match:
+        num = int(match.group(0))
+        if 1 <= num <= len(batch):
+            return batch[num - 1][0]
+    return None
+
+
+def store_batch_decision(chat_id: Any, persona_id: Any, message_ids: List[int], chosen_id: Optional[int]) -> None:
+    now = time.monotonic()
+    for mid in message_ids:
+        _decisions[(str(chat_id), persona_id, mid)] = (now, mid == chosen_id)
+    stats_counters["batches"] += 1
+    stats_counters["batched_messages"] += len(message_ids)
+
+
+def cached_decision(chat_id: Any, persona_id: Any, message_id: Optional[int]) -> Optional[bool]:
+    """Решение, принятое для этого сообщения в составе пачки (одноразовое), или None."""
+    entry = _decisions.pop((str(chat_id), persona_id, message_id), None)
+    if entry is None or time.monotonic() - entry[0] > _WINDOW_TTL:
+        return None
+    stats_counters["batch_decisions_reused"] += 1
+    return entry[1]
+
+
+def stats() -> Dict[str, Any]:
+    return dict(stats_counters, window_chats=len(_incoming), pending_decisions=len(_decisions))
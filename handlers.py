@@ -14,8 +14,7 @@ import urllib.parse
 import uuid
 import wave
 import subprocess
-import base64
-from typing import List, Dict, Any, Optional, Union, Tuple
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Awaitable
 from sqlalchemy import delete
 from telegram.constants import ParseMode # Added for confirm_pay
 
@@ -60,24 +59,30 @@ context_cache = SimpleCache(ttl=120, max_size=300)  # 2 минуты
 # Константы для UI
 CHECK_MARK = "✅ "  # Unicode Check Mark Symbol
 
-# Импорты для работы с Vosk
-try:
-    from vosk import Model, KaldiRecognizer
-    VOSK_AVAILABLE = True
-except ImportError:
-    VOSK_AVAILABLE = False
+# Vosk импортируется лениво: импорт и загрузка модели занимают секунды и не должны задерживать старт.
+# Модель грузится в фоне после запуска веб-сервера (main.py) или при первом голосовом.
+import importlib.util
+import threading
+VOSK_AVAILABLE = importlib.util.find_spec("vosk") is not None
 
 # --- Vosk model setup ---
 VOSK_MODEL_PATH = "model_vosk_ru"
 vosk_model = None
+_vosk_load_lock = threading.Lock()
 
 def load_vosk_model(model_path: str):
-    """Helper function to load the Vosk model if not already loaded."""
+    """Helper function to load the Vosk model if not already loaded. Blocking: call via asyncio.to_thread."""
     global vosk_model
-    if vosk_model is None and VOSK_AVAILABLE:
+    if not VOSK_AVAILABLE:
+        logger.warning("Vosk library not available. Voice transcription is disabled.")
+        return
+    with _vosk_load_lock:
+        if vosk_model is not None:
+            return
         logger.info(f"Attempting to load Vosk model from path: {model_path}")
         try:
             if os.path.exists(model_path):
+                from vosk import Model
                 vosk_model = Model(model_path)
                 logger.info(f"Vosk model loaded successfully from {model_path}")
             else:
@@ -85,11 +90,6 @@ def load_vosk_model(model_path: str):
         except Exception as e:
             logger.error(f"Error loading Vosk model: {e}", exc_info=True)
             vosk_model = None # Ensure it's None on failure
-    elif not VOSK_AVAILABLE:
-        logger.warning("Vosk library not available. Voice transcription is disabled.")
-
-# Загружаем модель при старте
-load_vosk_model(VOSK_MODEL_PATH)
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Bot, CallbackQuery
 from telegram.constants import ChatAction, ParseMode, ChatMemberStatus, ChatType
@@ -102,10 +102,7 @@ from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError, ProgrammingError, OperationalError
 from sqlalchemy import func, delete
 
-from yookassa import Configuration as YookassaConfig, Payment
-from yookassa.domain.models.currency import Currency
-from yookassa.domain.request.payment_request_builder import PaymentRequestBuilder
-from yookassa.domain.models.receipt import Receipt, ReceiptItem
+# yookassa импортируется лениво (ensure_yookassa_configured / buycredits_pkg_callback)
 
 # --- ИСПРАВЛЕНИЕ: Добавлены импорты из config.py для устранения NameError ---
 import config
@@ -129,14 +126,28 @@ from db import (
     PersonaConfig as DBPersonaConfig, 
     PersonaConfig,  # Импорт и как DBPersonaConfig и как PersonaConfig для обратной совместимости
     get_persona_by_id_and_owner, link_bot_instance_to_chat,
-    set_bot_instance_token, ChatContext,
-    get_personas_by_owner, get_next_api_key,
+    set_bot_instance_token, ChatContext, ChatSummary, invalidate_bot_route, debit_credits,
+    get_personas_by_owner,
     get_all_active_chat_bot_instances,
     unlink_bot_instance_from_chat,
     func,
     DEFAULT_SYSTEM_PROMPT_TEMPLATE, DEFAULT_MOOD_PROMPTS
 )
 from persona import Persona, CommunicationStyle, Verbosity
+from bot_registry import bot_registry
+import llm_clients
+import key_scheduler
+import llm_gateway
+import llm_router
+import group_relevance
+import context_window
+import context_summarizer
+import prompt_layout
+import gemini_cache
+import llm_payload
+import media_preprocess
+from llm_stream import ArrayStreamParser, parse_llm_output
+from update_envelope import current_envelope
 from utils import (
     postprocess_response,
     extract_gif_links,
@@ -153,8 +164,12 @@ async def send_to_google_gemini(
     system_prompt: str,
     messages: List[Dict[str, str]],
     image_data: Optional[bytes] = None,
+    persona_id: Optional[int] = None,
 ) -> Union[List[str], str]:
-    """Отправляет запрос в нативный Google Gemini API и возвращает список строк или строку-ошибку."""
+    """Отправляет запрос в нативный Google Gemini API и возвращает список строк или строку-ошибку.
+
+    С persona_id системный промпт может уйти ссылкой на cachedContents (gemini_cache).
+    """
     if not api_key:
         logger.error("send_to_google_gemini called without API key")
         return "[ошибка: API-ключ не предоставлен]"
@@ -166,72 +181,21 @@ async def send_to_google_gemini(
         "Content-Type": "application/json",
         "x-goog-api-key": api_key,
     }
-    # --- Build request for Gemini: use system_instruction and cleaned contents ---
-    generation_config: Dict[str, Any] = {
-        "temperature": 1.0,
-        "topP": 0.95,
-        "topK": 64,
-        "maxOutputTokens": 8192,
-        # Запрашиваем JSON, чтобы модель сразу вернула валидный JSON-массив
-        "responseMimeType": "application/json",
-    }
-
-    formatted_messages: List[Dict[str, Any]] = []
-    for msg in messages:
-        # Skip legacy system entries in history; pass system via system_instruction
-        if msg.get("role") == "system":
-            continue
-        role = "model" if msg.get("role") == "assistant" else "user"
-        text = msg.get("content", "")
-        try:
-            # Strip optional "username: " prefix which model doesn't need
-            import re as _re
-            text = _re.sub(r"^\w+:\s", "", text)
-        except Exception:
-            pass
-        formatted_messages.append({"role": role, "parts": [{"text": text}]})
-
-    # If there are no messages (e.g., proactive "напиши что-нибудь"),
-    # add a minimal starter so Google API doesn't reject empty contents
-    if not formatted_messages:
-        formatted_messages.append({"role": "user", "parts": [{"text": "Начни диалог."}]})
-
-    # Ensure conversation doesn't start with model role
-    if formatted_messages and formatted_messages[0].get("role") == "model":
-        formatted_messages.insert(0, {"role": "user", "parts": [{"text": "(начало диалога)"}]})
-
-    # Attach image to the last user message, if any
-    if image_data and formatted_messages:
-        last = formatted_messages[-1]
-        if last.get("role") == "user":
-            base64_image = base64.b64encode(image_data).decode("utf-8")
-            last["parts"].append({
-                "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
-                }
-            })
-
-    payload = {
-        "contents": formatted_messages,
-        "system_instruction": {"parts": [{"text": system_prompt or ""}]},
-        "generationConfig": generation_config,
-        # Чуть ослабляем фильтры на базовом запросе, чтобы не ловить блок на безобидных сообщениях в группах
-        "safetySettings": [
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-            {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_ONLY_HIGH"},
-        ],
-    }
+    cache_name = await gemini_cache.cached_content_name(api_key, system_prompt, persona_id)
+    body = llm_payload.gemini_body(system_prompt, messages, image_data, cached_content=cache_name)
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            resp = await client.post(api_url, headers=headers, json=payload)
+        async with llm_clients.shared_client(llm_clients.PROVIDER_GEMINI) as client:
+            resp = await client.post(api_url, headers=headers, content=body)
+            if cache_name and gemini_cache.is_cache_miss(resp.status_code, resp.text):
+                # кеш истёк или удалён другим процессом — повторяем с обычным system_instruction
+                gemini_cache.forget(cache_name)
+                return await send_to_google_gemini(api_key, system_prompt, messages, image_data=image_data)
             resp.raise_for_status()
             # Используем встроенный парсер httpx, который корректно учитывает заголовки и кодировку
             data = resp.json()
+            key_scheduler.report(api_key, resp.status_code, tokens=_gemini_usage_tokens(data))
+            prompt_layout.record_gemini_usage(model_name, data)
 
             # Проверка блокировки промпта
             if isinstance(data, dict) and "promptFeedback" in data and isinstance(data.get("promptFeedback"), dict):
@@ -249,48 +213,10 @@ async def send_to_google_gemini(
                             " Ответ должен оставаться в формате JSON-массива строк: [\"...\", \"...\"]"
                         )
                         safe_system_prompt = (system_prompt or "") + safe_suffix
-                        # --- ИСПРАВЛЕНИЕ: формируем payload в том же формате, что и основной запрос ---
-                        safe_formatted_messages: List[Dict[str, Any]] = []
-                        for msg in messages or []:
-                            if msg.get("role") == "system":
-                                continue
-                            role = "model" if msg.get("role") == "assistant" else "user"
-                            text = msg.get("content", "")
-                            safe_formatted_messages.append({"role": role, "parts": [{"text": text}]})
-
-                        if safe_formatted_messages and safe_formatted_messages[0].get("role") == "model":
-                            safe_formatted_messages.insert(0, {"role": "user", "parts": [{"text": "(начало диалога)"}]})
-
-                        if image_data and safe_formatted_messages:
-                            last_msg = safe_formatted_messages[-1]
-                            if last_msg.get("role") == "user":
-                                base64_image_retry = base64.b64encode(image_data).decode("utf-8")
-                                last_msg["parts"].append({
-                                    "inline_data": {
-                                        "mime_type": "image/jpeg",
-                                        "data": base64_image_retry
-                                    }
-                                })
-
-                        safe_payload = {
-                            "contents": safe_formatted_messages,
-                            "system_instruction": {"parts": [{"text": safe_system_prompt}]},
-                            "generationConfig": {
-                                "temperature": 0.9,
-                                "topP": 0.95,
-                                "maxOutputTokens": 2048,
-                            },
-                            # Ослабленные пороги безопасности только для ретрая
-                            "safetySettings": [
-                                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                                {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"},
-                            ],
-                        }
+                        # тот же формат, что и основной запрос; фрагменты истории и base64 картинки уже закодированы
+                        safe_body = llm_payload.gemini_body(safe_system_prompt, messages or [], image_data, safe_retry=True)
                         # Повторный запрос
-                        resp2 = await client.post(api_url, headers=headers, json=safe_payload)
+                        resp2 = await client.post(api_url, headers=headers, content=safe_body)
                         resp2.raise_for_status()
                         data2 = resp2.json()
                         # Если снова блок — выдаём мягкий ответ
@@ -324,84 +250,9 @@ async def send_to_google_gemini(
                 logger.error(f"Google Gemini API returned a valid but empty/unexpected response: {data}")
                 return "[ошибка google api: получен пустой или неожиданный ответ от модели]"
 
-            # Пытаемся распарсить текст как JSON
-            try:
-                parsed = json.loads(text_content)
-                if isinstance(parsed, list):
-                    return [str(it) for it in parsed if str(it).strip()]
-                if isinstance(parsed, dict):
-                    # Сначала обрабатываем ключ 'response' как приоритетный
-                    response_val = parsed.get('response')
-                    if isinstance(response_val, list):
-                        return [str(it) for it in response_val if str(it).strip()]
-                    if isinstance(response_val, str) and response_val.strip():
-                        # Попытка распарсить строку как JSON-массив
-                        try:
-                            inner_list = json.loads(response_val)
-                            if isinstance(inner_list, list):
-                                return [str(it) for it in inner_list if str(it).strip()]
-                        except (json.JSONDecodeError, TypeError):
-                            # Если это не JSON, вернуть как одиночный ответ
-                            return [response_val]
-
-                    # Если 'response' не дал ответа — ищем в альтернативных ключах
-                    for key in ['answer', 'text', 'parts']:
-                        val = parsed.get(key)
-                        if isinstance(val, list):
-                            return [str(it) for it in val if str(it).strip()]
-                        if isinstance(val, str) and val.strip():
-                            return [val]
-
-                    logger.warning(f"Model returned JSON but couldn't extract a response list/string: {type(parsed)}. Wrapping as single item.")
-                    return [str(text_content)]
-                # Иные типы
-                logger.warning(f"Model returned JSON but unexpected type: {type(parsed)}. Wrapping as single item.")
-                return [str(text_content)]
-            except json.JSONDecodeError:
-                # Fallback: сначала попробуем извлечь JSON из fenced-блока и найти массив response
-                import re
-                try:
-                    extracted_block = extract_json_from_markdown(text_content)
-                except Exception as e:
-                    logger.debug(f"JSON extraction from markdown failed: {e}")
-                    extracted_block = text_content
-                logger.warning(f"Failed to parse JSON. Falling back to regex extraction. Preview: {extracted_block[:200]}")
-                # 1) Попробуем найти массив после ключа "response"
-                try:
-                    m = re.search(r'"response"\s*:\s*(\[.*?\])', extracted_block, re.DOTALL)
-                    if m:
-                        arr = json.loads(m.group(1))
-                        if isinstance(arr, list):
-                            return [str(it) for it in arr]
-                except Exception as e:
-                    logger.debug(f"JSON parse attempt failed: {e}")
-                # 2) Если не вышло — извлечем только элементы массива в квадратных скобках
-                try:
-                    m2 = re.search(r'(\[\s*".*?"\s*(?:,\s*".*?"\s*)*\])', extracted_block, re.DOTALL)
-                    if m2:
-                        arr2 = json.loads(m2.group(1))
-                        if isinstance(arr2, list):
-                            return [str(it) for it in arr2]
-                except Exception as e:
-                    logger.debug(f"JSON parse attempt failed: {e}")
-                # 3) Последний шанс: извлечь все строки в кавычках, исключая служебные ключи вроде "response"
-                try:
-                    extracted_parts = re.findall(r'"([^"\\]*(?:\\.[^"\\]*)*)"', extracted_block)
-                    cleaned_parts = [
-                        part.replace('\\"', '"').replace('\\\\', '\\')
-                        for part in extracted_parts
-                    ]
-                    final_parts = [p.strip() for p in cleaned_parts if p and p.strip() and p.strip().lower() != 'response']
-                    if final_parts:
-                        logger.info(f"Successfully extracted {len(final_parts)} parts via regex fallback.")
-                        return final_parts
-                    else:
-                        logger.error(f"Regex fallback found no quoted strings. Treating as single message. Preview: {extracted_block[:200]}")
-                        return [str(text_content)]
-                except Exception as regex_err:
-                    logger.error(f"Regex fallback failed with error: {regex_err}. Treating as single message.")
-                    return [str(text_content)]
+            return parse_llm_output(text_content)
     except httpx.HTTPStatusError as e:
+        key_scheduler.report(api_key, getattr(e.response, 'status_code', None))
         try:
             error_body = e.response.json()
             error_message = (error_body.get("error", {}) or {}).get("message") or str(e)
@@ -418,9 +269,128 @@ async def send_to_google_gemini(
         logger.error(f"Unexpected error in send_to_google_gemini calling '{api_url}': {e}", exc_info=True)
         return f"[неизвестная ошибка при обращении к API по адресу {api_url}]"
 
+def _gemini_usage_tokens(data: Any) -> Optional[int]:
+    """totalTokenCount из usageMetadata ответа Gemini (None, если его нет)."""
+    if not isinstance(data, dict):
+        return None
+    usage = data.get("usageMetadata") or {}
+    return usage.get("totalTokenCount")
+
+
+async def _iter_sse_data(resp: httpx.Response):
+    """Поля data: из SSE-потока (комментарии и пустые строки пропускаются)."""
+    async for line in resp.aiter_lines():
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data:
+                yield data
+
+
+# Статус для key_scheduler.report, когда стрим оборвался после первых частей
+_STREAM_INTERRUPTED_STATUS = 503
+
+
+def _finish_stream(parser: ArrayStreamParser, parsed: Union[List[str], str]) -> Union[List[str], str]:
+    """Итог стрима: то, что уже ушло в чат, обязано остаться префиксом результата."""
+    streamed = [str(it) for it in parser.items if str(it).strip()]
+    if parser.completed:
+        return streamed
+    if streamed:
+        if isinstance(parsed, list) and parsed[:len(streamed)] == streamed:
+            return parsed
+        return streamed
+    return parsed
+
+
+async def stream_google_gemini(
+    api_key: str,
+    system_prompt: str,
+    messages: List[Dict[str, str]],
+    on_part: Callable[[str], Awaitable[None]],
+    image_data: Optional[bytes] = None,
+    persona_id: Optional[int] = None,
+) -> Union[List[str], str]:
+    """Стриминговый send_to_google_gemini (streamGenerateContent, SSE).
+
+    Элементы JSON-массива передаются в on_part, как только модель их дописала.
+    Если до первого элемента случилась блокировка промпта, пустой ответ или обрыв,
+    повторяем обычным send_to_google_gemini (там ретрай с безопасным промптом).
+    """
+    if not api_key:
+        return await send_to_google_gemini(api_key, system_prompt, messages, image_data=image_data)
+
+    api_url = config.GEMINI_API_BASE_URL_TEMPLATE.format(model=config.GEMINI_MODEL_NAME_FOR_API)
+    api_url = api_url.replace(":generateContent", ":streamGenerateContent")
+    api_url += ("&" if "?" in api_url else "?") + "alt=sse"
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": api_key,
+    }
+    cache_name = await gemini_cache.cached_content_name(api_key, system_prompt, persona_id)
+    body = llm_payload.gemini_body(system_prompt, messages, image_data, cached_content=cache_name)
+    parser = ArrayStreamParser()
+    text_chunks: List[str] = []
+    usage_tokens = None
+    last_usage_chunk = None
+
+    async def _fallback(reason: str) -> Union[List[str], str]:
+        logger.warning(f"stream_google_gemini: {reason}; falling back to non-streaming call")
+        return await send_to_google_gemini(api_key, system_prompt, messages, image_data=image_data)
+
+    try:
+        client = llm_clients.get_client(llm_clients.PROVIDER_GEMINI)
+        async with client.stream("POST", api_url, headers=headers, content=body) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                if cache_name and gemini_cache.is_cache_miss(resp.status_code, resp.text):
+                    gemini_cache.forget(cache_name)
+                    return await stream_google_gemini(api_key, system_prompt, messages, on_part, image_data=image_data)
+                key_scheduler.report(api_key, resp.status_code)
+                try:
+                    error_message = ((resp.json() or {}).get("error", {}) or {}).get("message") or resp.text
+                except Exception:
+                    error_message = resp.text
+                logger.error(f"API error calling '{api_url}' (status={resp.status_code}): {error_message}")
+                return f"[ошибка google api {resp.status_code}: Provider returned error]"
+            async for data in _iter_sse_data(resp):
+                chunk = json.loads(data)
+                # usageMetadata в чанках накопительный: последний — итог
+                usage_tokens = _gemini_usage_tokens(chunk) or usage_tokens
+                if chunk.get("usageMetadata"):
+                    last_usage_chunk = chunk
+                feedback = chunk.get("promptFeedback")
+                if isinstance(feedback, dict) and feedback.get("blockReason") not in (None, "BLOCK_REASON_UNSPECIFIED"):
+                    if not parser.items:
+                        return await _fallback(f"prompt blocked ({feedback.get('blockReason')})")
+                    break
+                candidate = (chunk.get("candidates") or [{}])[0] or {}
+                for part in (candidate.get("content") or {}).get("parts") or []:
+                    text = part.get("text")
+                    if not text:
+                        continue
+                    text_chunks.append(text)
+                    for item in parser.feed(text):
+                        await on_part(item)
+    except Exception as e:
+        if not parser.items:
+            return await _fallback(f"stream failed before first part: {e}")
+        logger.warning(f"stream_google_gemini: stream interrupted after {len(parser.items)} parts: {e}")
+        # модель уже сгенерировала часть ответа: списываем токены и сообщаем о сбое ключа
+        key_scheduler.report(api_key, _STREAM_INTERRUPTED_STATUS, tokens=usage_tokens)
+        prompt_layout.record_gemini_usage(config.GEMINI_MODEL_NAME_FOR_API, last_usage_chunk)
+        return _finish_stream(parser, [])
+
+    key_scheduler.report(api_key, 200, tokens=usage_tokens)
+    prompt_layout.record_gemini_usage(config.GEMINI_MODEL_NAME_FOR_API, last_usage_chunk)
+    full_text = "".join(text_chunks)
+    if not parser.items and not full_text.strip():
+        return await _fallback("empty stream")
+    return _finish_stream(parser, [] if parser.completed else parse_llm_output(full_text))
+
 # --- Constants ---
 BOTSET_SELECT, BOTSET_MENU, BOTSET_WHITELIST_ADD, BOTSET_WHITELIST_REMOVE = range(4)
 
+
 def _process_history_for_time_gaps(history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
     """
     Processes message history to insert system notes about time gaps.
@@ -450,8 +420,13 @@ def _process_history_for_time_gaps(history: List[Dict[str, Any]]) -> List[Dict[s
             if note:
                 processed_history.append({"role": "system", "content": note})
 
-        # Добавляем само сообщение, но уже без timestamp
-        processed_history.append({"role": message["role"], "content": message["content"]})
+        # Добавляем само сообщение, но уже без timestamp (token_count нужен context_window)
+        processed_history.append({
+            "role": message["role"],
+            "content": message["content"],
+            "token_count": message.get("token_count"),
+            "pinned": bool(message.get("pinned")),
+        })
         last_timestamp = current_timestamp
         
     return processed_history
@@ -676,6 +651,7 @@ async def botsettings_set_access(update: Update, context: ContextTypes.DEFAULT_T
         bi.access_level = new_level
         db.add(bi)
         db.commit()
+        invalidate_bot_route(bot_instance_id=bi.id)
     return await botsettings_menu_show(update, context)
 
 async def botsettings_wl_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -741,6 +717,7 @@ async def botsettings_wl_add_receive(update: Update, context: ContextTypes.DEFAU
             bi.whitelisted_users_json = json.dumps(wl, ensure_ascii=False)
             db.add(bi)
             db.commit()
+            invalidate_bot_route(bot_instance_id=bi.id)
     await update.message.reply_text("пользователь добавлен в whitelist.", parse_mode=None)
     return await botsettings_menu_show(update, context)
 
@@ -798,6 +775,7 @@ async def botsettings_wl_remove_confirm(update: Update, context: ContextTypes.DE
             bi.whitelisted_users_json = json.dumps(wl, ensure_ascii=False)
             db.add(bi)
             db.commit()
+            invalidate_bot_route(bot_instance_id=bi.id)
     return await botsettings_menu_show(update, context)
 
 async def botsettings_mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -827,6 +805,7 @@ async def botsettings_mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cbi.is_muted = True
             db.add(cbi)
             db.commit()
+            invalidate_bot_route(bot_instance_id=cbi.bot_instance_id)
         except Exception:
             db.rollback()
             await q.edit_message_text("не удалось применить мут (ошибка БД)")
@@ -860,6 +839,7 @@ async def botsettings_unmute(update: Update, context: ContextTypes.DEFAULT_TYPE)
             cbi.is_muted = False
             db.add(cbi)
             db.commit()
+            invalidate_bot_route(bot_instance_id=cbi.bot_instance_id)
         except Exception:
             db.rollback()
             await q.edit_message_text("не удалось применить размут (ошибка БД)")
@@ -913,6 +893,7 @@ async def transcribe_audio_with_vosk(audio_data: bytes, original_mime_type: str)
                 logger.error(f"Audio file {temp_wav_filename} is not in the correct format.")
                 return None
 
+            from vosk import KaldiRecognizer
             current_recognizer = KaldiRecognizer(vosk_model, wf.getframerate())
             current_recognizer.SetWords(True)
 
@@ -1080,32 +1061,6 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 # --- Core Logic Helpers ---
-def extract_json_from_markdown(text: str) -> str:
-    """
-    Extracts a JSON string from a markdown code block (e.g., ```json...```).
-    If no markdown block is found, returns the original text.
-    """
-    # The pattern looks for a string inside ```<lang>? ... ``` or ``` ... ```
-    # Previously we only allowed optional 'json' language marker, which caused leaking 'text' into content
-    # when models responded with ```text ...```. Now accept any language marker and exclude it from capture.
-    pattern = r"```(?:[a-zA-Z0-9_\-]+)?\s*([\s\S]*?)\s*```"
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        extracted_json = match.group(1).strip()
-        # Safety: drop a leading language marker line like 'text', 'json', 'markdown', etc.
-        # Examples to strip: 'text', 'text:\n', 'json -', 'md: ', 'plain\n'
-        # Accept punctuation like :, -, ., ;, — and spaces after marker
-        lang_marker_pattern = r'^(?:json|text|markdown|plain|md)\b[\s:\-\.；;—–]*'
-        extracted_json = re.sub(lang_marker_pattern, '', extracted_json, flags=re.IGNORECASE)
-        logger.debug(f"Extracted from fenced block. Original len={len(text)}, extracted len={len(extracted_json)}; preview='{extracted_json[:120]}'")
-        return extracted_json
-    # If no markdown block is found, maybe the response is already a clean JSON array.
-    plain = text.strip()
-    # Also strip plain leading language markers if model put them without fences
-    plain = re.sub(r'^(?:json|text|markdown|plain|md)\b[\s:\-\.；;—–]*', '', plain, flags=re.IGNORECASE)
-    logger.debug(f"No fenced block detected. Returning plain text preview='{plain[:120]}' (orig len={len(text)})")
-    return plain
-
 def _is_degenerate_text(text: str) -> bool:
     """Heuristic check for useless model outputs like 'ext', 'ok', single meaningless ascii tokens.
     Returns True if the text is likely garbage and should trigger a fallback/regeneration.
@@ -1135,6 +1090,8 @@ def _is_degenerate_text(text: str) -> bool:
 
 # Максимальная длина входящего сообщения от пользователя в символах
 MAX_USER_MESSAGE_LENGTH_CHARS = 600
+# Значения media_reaction, при которых личность не отвечает на текст (сообщение только пишется в контекст)
+TEXT_IGNORING_MEDIA_REACTIONS = ("all_media_no_text", "photo_only", "voice_only", "none")
 
 async def send_to_openrouter(
     api_key: str,
@@ -1152,56 +1109,14 @@ async def send_to_openrouter(
         "HTTP-Referer": "https://t.me/your_bot_username",
         "X-Title": "NunuAi Telegram Bot",
     }
-    openrouter_messages = []
-    if system_prompt:
-        openrouter_messages.append({"role": "system", "content": system_prompt})
-    if image_data:
-        last_user_message = next((m for m in reversed(messages) if m.get('role') == 'user'), None)
-        text_content = last_user_message['content'] if last_user_message else "Опиши картинку кратко, затем задай 1-2 вопроса. Ответ в JSON."
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        image_url_data = f"data:image/jpeg;base64,{base64_image}"
-        # Пересобираем последнее пользовательское сообщение вместе с картинкой в универсальном формате
-        if last_user_message:
-            messages_without_last = [m for m in messages if m is not last_user_message]
-            openrouter_messages.extend(messages_without_last)
-        else:
-            openrouter_messages.extend(messages)
-        openrouter_messages.append({
-            "role": "user",
-            "content": [
-                {"type": "text", "text": text_content},
-                {"type": "image_url", "image_url": {"url": image_url_data}},
-            ],
-        })
-    else:
-        openrouter_messages.extend(messages)
-    # Напрямую используем имя модели из конфига; позволяем OpenRouter маршрутизировать запрос автоматически
-    payload = {
-        "model": model_name,
-        "messages": openrouter_messages,
-        "stream": False,
-        "response_format": {"type": "json_object"},
-        # Pass-through Gemini safety settings via OpenRouter
-        "safety_settings": [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ],
-    }
-    # Temperature: если явно не задано — используем немного творческий режим по умолчанию
-    if temperature is not None:
-        payload["temperature"] = float(temperature)
-    else:
-        payload["temperature"] = 0.9
-    if max_tokens is not None:
-        payload["max_tokens"] = int(max_tokens)
+    body = llm_payload.openrouter_body(system_prompt, messages, model_name, image_data, temperature, max_tokens)
     try:
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            resp = await client.post(config.OPENROUTER_API_BASE_URL, json=payload, headers=headers)
+        async with llm_clients.shared_client(llm_clients.PROVIDER_OPENROUTER) as client:
+            resp = await client.post(config.OPENROUTER_API_BASE_URL, content=body, headers=headers)
         if resp.status_code == 200:
             try:
                 data = resp.json()
+                prompt_layout.record_openrouter_usage(model_name, data)
                 content = data.get('choices', [{}])[0].get('message', {}).get('content', '')
                 if not content or _is_degenerate_text(content):
                     logger.warning(f"OpenRouter returned empty or degenerate content: '{str(content)[:100]}' — attempting one safe retry with adjusted params")
@@ -1214,52 +1129,14 @@ async def send_to_openrouter(
                     )
                     retry_system_prompt = (system_prompt or "") + retry_suffix
 
-                    # Build retry messages: start with modified system, then original user/assistant messages
-                    base_messages = messages or []
-                    retry_messages = []
-                    if retry_system_prompt:
-                        retry_messages.append({"role": "system", "content": retry_system_prompt})
-                    # Rebuild image payload if needed
-                    if image_data:
-                        # replicate same image handling as above
-                        last_user_message = next((m for m in reversed(base_messages) if m.get('role') == 'user'), None)
-                        text_content = last_user_message['content'] if last_user_message else "Опиши картинку кратко, затем задай 1-2 вопроса. Ответ в JSON."
-                        base64_image = base64.b64encode(image_data).decode('utf-8')
-                        image_url_data = f"data:image/jpeg;base64,{base64_image}"
-                        if last_user_message:
-                            messages_without_last = [m for m in base_messages if m is not last_user_message]
-                            retry_messages.extend(messages_without_last)
-                        else:
-                            retry_messages.extend(base_messages)
-                        retry_messages.append({
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": text_content},
-                                {"type": "image_url", "image_url": {"url": image_url_data}},
-                            ],
-                        })
-                    else:
-                        retry_messages.extend(base_messages)
-
-                    retry_payload = {
-                        "model": model_name,
-                        "messages": retry_messages,
-                        "stream": False,
-                        "response_format": {"type": "json_object"},
-                        # Pass-through Gemini safety settings via OpenRouter (retry)
-                        "safety_settings": [
-                            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                        ],
-                        "temperature": 0.75,
-                    }
-                    if max_tokens is not None:
-                        retry_payload["max_tokens"] = int(max_tokens)
+                    # Тот же запрос с изменённым системным промптом; фрагменты истории и base64 картинки переиспользуются
+                    retry_body = llm_payload.openrouter_body(
+                        retry_system_prompt, messages or [], model_name, image_data,
+                        temperature=0.75, max_tokens=max_tokens,
+                    )
                     try:
-                        async with httpx.AsyncClient(timeout=90.0) as client:
-                            retry_resp = await client.post(config.OPENROUTER_API_BASE_URL, json=retry_payload, headers=headers)
+                        async with llm_clients.shared_client(llm_clients.PROVIDER_OPENROUTER) as client:
+                            retry_resp = await client.post(config.OPENROUTER_API_BASE_URL, content=retry_body, headers=headers)
                         if retry_resp.status_code == 200:
                             try:
                                 retry_data = retry_resp.json()
@@ -1271,33 +1148,7 @@ async def send_to_openrouter(
                                     return [
                                         "не совсем понял мысль. можешь сказать иначе или чуть подробнее?",
                                     ]
-                                # Parse JSON on retry (flexible)
-                                try:
-                                    retry_clean = (retry_content or "").strip()
-                                    # strip common markdown code fences
-                                    if retry_clean.startswith("```") and retry_clean.endswith("```"):
-                                        retry_clean = retry_clean.strip("`")
-                                    if retry_clean.lower().startswith("json\n"):
-                                        retry_clean = retry_clean[5:]
-                                    retry_parsed = json.loads(retry_clean)
-                                    if isinstance(retry_parsed, dict) and isinstance(retry_parsed.get("response"), list):
-                                        return [str(item).strip() for item in retry_parsed["response"] if str(item).strip()]
-                                    if isinstance(retry_parsed, list):
-                                        return [str(item).strip() for item in retry_parsed if str(item).strip()]
-                                    if isinstance(retry_parsed, dict):
-                                        for key in ["text", "body", "message", "content", "answer"]:
-                                            val = retry_parsed.get(key)
-                                            if isinstance(val, str) and val.strip():
-                                                return [val.strip()]
-                                            if isinstance(val, list):
-                                                items = [str(it).strip() for it in val if str(it).strip()]
-                                                if items:
-                                                    return items
-                                    logger.warning(f"OpenRouter retry returned valid JSON but unexpected structure: {str(retry_parsed)[:200]}")
-                                    return [json.dumps(retry_parsed, ensure_ascii=False, indent=2)]
-                                except Exception as e_json_retry:
-                                    logger.warning(f"Retry JSON parse failed: {e_json_retry}. Raw: {retry_content[:200]}")
-                                    return [str(retry_content)]
+                                return parse_llm_output(retry_content)
                             except (json.JSONDecodeError, IndexError) as e2:
                                 logger.warning(f"Could not parse OpenRouter JSON retry response: {e2}. Raw text: {retry_resp.text[:250]}")
                                 return f"[ошибка openrouter: не удалось обработать ответ: {retry_resp.text[:100]}]"
@@ -1307,46 +1158,7 @@ async def send_to_openrouter(
                     except Exception as retry_err:
                         logger.error(f"Retry request to OpenRouter failed: {retry_err}")
                         return f"[ошибка сети при повторном обращении к OpenRouter: {retry_err}]"
-                # Parse primary response as JSON
-                try:
-                    clean = (content or "").strip()
-                    # strip common markdown code fences
-                    if clean.startswith("```") and clean.endswith("```"):
-                        clean = clean.strip("`")
-                    if clean.lower().startswith("json\n"):
-                        clean = clean[5:]
-                    parsed = json.loads(clean)
-
-                    # 1) Preferred format: {"response": [ ... ]}
-                    if isinstance(parsed, dict) and isinstance(parsed.get("response"), list):
-                        return [str(item).strip() for item in parsed["response"] if str(item).strip()]
-                    # Added: handle string response
-                    elif isinstance(parsed, dict) and isinstance(parsed.get("response"), str):
-                        response_str = parsed.get("response", "").strip()
-                        if response_str:
-                            return [response_str]
-
-                    # 2) Fallback: raw list [ ... ]
-                    if isinstance(parsed, list):
-                        return [str(item).strip() for item in parsed if str(item).strip()]
-
-                    # 3) Heuristic extraction from common keys
-                    if isinstance(parsed, dict):
-                        for key in ["text", "body", "message", "content", "answer"]:
-                            val = parsed.get(key)
-                            if isinstance(val, str) and val.strip():
-                                return [val.strip()]
-                            if isinstance(val, list):
-                                items = [str(it).strip() for it in val if str(it).strip()]
-                                if items:
-                                    return items
-
-                    # 4) Unknown but valid JSON: return formatted for visibility
-                    logger.warning(f"OpenRouter returned valid JSON but unexpected structure: {str(parsed)[:200]}")
-                    return [json.dumps(parsed, ensure_ascii=False, indent=2)]
-                except Exception as e_json:
-                    logger.warning(f"Could not parse OpenRouter JSON response: {e_json}. Raw text: {str(content)[:250]}")
-                    return [str(content)]
+                return parse_llm_output(content)
             except (json.JSONDecodeError, IndexError) as e:
                 logger.warning(f"Could not parse OpenRouter JSON response: {e}. Raw text: {resp.text[:250]}")
                 return f"[ошибка openrouter: не удалось обработать ответ: {resp.text[:100]}]"
@@ -1375,6 +1187,85 @@ async def send_to_openrouter(
         logger.error(f"Unexpected error in send_to_openrouter: {e}", exc_info=True)
         return "[неизвестная ошибка при обращении к OpenRouter API]"
 
+async def stream_openrouter(
+    api_key: str,
+    system_prompt: str,
+    messages: List[Dict[str, str]],
+    model_name: str,
+    on_part: Callable[[str], Awaitable[None]],
+    image_data: Optional[bytes] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> Union[List[str], str]:
+    """Стриминговый send_to_openrouter (stream: true, SSE с delta.content).
+
+    Ошибки API возвращаются строкой, как в send_to_openrouter: ретраи решает llm_gateway.
+    Пустой/деградированный ответ и обрыв до первого элемента обрабатывает
+    обычный send_to_openrouter (безопасный ретрай).
+    """
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": "https://t.me/your_bot_username",
+        "X-Title": "NunuAi Telegram Bot",
+    }
+    body = llm_payload.openrouter_body(system_prompt, messages, model_name, image_data, temperature, max_tokens, stream=True)
+    parser = ArrayStreamParser()
+    text_chunks: List[str] = []
+    usage_tokens = None
+
+    async def _fallback(reason: str) -> Union[List[str], str]:
+        logger.warning(f"stream_openrouter: {reason}; falling back to non-streaming call")
+        return await send_to_openrouter(
+            api_key=api_key, system_prompt=system_prompt, messages=messages, model_name=model_name,
+            image_data=image_data, temperature=temperature, max_tokens=max_tokens,
+        )
+
+    try:
+        client = llm_clients.get_client(llm_clients.PROVIDER_OPENROUTER)
+        async with client.stream("POST", config.OPENROUTER_API_BASE_URL, content=body, headers=headers) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                key_scheduler.report(api_key, resp.status_code)
+                error_text = f"[ошибка openrouter api {resp.status_code}: {resp.text}]"
+                try:
+                    msg = ((resp.json() or {}).get("error", {}) or {}).get("message") or resp.text
+                    error_text = f"[ошибка openrouter api {resp.status_code}: {msg}]"
+                except Exception:
+                    pass
+                logger.error(error_text)
+                return error_text
+            async for data in _iter_sse_data(resp):
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get("error"):
+                    raise RuntimeError(str(chunk["error"])[:200])
+                if chunk.get("usage"):
+                    # usage приходит последним чанком (с пустым choices)
+                    prompt_layout.record_openrouter_usage(model_name, chunk)
+                    usage_tokens = (chunk.get("usage") or {}).get("total_tokens") or usage_tokens
+                delta = ((chunk.get("choices") or [{}])[0] or {}).get("delta") or {}
+                text = delta.get("content")
+                if not text:
+                    continue
+                text_chunks.append(text)
+                for item in parser.feed(text):
+                    await on_part(item)
+    except Exception as e:
+        if not parser.items:
+            return await _fallback(f"stream failed before first part: {e}")
+        logger.warning(f"stream_openrouter: stream interrupted after {len(parser.items)} parts: {e}")
+        key_scheduler.report(api_key, _STREAM_INTERRUPTED_STATUS, tokens=usage_tokens)
+        return _finish_stream(parser, [])
+
+    key_scheduler.report(api_key, 200, tokens=usage_tokens)
+    content = "".join(text_chunks)
+    if not parser.items and (not content or _is_degenerate_text(content)):
+        return await _fallback("empty or degenerate content")
+    return _finish_stream(parser, [] if parser.completed else parse_llm_output(content))
+
+
 def parse_and_split_messages(text_content: str) -> List[str]:
     """Splits a plain text response from an LLM into a list of messages based on newlines."""
     if not text_content or not text_content.strip():
@@ -1391,6 +1282,107 @@ def parse_and_split_messages(text_content: str) -> List[str]:
     parts = [part.strip() for part in cleaned_text.split('\n') if part.strip()]
     return parts if parts else [cleaned_text]
 
+_LLM_ERROR_STATUS_RE = re.compile(r"^\[ошибка [\w ]+? (\d{3})")
+_NO_GEMINI_KEYS_ERROR = "[ошибка: нет доступных API-ключей Gemini]"
+
+def _classify_llm_result(result: Union[List[str], str]) -> str:
+    """Исход вызова провайдера для llm_gateway: send_to_* возвращают ошибки строками."""
+    if isinstance(result, list):
+        return llm_gateway.OUTCOME_OK
+    text = str(result or "")
+    lowered = text.lower()
+    match = _LLM_ERROR_STATUS_RE.match(text)
+    status = int(match.group(1)) if match else None
+    if status in (429, 503, 529) or "overload" in lowered:
+        return llm_gateway.OUTCOME_OVERLOAD
+    if (status is not None and status >= 500) or "ошибка сети" in lowered or "неизвестная ошибка" in lowered:
+        return llm_gateway.OUTCOME_FAILURE
+    return llm_gateway.OUTCOME_NEUTRAL
+
+def _provider_unavailable(api_label: str) -> str:
+    # Формат как у ошибок провайдера: по '503' вызывающий код узнаёт перегрузку
+    return f"[ошибка {api_label} 503: провайдер перегружен, запрос временно не отправлен]"
+
+async def call_gemini(
+    system_prompt: str,
+    messages: List[Dict[str, str]],
+    image_data: Optional[bytes] = None,
+    on_part: Optional[Callable[[str], Awaitable[None]]] = None,
+    max_retries: Optional[int] = None,
+    persona_id: Optional[int] = None,
+) -> Tuple[Union[List[str], str], Optional[str]]:
+    """Запрос к Gemini через llm_gateway; ключ берётся у key_scheduler на каждую попытку.
+
+    Возвращает (ответ, последний использованный api-ключ или None, если ключей нет).
+    """
+    api_key_used: Optional[str] = None
+
+    async def _attempt() -> Union[List[str], str]:
+        nonlocal api_key_used
+        key_obj = key_scheduler.acquire('gemini')
+        if not key_obj or not key_obj.api_key:
+            return _NO_GEMINI_KEYS_ERROR
+        api_key_used = key_obj.api_key
+        if on_part is not None:
+            # стрим не дублируем: части уже уходят в чат
+            return await stream_google_gemini(api_key_used, system_prompt, messages, on_part, image_data=image_data, persona_id=persona_id)
+        if not config.LLM_HEDGE_ENABLED:
+            return await send_to_google_gemini(api_key_used, system_prompt, messages, image_data=image_data, persona_id=persona_id)
+        primary_key = api_key_used
+
+        def _backup():
+            # дубликат — только на другой ключ и только в пределах его бюджета
+            backup_obj = key_scheduler.acquire('gemini', exclude=primary_key, strict=True)
+            if backup_obj is None:
+                return None
+            return send_to_google_gemini(backup_obj.api_key, system_prompt, messages, image_data=image_data, persona_id=persona_id)
+
+        return await gateway.hedged(
+            lambda: send_to_google_gemini(primary_key, system_prompt, messages, image_data=image_data, persona_id=persona_id),
+            _backup,
+            _classify_llm_result,
+        )
+
+    gateway = llm_gateway.get_gateway(llm_clients.PROVIDER_GEMINI, config.GEMINI_MODEL_NAME_FOR_API)
+    result = await gateway.run(_attempt, _classify_llm_result, rejected=_provider_unavailable("google api"), max_retries=max_retries)
+    return result, api_key_used
+
+def _should_fail_over(result: Union[List[str], str]) -> bool:
+    """Ошибка провайдера, после которой имеет смысл спросить следующего кандидата маршрута.
+
+    Ошибки самого запроса (400, блокировка контента) не переносим: другой провайдер
+    скорее всего ответит так же, а пользователь заплатит дважды.
+    """
+    if result == _NO_GEMINI_KEYS_ERROR:
+        return True
+    return _classify_llm_result(result) in (llm_gateway.OUTCOME_OVERLOAD, llm_gateway.OUTCOME_FAILURE)
+
+async def _call_openrouter_routed(
+    system_prompt: str,
+    messages: List[Dict[str, str]],
+    model_name: str,
+    image_data: Optional[bytes],
+    on_part: Optional[Callable[[str], Awaitable[None]]],
+) -> Union[List[str], str]:
+    """Запрос к OpenRouter через шлюз пары (openrouter, model_name)."""
+    request_kwargs = dict(
+        api_key=config.OPENROUTER_API_KEY,
+        system_prompt=system_prompt,
+        messages=messages,
+        model_name=model_name,
+        image_data=image_data,
+        temperature=(0.3 if image_data else None),
+        max_tokens=(400 if image_data else None),
+    )
+
+    async def _attempt() -> Union[List[str], str]:
+        if on_part is not None:
+            return await stream_openrouter(on_part=on_part, **request_kwargs)
+        return await send_to_openrouter(**request_kwargs)
+
+    gateway = llm_gateway.get_gateway(llm_clients.PROVIDER_OPENROUTER, model_name)
+    return await gateway.run(_attempt, _classify_llm_result, rejected=_provider_unavailable("openrouter api"))
+
 async def get_llm_response(
     db_session: Session,
     owner_user: User,
@@ -1398,58 +1390,71 @@ async def get_llm_response(
     context_for_ai: List[Dict[str, str]],
     image_data: Optional[bytes] = None,
     media_type: Optional[str] = None,
+    on_part: Optional[Callable[[str], Awaitable[None]]] = None,
+    persona_id: Optional[int] = None,
 ) -> Tuple[Union[List[str], str], str, Optional[str]]:
     """
-    Централизованный выбор LLM: OpenRouter для платных пользователей, Gemini для бесплатных.
-    Возвращает (ответ, имя_модели, использованный_api_ключ или None).
+    Централизованный выбор LLM через llm_router: тариф (платный/бесплатный, фото) задаёт
+    упорядоченный список кандидатов, при перегрузке или сбое кандидата запрос уходит следующему.
+    Возвращает (ответ, имя_фактически_ответившей_модели, использованный_api_ключ или None).
+    Если передан on_part (и включён LLM_STREAMING_ENABLED), ответ стримится,
+    и части уходят в on_part по мере генерации.
+    История обрезается под бюджет токенов каждой модели (context_window.fit).
     """
+    streaming = on_part is not None and config.LLM_STREAMING_ENABLED
     attached_owner = db_session.merge(owner_user)
     has_credits = attached_owner.has_credits()
     llm_response: Union[List[str], str] = "[системная ошибка: ответ LLM не был получен]"
     model_to_use = "unknown"
     api_key_to_use = None
 
+    is_image = media_type == 'photo' and bool(image_data)
+    tier = llm_router.tier_for(has_credits, is_image)
+    candidates = llm_router.plan(tier)
+    if not candidates:
+        if has_credits and not config.OPENROUTER_API_KEY:
+            return "[ошибка: ключ OPENROUTER_API_KEY не настроен]", "N/A", None
+        return "[ошибка: нет доступных LLM-провайдеров]", "N/A", None
+
+    parts_sent = 0
+
+    async def _on_part_counted(part: str) -> None:
+        nonlocal parts_sent
+        parts_sent += 1
+        await on_part(part)
+
     try:
-        if has_credits:
-            api_key_to_use = config.OPENROUTER_API_KEY
-            if not api_key_to_use:
-                return "[ошибка: ключ OPENROUTER_API_KEY не настроен]", "N/A", None
-
-            # Для фото используем специальную модель из конфига, для текста — основную.
-            if media_type == 'photo' and image_data:
-                model_to_use = config.OPENROUTER_IMAGE_MODEL_NAME
-                logger.info(f"get_llm_response: user has credits, media is photo. Using OpenRouter image model: '{model_to_use}'.")
-            else:
-                model_to_use = config.OPENROUTER_MODEL_NAME
-            
+        for position, candidate in enumerate(candidates):
+            if position > 0:
+                if parts_sent:
+                    # начало ответа уже в чате — другой моделью его не дописываем
+                    break
+                logger.warning(
+                    f"get_llm_response: {candidates[position - 1].name} failed ({str(llm_response)[:80]}), failing over to {candidate.name}."
+                )
+            model_to_use = candidate.model
+            messages = context_window.fit(context_for_ai, model_to_use, system_prompt, persona_id=persona_id)
             logger.info(
-                f"get_llm_response: user {getattr(attached_owner, 'id', 'N/A')} has credits; using OpenRouter model '{model_to_use}'."
-            )
-            
-            llm_response = await send_to_openrouter(
-                api_key=api_key_to_use,
-                system_prompt=system_prompt,
-                messages=context_for_ai,
-                model_name=model_to_use,
-                image_data=image_data,
-                temperature=(0.3 if (media_type == 'photo' and image_data) else None),
-                max_tokens=(400 if (media_type == 'photo' and image_data) else None),
-            )
-
-        else:
-            # Нет кредитов — используем Gemini
-            model_to_use = config.GEMINI_MODEL_NAME_FOR_API
-            api_key_obj = get_next_api_key(db_session, service='gemini')
-            if not api_key_obj or not api_key_obj.api_key:
-                return "[ошибка: нет доступных API-ключей Gemini]", model_to_use, None
-            api_key_to_use = api_key_obj.api_key
-            logger.info(f"get_llm_response: using Gemini model '{model_to_use}'.")
-            llm_response = await send_to_google_gemini(
-                api_key=api_key_to_use,
-                system_prompt=system_prompt,
-                messages=context_for_ai,
-                image_data=image_data,
+                f"get_llm_response: user {getattr(attached_owner, 'id', 'N/A')} tier '{tier}'; using {candidate.name} "
+                f"with {len(messages)}/{len(context_for_ai)} context messages."
             )
+            if candidate.provider == llm_clients.PROVIDER_OPENROUTER:
+                api_key_to_use = config.OPENROUTER_API_KEY
+                llm_response = await _call_openrouter_routed(
+                    system_prompt, messages, model_to_use, image_data,
+                    _on_part_counted if streaming else None,
+                )
+            else:
+                llm_response, api_key_to_use = await call_gemini(
+                    system_prompt=system_prompt,
+                    messages=messages,
+                    image_data=image_data,
+                    on_part=(_on_part_counted if streaming else None),
+                    persona_id=persona_id,
+                )
+            llm_router.record(tier, candidate, position, ok=isinstance(llm_response, list))
+            if not _should_fail_over(llm_response):
+                break
 
     except Exception as e:
         logger.error(f"[CRITICAL] get_llm_response failed: {e}", exc_info=True)
@@ -1457,8 +1462,136 @@ async def get_llm_response(
 
     return llm_response, model_to_use, api_key_to_use
 
-async def process_and_send_response(update: Update, context: ContextTypes.DEFAULT_TYPE, bot: Bot, chat_id: Union[str, int], persona: Persona, llm_response: Union[List[str], str], db: Session, reply_to_message_id: int, is_first_message: bool = False) -> bool:
-    """Processes the response from AI (list of strings or error string) and sends messages to the chat."""
+def _clean_response_part(part: str) -> str:
+    """Снимает внешние кавычки/квадратные скобки, которые модель иногда оставляет вокруг части."""
+    cleaned_part = str(part).strip()
+    # Снимаем внешние кавычки
+    if len(cleaned_part) >= 2 and cleaned_part.startswith('"') and cleaned_part.endswith('"'):
+        cleaned_part = cleaned_part[1:-1].strip()
+    # Снимаем внешние квадратные скобки
+    if len(cleaned_part) >= 2 and cleaned_part.startswith('[') and cleaned_part.endswith(']'):
+        cleaned_part = cleaned_part[1:-1].strip()
+    # Ещё раз снимем возможные кавычки после скобок
+    if len(cleaned_part) >= 2 and cleaned_part.startswith('"') and cleaned_part.endswith('"'):
+        cleaned_part = cleaned_part[1:-1].strip()
+    return cleaned_part
+
+def _strip_repeated_greeting(first_part: str) -> str:
+    """Убирает приветствие из начала первой части, если это не первое сообщение диалога."""
+    # Паттерн для разных вариантов приветствий
+    greetings_pattern = r"^\s*(?:привет|здравствуй|добр(?:ый|ое|ого)\s+(?:день|утро|вечер)|хай|ку|здорово|салют|о[йи])(?:[,.!?;:]|\b)"
+    match = re.match(greetings_pattern, first_part, re.IGNORECASE)
+    if not match:
+        return first_part
+    # Убираем приветствие и лишние пробелы
+    cleaned_part = first_part[match.end():].lstrip()
+    # Удаляем приветствие, только если после него есть содержимое и исходная фраза была длиннее
+    if cleaned_part and len(first_part) > len(match.group(0)) + 5:
+        logger.info(f"process_and_send_response [JSON]: Removed greeting. New start of part 1: '{cleaned_part[:50]}...'")
+        return cleaned_part
+    # Не удаляем, если ответ целиком — короткое приветствие
+    logger.info("process_and_send_response [JSON]: Greeting is the whole message. Keeping it.")
+    return first_part
+
+async def _send_response_part(bot: Bot, chat_id_str: str, text: str, reply_to_message_id: Optional[int], label: str) -> bool:
+    """Отправляет одну часть ответа: MarkdownV2, при ошибке — простым текстом. True — отправлено."""
+    if len(text) > TELEGRAM_MAX_LEN:
+        logger.warning(f"process_and_send_response [JSON]: Part {label} exceeds max length ({len(text)}). Truncating.")
+        text = text[:TELEGRAM_MAX_LEN - 3] + "..."
+
+    escaped_part_send = escape_markdown_v2(text)
+    logger.info(f"process_and_send_response [JSON]: Attempting send part {label} (MDv2, ReplyTo: {reply_to_message_id}) to {chat_id_str}: '{escaped_part_send[:80]}...')")
+    try:
+        await bot.send_message(
+            chat_id=chat_id_str, text=escaped_part_send, parse_mode=ParseMode.MARKDOWN_V2,
+            reply_to_message_id=reply_to_message_id, read_timeout=30, write_timeout=30
+        )
+        return True
+    except Exception as e_md_send:
+        logger.warning(f"process_and_send_response [JSON]: Failed to send part {label} with MarkdownV2: {e_md_send}. Retrying plain text...")
+        try:
+            # Если причина — не найдено сообщение для ответа, пробуем без reply_to
+            retry_reply_to = None if isinstance(e_md_send, BadRequest) and 'replied not found' in str(e_md_send).lower() else reply_to_message_id
+            await bot.send_message(
+                chat_id=chat_id_str, text=text, parse_mode=None,
+                reply_to_message_id=retry_reply_to, read_timeout=30, write_timeout=30
+            )
+            return True
+        except Exception as e_plain_send:
+            logger.error(f"process_and_send_response [JSON]: Failed plain send part {label}: {e_plain_send}", exc_info=True)
+            return False
+
+def _streaming_part_limit(max_messages_setting_value: Optional[int]) -> int:
+    """Сколько частей можно отправить во время стрима, не зная их итогового числа.
+
+    Совпадает с лимитом process_and_send_response; для «случайного» режима (0) берём
+    его нижнюю границу (2), остальное досылается после завершения ответа.
+    """
+    return {1: 1, 3: 3, 6: 6, 0: 2}.get(max_messages_setting_value, 3)
+
+
+class StreamingPartSender:
+    """on_part для стриминга: отправляет части ответа в чат по мере генерации.
+
+    Применяет к каждой части ту же обработку, что process_and_send_response (очистка,
+    приветствие, фильтр мусора, лимит), поэтому после стрима тот вызывается с
+    already_sent=sent и досылает только оставшееся (и GIF).
+    """
+
+    def __init__(self, bot: Bot, chat_id: Union[str, int], reply_to_message_id: Optional[int], chat_type: Optional[str], max_messages_setting_value: Optional[int], is_first_message: bool = False):
+        self.bot = bot
+        self.chat_id_str = str(chat_id)
+        self.reply_to_message_id = reply_to_message_id
+        self.is_group = chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]
+        self.limit = _streaming_part_limit(max_messages_setting_value)
+        self.is_first_message = is_first_message
+        self.sent = 0
+        self.stopped = False
+        self.first_part_latency: Optional[float] = None
+        self._seen_first_part = False
+        self._started_at = time.monotonic()
+
+    async def __call__(self, raw_part: str) -> None:
+        if self.stopped:
+            return
+        if '\n' in raw_part:
+            # части с переносами process_and_send_response может разбить иначе — дальше без стрима
+            self.stopped = True
+            return
+        part = _clean_response_part(raw_part)
+        if not part:
+            return
+        if not self._seen_first_part:
+            self._seen_first_part = True
+            if not self.is_first_message:
+                part = _strip_repeated_greeting(part)
+        if _is_degenerate_text(part):
+            return
+        if self.sent >= self.limit:
+            self.stopped = True
+            return
+        try:
+            if self.is_group and self.sent > 0:
+                # небольшой таймаут между сообщениями в группах, чтобы не ловить flood control
+                await asyncio.sleep(0.35)
+            reply_to = self.reply_to_message_id if self.sent == 0 else None
+            if not await _send_response_part(self.bot, self.chat_id_str, part, reply_to, f"{self.sent + 1} (stream)"):
+                self.stopped = True
+                return
+        except Exception as e:
+            logger.error(f"StreamingPartSender: failed to send part: {e}", exc_info=True)
+            self.stopped = True
+            return
+        self.sent += 1
+        if self.first_part_latency is None:
+            self.first_part_latency = time.monotonic() - self._started_at
+            logger.info(f"StreamingPartSender: first part sent to {self.chat_id_str} after {self.first_part_latency:.2f}s")
+
+async def process_and_send_response(update: Update, context: ContextTypes.DEFAULT_TYPE, bot: Bot, chat_id: Union[str, int], persona: Persona, llm_response: Union[List[str], str], db: Session, reply_to_message_id: int, is_first_message: bool = False, already_sent: int = 0) -> bool:
+    """Processes the response from AI (list of strings or error string) and sends messages to the chat.
+
+    already_sent — сколько первых текстовых частей уже отправил StreamingPartSender во время стрима.
+    """
     logger.info(f"process_and_send_response [v4]: --- ENTER --- ChatID: {chat_id}, Persona: '{persona.name}'")
 
     text_parts_to_send: List[str] = []
@@ -1491,6 +1624,7 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
         try:
             add_message_to_context(db, persona.chat_instance.id, "assistant", content_to_save_in_db)
             context_response_prepared = True
+            context_summarizer.note_activity(persona.chat_instance.id)
             logger.debug("AI response prepared for database context (pending commit).")
         except SQLAlchemyError as e:
             logger.error(f"DB Error preparing assistant response for context: {e}", exc_info=True)
@@ -1507,16 +1641,7 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
     final_cleaned_parts: List[str] = []
     if text_parts_to_send:
         for part in text_parts_to_send:
-            cleaned_part = part.strip()
-            # Снимаем внешние кавычки
-            if len(cleaned_part) >= 2 and cleaned_part.startswith('"') and cleaned_part.endswith('"'):
-                cleaned_part = cleaned_part[1:-1].strip()
-            # Снимаем внешние квадратные скобки
-            if len(cleaned_part) >= 2 and cleaned_part.startswith('[') and cleaned_part.endswith(']'):
-                cleaned_part = cleaned_part[1:-1].strip()
-            # Ещё раз снимем возможные кавычки после скобок
-            if len(cleaned_part) >= 2 and cleaned_part.startswith('"') and cleaned_part.endswith('"'):
-                cleaned_part = cleaned_part[1:-1].strip()
+            cleaned_part = _clean_response_part(part)
             if cleaned_part:
                 final_cleaned_parts.append(cleaned_part)
     text_parts_to_send = final_cleaned_parts
@@ -1526,20 +1651,7 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
     # --- СТРАХОВКА ОТ ПОВТОРНЫХ ПРИВЕТСТВИЙ ---
     # Если это не первое сообщение в диалоге, и модель вдруг поздоровалась, убираем это.
     if text_parts_to_send and not is_first_message:
-        first_part = text_parts_to_send[0]
-        # Паттерн для разных вариантов приветствий
-        greetings_pattern = r"^\s*(?:привет|здравствуй|добр(?:ый|ое|ого)\s+(?:день|утро|вечер)|хай|ку|здорово|салют|о[йи])(?:[,.!?;:]|\b)"
-        match = re.match(greetings_pattern, first_part, re.IGNORECASE)
-        if match:
-            # Убираем приветствие и лишние пробелы
-            cleaned_part = first_part[match.end():].lstrip()
-            # Удаляем приветствие, только если после него есть содержимое и исходная фраза была длиннее
-            if cleaned_part and len(first_part) > len(match.group(0)) + 5:
-                logger.info(f"process_and_send_response [JSON]: Removed greeting. New start of part 1: '{cleaned_part[:50]}...'")
-                text_parts_to_send[0] = cleaned_part
-            else:
-                # Не удаляем, если ответ целиком — короткое приветствие
-                logger.info("process_and_send_response [JSON]: Greeting is the whole message. Keeping it.")
+        text_parts_to_send[0] = _strip_repeated_greeting(text_parts_to_send[0])
 
     # Фильтрация деградированных ответов (например, 'ext') до применения лимитов
     try:
@@ -1565,7 +1677,7 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
             # если частей мало — отправляем все.
             if len(text_parts_to_send) > 5:
                 try:
-                    target_message_count = random.randint(2, 5)
+                    target_message_count = random.randint(max(2, already_sent), 5)
                 except Exception:
                     target_message_count = 5
             else:
@@ -1580,7 +1692,8 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
         logger.info(f"Финальное количество текстовых частей для отправки: {len(text_parts_to_send)} (настройка: {max_messages_setting_value})")
 
     try:
-        first_message_sent = False
+        # Части, отправленные во время стрима, уже ответили на сообщение пользователя
+        first_message_sent = already_sent > 0
         chat_id_str = str(chat_id)
         # Используем переданный экземпляр бота (он уже соответствует текущему апдейту)
         local_bot = bot
@@ -1609,6 +1722,8 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
 
         if text_parts_to_send:
             for i, part_raw_send in enumerate(text_parts_to_send):
+                if i < already_sent:
+                    continue
                 if not part_raw_send:
                     continue
                 # Санитизация отключена: отправляем ответ модели как есть
@@ -1618,10 +1733,6 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
                     logger.warning(f"process_and_send_response [JSON]: Part {i+1} is empty after preprocessing. Skipping.")
                     continue
 
-                if len(sanitized_part) > TELEGRAM_MAX_LEN:
-                    logger.warning(f"process_and_send_response [JSON]: Part {i+1} exceeds max length ({len(sanitized_part)}). Truncating.")
-                    sanitized_part = sanitized_part[:TELEGRAM_MAX_LEN - 3] + "..."
-
                 if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
                     try:
                         # небольшой таймаут между сообщениями в группах, чтобы не ловить flood control
@@ -1630,29 +1741,10 @@ async def process_and_send_response(update: Update, context: ContextTypes.DEFAUL
                         logger.warning(f"Failed to sleep: {e}")
 
                 current_reply_id_text = reply_to_message_id if not first_message_sent else None
-                escaped_part_send = escape_markdown_v2(sanitized_part)
-                message_sent_successfully = False
-
-                logger.info(f"process_and_send_response [JSON]: Attempting send part {i+1}/{len(text_parts_to_send)} (MDv2, ReplyTo: {current_reply_id_text}) to {chat_id_str}: '{escaped_part_send[:80]}...')")
                 try:
-                    await local_bot.send_message(
-                        chat_id=chat_id_str, text=escaped_part_send, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_to_message_id=current_reply_id_text, read_timeout=30, write_timeout=30
+                    message_sent_successfully = await _send_response_part(
+                        local_bot, chat_id_str, sanitized_part, current_reply_id_text, f"{i+1}/{len(text_parts_to_send)}"
                     )
-                    message_sent_successfully = True
-                except Exception as e_md_send:
-                    logger.warning(f"process_and_send_response [JSON]: Failed to send part {i+1} with MarkdownV2: {e_md_send}. Retrying plain text...")
-                    try:
-                        # Если причина — не найдено сообщение для ответа, пробуем без reply_to
-                        retry_reply_to = None if isinstance(e_md_send, BadRequest) and 'replied not found' in str(e_md_send).lower() else current_reply_id_text
-                        await local_bot.send_message(
-                            chat_id=chat_id_str, text=sanitized_part, parse_mode=None,
-                            reply_to_message_id=retry_reply_to, read_timeout=30, write_timeout=30
-                        )
-                        message_sent_successfully = True
-                    except Exception as e_plain_send:
-                        logger.error(f"process_and_send_response [JSON]: Failed plain send part {i+1}: {e_plain_send}", exc_info=True)
-                        break
                 except Exception as e_other_send:
                     logger.error(f"process_and_send_response [JSON]: Unexpected error sending part {i+1}: {e_other_send}", exc_info=True)
                     break
@@ -1697,14 +1789,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             current_bot = None
 
         # --- Determine if this is a command ---
-        try:
-            entities = update.message.entities or []
-            text_raw = update.message.text or ''
-            is_command = any((e.type == 'bot_command') for e in entities) or text_raw.startswith('/')
-        except Exception:
-            entities = []
-            text_raw = update.message.text or ''
-            is_command = text_raw.startswith('/')
+        # В webhook-режиме признаки уже посчитаны предклассификатором по сырому JSON
+        envelope = current_envelope()
+        if envelope is not None:
+            is_command = envelope.is_command
+        else:
+            try:
+                entities = update.message.entities or []
+                text_raw = update.message.text or ''
+                is_command = any((e.type == 'bot_command') for e in entities) or text_raw.startswith('/')
+            except Exception:
+                text_raw = update.message.text or ''
+                is_command = text_raw.startswith('/')
 
         # --- NEW: Block non-command messages on the main bot ---
         main_bot_id = context.bot_data.get('main_bot_id')
@@ -1795,7 +1891,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 # Теперь получаем контекст (список сообщений) отдельно, используя chat_instance.id
                 initial_context_from_db = get_context_for_chat_bot(db_session, chat_instance.id)
 
-                if persona.config.media_reaction in ["all_media_no_text", "photo_only", "voice_only", "none"]:
+                if persona.config.media_reaction in TEXT_IGNORING_MEDIA_REACTIONS:
                     logger.info(f"handle_message: Persona '{persona.name}' (ID: {persona.id}) is configured with media_reaction='{persona.config.media_reaction}', so it will not respond to this text message. Message will still be added to context if not muted.")
                     if not persona.chat_instance.is_muted:
                         current_user_message_content = f"{username}: {message_text}"
@@ -1859,14 +1955,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         logger.error(f"handle_message: Could not get bot username or id for group check! PersonaID: {getattr(persona, 'id', 'unknown')}")
 
                     persona_name_lower = persona.name.lower()
-                    # 1) Явное упоминание @username
-                    is_mentioned = (f"@{bot_username}".lower() in message_text.lower()) if bot_username else False
-                    # 2) Ответ на сообщение бота (reply)
-                    is_reply_to_bot = (
-                        bool(getattr(update, 'message', None) and getattr(update.message, 'reply_to_message', None)) and
-                        getattr(update.message.reply_to_message, 'from_user', None) is not None and
-                        (getattr(update.message.reply_to_message.from_user, 'id', None) == bot_telegram_id)
-                    )
+                    if envelope is not None:
+                        # 1) Явное упоминание @username и 2) ответ на сообщение бота — из конверта вебхука
+                        is_mentioned = envelope.mentions_username(bot_username)
+                        is_reply_to_bot = envelope.reply_to_bot
+                    else:
+                        # 1) Явное упоминание @username
+                        is_mentioned = (f"@{bot_username}".lower() in message_text.lower()) if bot_username else False
+                        # 2) Ответ на сообщение бота (reply)
+                        is_reply_to_bot = (
+                            bool(getattr(update, 'message', None) and getattr(update.message, 'reply_to_message', None)) and
+                            getattr(update.message.reply_to_message, 'from_user', None) is not None and
+                            (getattr(update.message.reply_to_message.from_user, 'id', None) == bot_telegram_id)
+                        )
                     # 3) Упоминание по имени персоны
                     contains_persona_name = bool(re.search(rf'(?i)\b{re.escape(persona_name_lower)}\b', message_text))
 
@@ -1883,7 +1984,36 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         should_ai_respond = is_mentioned or is_reply_to_bot or contains_persona_name
                     elif reply_pref == "mentioned_or_contextual":
                         should_ai_respond = is_mentioned or is_reply_to_bot or contains_persona_name
+                        prefilter = None
+                        batched_decision = None
                         if not should_ai_respond:
+                            # Решение могло быть уже принято пачкой вместе с предыдущим сообщением окна
+                            batched_decision = group_relevance.cached_decision(chat_id_str, getattr(persona, 'id', None), message_id)
+                            if batched_decision is not None:
+                                should_ai_respond = batched_decision
+                                logger.info(f"handle_message: reusing batched group decision for message {message_id}: {batched_decision}.")
+                                if not should_ai_respond:
+                                    try:
+                                        db_session.commit()
+                                    except Exception as e_commit_batch:
+                                        logger.warning(f"handle_message: commit after batched skip failed: {e_commit_batch}")
+                        if not should_ai_respond and batched_decision is None and config.GROUP_PREFILTER_ENABLED:
+                            # Дешёвый локальный скор: уверенные «да» и «нет» решаются без LLM
+                            prefilter = group_relevance.score_message(message_text, persona.name, initial_context_from_db)
+                            if prefilter.verdict is not None:
+                                should_ai_respond = prefilter.verdict
+                                group_relevance.log_decision(chat_id_str, getattr(persona, 'id', None), prefilter)
+                                logger.info(
+                                    f"handle_message: group prefilter decided {'respond' if prefilter.verdict else 'skip'} "
+                                    f"without LLM (score={prefilter.score}, signals={list(prefilter.signals)})."
+                                )
+                                if not should_ai_respond:
+                                    # как и перед LLM-проверкой: сообщение пользователя остаётся в контексте
+                                    try:
+                                        db_session.commit()
+                                    except Exception as e_commit_pf:
+                                        logger.warning(f"handle_message: commit after prefilter skip failed: {e_commit_pf}")
+                        if not should_ai_respond and batched_decision is None and (prefilter is None or prefilter.verdict is None):
                             # --- КОНТЕКСТУАЛЬНАЯ ПРОВЕРКА ЧЕРЕЗ LLM (С ПРЕДВАРИТЕЛЬНЫМ ЗАКРЫТИЕМ СЕССИИ) ---
                             logger.info("handle_message: No direct mention. Performing contextual LLM check...")
                             # Кэшируем ID персоны до закрытия сессии, чтобы избежать DetachedInstanceError
@@ -1900,6 +2030,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             except Exception as e_commit_ctx:
                                 logger.warning(f"handle_message: commit/close before contextual AI call failed: {e_commit_ctx}")
 
+                            # Сообщения чата, пришедшие в течение окна, проверяем одним вызовом
+                            decision_batch = await group_relevance.collect_window(chat_id_str, message_id, message_text)
+
                             # Формируем промпт в НОВОЙ короткой сессии на основе заново загруженной персоны
                             ctx_prompt = None
                             if not persona_id_cache:
@@ -1910,61 +2043,66 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                                         persona_for_prompt = prompt_db.query(DBPersonaConfig).filter(DBPersonaConfig.id == persona_id_cache).first()
                                         if persona_for_prompt:
                                             persona_obj_for_prompt = Persona(persona_for_prompt)
-                                            ctx_prompt = persona_obj_for_prompt.format_should_respond_prompt(
-                                                message_text=message_text,
-                                                bot_username=bot_username,
-                                                history=initial_context_from_db
-                                            )
+                                            if len(decision_batch) == 1:
+                                                ctx_prompt = persona_obj_for_prompt.format_should_respond_prompt(
+                                                    message_text=message_text,
+                                                    bot_username=bot_username,
+                                                    history=initial_context_from_db
+                                                )
+                                            else:
+                                                ctx_prompt = persona_obj_for_prompt.format_batch_should_respond_prompt(
+                                                    numbered_messages=group_relevance.format_batch(decision_batch),
+                                                    bot_username=bot_username,
+                                                    history=initial_context_from_db
+                                                )
                                         else:
                                             logger.error(f"Could not re-fetch persona by id={persona_id_cache} for contextual prompt generation.")
                                 except Exception as fmt_err:
                                     logger.error(f"Failed to format contextual should_respond prompt: {fmt_err}", exc_info=True)
 
-                            api_key_for_check = None
+                            # Долгий вызов LLM выполняем ВНЕ активной транзакции основной сессии.
+                            # Ключ, лимит параллельности и ретрай при перегрузке — в call_gemini (llm_gateway)
                             if ctx_prompt:
-                                # 1) Получаем ключ в ОТДЕЛЬНОЙ короткой сессии
                                 try:
-                                    with get_db() as _db_check:
-                                        key_obj_check = get_next_api_key(_db_check, service='gemini')
-                                        if key_obj_check and getattr(key_obj_check, 'api_key', None):
-                                            api_key_for_check = key_obj_check.api_key
-                                        _db_check.commit()
-                                except Exception as key_err:
-                                    logger.error(f"Contextual check: failed to fetch API key: {key_err}", exc_info=True)
-
-                            # 2) Долгий вызов LLM выполняем ВНЕ активной транзакции основной сессии
-                            if api_key_for_check and ctx_prompt:
-                                try:
-                                    llm_decision = await send_to_google_gemini(
-                                        api_key=api_key_for_check,
-                                        system_prompt="You decide if the bot should respond based on relevance. Answer only with 'Да' or 'Нет'.",
-                                        messages=[{"role": "user", "content": ctx_prompt}]
-                                    )
-                                    # Повторная попытка при перегрузке модели Gemini
-                                    if isinstance(llm_decision, str) and ("503" in llm_decision or "overload" in llm_decision.lower()):
-                                        logger.warning("Contextual LLM check: Gemini overloaded (503). Retrying once...")
-                                        await asyncio.sleep(1.5)
-                                        llm_decision = await send_to_google_gemini(
-                                            api_key=api_key_for_check,
-                                            system_prompt="You decide if the bot should respond based on relevance. Answer only with 'Да' or 'Нет'.",
-                                            messages=[{"role": "user", "content": ctx_prompt}]
+                                    if len(decision_batch) == 1:
+                                        decision_system_prompt = "You decide if the bot should respond based on relevance. Answer only with 'Да' or 'Нет'."
+                                    else:
+                                        decision_system_prompt = (
+                                            "You decide which of several numbered group messages the bot should respond to. "
+                                            "Answer only with the number of that single message, or 'Нет' if none of them needs a reply."
                                         )
+                                    llm_decision, _ = await call_gemini(
+                                        system_prompt=decision_system_prompt,
+                                        messages=[{"role": "user", "content": ctx_prompt}],
+                                        max_retries=1,
+                                    )
                                     if isinstance(llm_decision, list) and llm_decision:
                                         ans = str(llm_decision[0]).strip().lower()
                                     else:
                                         ans = str(llm_decision or "").strip().lower()
-                                    if "да" in ans:
+                                    if len(decision_batch) > 1:
+                                        chosen_id = group_relevance.parse_batch_answer(ans, decision_batch)
+                                        group_relevance.store_batch_decision(
+                                            chat_id_str, persona_id_cache,
+                                            [mid for mid, _ in decision_batch if mid != message_id], chosen_id,
+                                        )
+                                        should_ai_respond = chosen_id == message_id
+                                        logger.info(
+                                            f"LLM batched contextual check over {len(decision_batch)} messages chose {chosen_id} "
+                                            f"(answer: {ans}); current message {message_id} -> {should_ai_respond}."
+                                        )
+                                    elif "да" in ans:
                                         should_ai_respond = True
                                         logger.info(f"LLM contextual check PASSED (answer: {ans}).")
                                     else:
                                         logger.info(f"LLM contextual check FAILED (answer: {ans}).")
+                                    if prefilter is not None:
+                                        group_relevance.log_decision(chat_id_str, persona_id_cache, prefilter, llm_answer=ans)
                                 except Exception as llm_err:
                                     logger.error(f"Contextual LLM check failed: {llm_err}", exc_info=True)
                                     # по ошибке проверки — оставляем решение 'не отвечать'
-                            elif ctx_prompt is None:
-                                logger.warning("Contextual prompt not generated; skipping LLM check.")
                             else:
-                                logger.warning("No API key available for contextual check; skipping LLM check.")
+                                logger.warning("Contextual prompt not generated; skipping LLM check.")
 
                     if not should_ai_respond:
                         logger.info(f"handle_message: Final decision - NOT responding in group '{getattr(update.effective_chat, 'title', '')}'.")
@@ -1978,8 +2116,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     except Exception as commit_err:
                         logger.error(f"handle_message: Commit failed before AI call (group decision=respond): {commit_err}", exc_info=True)
 
-                    # Вызываем format_system_prompt БЕЗ текста сообщения, с учетом типа чата
-                    system_prompt = persona.format_system_prompt(user_id, username, getattr(update.effective_chat, 'type', None))
+                    # Промпт БЕЗ текста сообщения, с учетом типа чата; данные хода (пользователь, время)
+                    # идут не в системный промпт, а после истории — см. prompt_layout
+                    layout = persona.build_prompt_layout(user_id, username, getattr(update.effective_chat, 'type', None))
+                    system_prompt = layout.system if layout else None
                     if not system_prompt:
                         await update.message.reply_text(escape_markdown_v2("❌ ошибка при подготовке системного сообщения."), parse_mode=ParseMode.MARKDOWN_V2)
                         db_session.rollback()
@@ -1989,14 +2129,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     # ВАЖНО: очищаем историю от лишних полей (например, timestamp), чтобы избежать ошибок сериализации JSON.
                     try:
                         context_for_ai = [
-                            {"role": msg.get("role"), "content": msg.get("content")}
+                            {"role": msg.get("role"), "content": msg.get("content"), "token_count": msg.get("token_count"), "pinned": bool(msg.get("pinned"))}
                             for msg in (initial_context_from_db or [])
                             if isinstance(msg, dict) and msg.get("role") and msg.get("content") is not None
                         ]
                     except Exception:
                         # Фолбэк: если история неожиданного формата, игнорируем её
                         context_for_ai = []
-                    context_for_ai.append({"role": "user", "content": f"{username}: {message_text}"})
+                    # токены сообщения считаем один раз: для бюджета контекста и для списания кредитов
+                    message_tokens = count_openai_compatible_tokens(message_text)
+                    context_for_ai.append({
+                        "role": "user",
+                        "content": prompt_layout.append_turn_context(f"{username}: {message_text}", layout.turn_context),
+                        "token_count": message_tokens + count_openai_compatible_tokens(f"{username}: \n\n{layout.turn_context}"),
+                    })
+                    persona_id_for_llm = getattr(persona, 'id', None)
+                    # Части ответа отправляются по мере стрима; настройку лимита читаем, пока сессия открыта
+                    stream_sender = StreamingPartSender(
+                        current_bot,
+                        chat_id_str,
+                        reply_to_message_id=message_id,
+                        chat_type=getattr(update.effective_chat, 'type', None),
+                        max_messages_setting_value=(persona.config.max_response_messages if persona.config else None),
+                        is_first_message=(len(initial_context_from_db) == 0),
+                    )
                     # --- Закрываем транзакцию/сессию перед долгим IO (AI) ---
                     try:
                         db_session.commit()
@@ -2023,6 +2179,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             owner_user=owner_user_for_llm,
                             system_prompt=system_prompt,
                             context_for_ai=context_for_ai,
+                            on_part=stream_sender,
+                            persona_id=persona_id_for_llm,
                         )
 
                     context_response_prepared = False
@@ -2048,7 +2206,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                                         assistant_response_text,  # список строк
                                         db_after_ai,
                                         reply_to_message_id=message_id,
-                                        is_first_message=(len(initial_context_from_db) == 0)
+                                        is_first_message=(len(initial_context_from_db) == 0),
+                                        already_sent=stream_sender.sent,
                                     )
                                     if context_response_prepared:
                                         # ВАЖНО: присоединяем пользователя к текущей сессии, чтобы избежать DetachedInstanceError
@@ -2063,6 +2222,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                                             input_text=message_text,
                                             output_text="\n".join(assistant_response_text),
                                             model_name=model_used,
+                                            input_tokens=message_tokens,
                                             media_type=None,
                                             main_bot=context.application.bot
                                         )
@@ -2185,8 +2345,14 @@ async def deduct_credits_for_interaction(
     media_type: Optional[str] = None,
     media_duration_sec: Optional[int] = None,
     main_bot=None,
+    input_tokens: Optional[int] = None,
+    output_tokens: Optional[int] = None,
 ) -> None:
-    """Рассчитывает и списывает кредиты за одно взаимодействие (текст/фото/голос)."""
+    """Рассчитывает и списывает кредиты за одно взаимодействие (текст/фото/голос).
+
+    input_tokens/output_tokens — уже посчитанные токены (например, при сборке контекста);
+    если не переданы, текст токенизируется здесь.
+    """
     try:
         from config import CREDIT_COSTS, MODEL_PRICE_MULTIPLIERS, GEMINI_MODEL_NAME_FOR_API, LOW_BALANCE_WARNING_THRESHOLD, FREE_IMAGE_RESPONSES
     
@@ -2211,14 +2377,16 @@ async def deduct_credits_for_interaction(
             total_cost += CREDIT_COSTS.get("audio_per_minute", 0.0) * minutes
 
         # 2) Стоимость токенов
-        try:
-            input_tokens = count_openai_compatible_tokens(input_text or "", effective_model)
-        except Exception:
-            input_tokens = 0
-        try:
-            output_tokens = count_openai_compatible_tokens(output_text or "", effective_model)
-        except Exception:
-            output_tokens = 0
+        if input_tokens is None:
+            try:
+                input_tokens = count_openai_compatible_tokens(input_text or "", effective_model)
+            except Exception:
+                input_tokens = 0
+        if output_tokens is None:
+            try:
+                output_tokens = count_openai_compatible_tokens(output_text or "", effective_model)
+            except Exception:
+                output_tokens = 0
 
         tokens_cost = (
             (input_tokens / 1000.0) * CREDIT_COSTS.get("input_tokens_per_1k", 0.0) +
@@ -2232,25 +2400,26 @@ async def deduct_credits_for_interaction(
             final_cost = 0.0
         else:
             final_cost = round(total_cost * mult, 6)
-        prev_credits = float(getattr(owner_user, 'credits', 0.0) or 0.0)
+        # Списание атомарным UPDATE по текущему значению в БД: объект owner_user загружен
+        # до отправки ответа, и его баланс мог устареть (пополнение, параллельный чат)
+        new_balance = debit_credits(db, owner_user, final_cost) if final_cost > 0 else None
+        prev_credits = new_balance + final_cost if new_balance is not None else float(getattr(owner_user, 'credits', 0.0) or 0.0)
 
-        if prev_credits >= final_cost and final_cost > 0:
-            owner_user.credits = round(prev_credits - final_cost, 6)
-            db.add(owner_user)
+        if new_balance is not None:
             logger.info(
-                f"кредиты списаны (тип: {media_type or 'text'}): пользователь {owner_user.id}, стоимость={final_cost}, новый баланс={owner_user.credits}"
+                f"кредиты списаны (тип: {media_type or 'text'}): пользователь {owner_user.id}, стоимость={final_cost}, новый баланс={new_balance}"
             )
 
             # Предупреждение о низком балансе
             try:
                 if (
-                    owner_user.credits < LOW_BALANCE_WARNING_THRESHOLD and
+                    new_balance < LOW_BALANCE_WARNING_THRESHOLD and
                     prev_credits >= LOW_BALANCE_WARNING_THRESHOLD and
                     main_bot
                 ):
                     warning_text = (
                         f"⚠️ предупреждение: на вашем балансе осталось меньше {LOW_BALANCE_WARNING_THRESHOLD:.0f} кредитов!\n"
-                        f"текущий баланс: {owner_user.credits:.2f} кр.\n\n"
+                        f"текущий баланс: {new_balance:.2f} кр.\n\n"
                         f"пополните баланс командой /buycredits"
                     )
                     await main_bot.send_message(chat_id=owner_user.telegram_id, text=warning_text, parse_mode=None)
@@ -2304,11 +2473,12 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media
                 try:
                     photo_sizes = update.message.photo
                     if photo_sizes:
-                        photo_file = photo_sizes[-1]
-                        file = await current_bot.get_file(photo_file.file_id)
-                        image_data_io = await file.download_as_bytearray()
-                        image_data = bytes(image_data_io)
-                        logger.info(f"Downloaded image: {len(image_data)} bytes")
+                        # размер под цель моделей маршрута (фото уходит в тариф paid_image или free)
+                        image_tier = llm_router.tier_for(owner_user.has_credits(), is_image=True)
+                        image_data = await media_preprocess.prepare_photo(
+                            current_bot, photo_sizes, media_preprocess.target_for(llm_router.route_models(image_tier)),
+                        )
+                        logger.info(f"Prepared image: {len(image_data or b'')} bytes")
                         if caption:
                             user_message_content = f"{username}: {caption}"
                         else:
@@ -2329,7 +2499,7 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media
                         audio_data = bytes(voice_bytes)
                         transcribed_text = None
                         if vosk_model is None:
-                            load_vosk_model(VOSK_MODEL_PATH)
+                            await asyncio.to_thread(load_vosk_model, VOSK_MODEL_PATH)
                         
                         if vosk_model:
                             transcribed_text = await transcribe_audio_with_vosk(audio_data, update.message.voice.mime_type)
@@ -2418,26 +2588,9 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media
                     context_for_ai=context_for_ai,
                     image_data=image_data,
                     media_type=media_type,
+                    persona_id=persona_id_cache,
                 )
-            # Повторная попытка при перегрузке (503) только для Gemini
-            if (
-                isinstance(ai_response_text, str)
-                and ai_response_text.startswith("[ошибка google api")
-                and ("503" in ai_response_text or "overload" in ai_response_text.lower())
-                and model_used == config.GEMINI_MODEL_NAME_FOR_API
-                and api_key_used
-            ):
-                for attempt in range(1, 3):
-                    backoff = 1.0 * attempt + random.uniform(0.2, 0.8)
-                    logger.warning(f"Google API overloaded (media). Retry {attempt}/2 after {backoff:.2f}s...")
-                    await asyncio.sleep(backoff)
-                    ai_response_text = await send_to_google_gemini(api_key=api_key_used, system_prompt=system_prompt, messages=context_for_ai, image_data=image_data)
-                    if not (
-                        isinstance(ai_response_text, str)
-                        and ai_response_text.startswith("[ошибка google api")
-                        and ("503" in ai_response_text or "overload" in ai_response_text.lower())
-                    ):
-                        break
+            # Ретраи при перегрузке (503) выполняет llm_gateway внутри get_llm_response
 
             if ai_response_text is None:
                 ai_response_text = "[ошибка: ключ GEMINI_API_KEY не установлен]"
@@ -3314,6 +3467,7 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             stmt = delete(ChatContext).where(ChatContext.chat_bot_instance_id == chat_bot_instance_id)
             result = db.execute(stmt)
             deleted_count = result.rowcount
+            db.execute(delete(ChatSummary).where(ChatSummary.chat_bot_instance_id == chat_bot_instance_id))
             db.commit()
 
             logger.info(
@@ -3723,7 +3877,7 @@ async def bind_bot_token_received(update: Update, context: ContextTypes.DEFAULT_
                 # Пытаемся установить webhook для нового бота
                 try:
                     webhook_url = f"{config.WEBHOOK_URL_BASE}/telegram/{token}"
-                    temp_bot = Bot(token=token)
+                    temp_bot = await bot_registry.get(token)
                     secret = str(uuid.uuid4())
                     await temp_bot.set_webhook(
                         url=webhook_url,
@@ -3740,6 +3894,7 @@ async def bind_bot_token_received(update: Update, context: ContextTypes.DEFAULT_
                         if hasattr(instance, 'status'):
                             instance.status = 'active'
                         db.commit()
+                        invalidate_bot_route(token=token, bot_instance_id=instance.id)
                     except Exception as e_db_commit:
                         logger.error(f"bind_bot_token_received: failed to commit webhook secret/timestamp/status: {e_db_commit}", exc_info=True)
                         db.rollback()
@@ -3769,6 +3924,7 @@ async def bind_bot_token_received(update: Update, context: ContextTypes.DEFAULT_
                         if hasattr(instance, 'status'):
                             instance.status = 'webhook_error'
                         db.commit()
+                        invalidate_bot_route(token=token, bot_instance_id=instance.id)
                     except Exception:
                         db.rollback()
                     await update.message.reply_text(
@@ -3877,6 +4033,7 @@ async def add_bot_to_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, pe
                     stmt = delete(ChatContext).where(ChatContext.chat_bot_instance_id == existing_active_link.id)
                     delete_result = db.execute(stmt)
                     deleted_ctx = delete_result.rowcount # Получаем количество удаленных строк
+                    db.execute(delete(ChatSummary).where(ChatSummary.chat_bot_instance_id == existing_active_link.id))
                     db.commit()
                     logger.debug(f"Cleared {deleted_ctx} context messages for re-added ChatBotInstance {existing_active_link.id}.")
                     return
@@ -4219,6 +4376,26 @@ async def buycredits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await context.bot.send_message(chat_id, text_md, reply_markup=InlineKeyboardMarkup(keyboard_rows), parse_mode=ParseMode.MARKDOWN_V2)
 
 
+_yookassa_configured = False
+
+def ensure_yookassa_configured() -> bool:
+    """Импортирует SDK YooKassa и один раз настраивает магазин. True, если SDK готов к созданию платежей."""
+    global _yookassa_configured
+    if _yookassa_configured:
+        return True
+    if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY and YOOKASSA_SHOP_ID.isdigit()):
+        logger.warning("YOOKASSA_SHOP_ID or YOOKASSA_SECRET_KEY invalid/missing.")
+        return False
+    try:
+        from yookassa import Configuration as YookassaConfig
+        YookassaConfig.configure(account_id=int(YOOKASSA_SHOP_ID), secret_key=YOOKASSA_SECRET_KEY)
+        _yookassa_configured = True
+        logger.info(f"Yookassa SDK configured (Shop ID: {YOOKASSA_SHOP_ID}).")
+    except Exception as e:
+        logger.error(f"Failed to configure Yookassa SDK: {e}")
+    return _yookassa_configured
+
+
 async def buycredits_pkg_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Создает платеж YooKassa для выбранного кредитного пакета."""
     query = update.callback_query
@@ -4245,9 +4422,13 @@ async def buycredits_pkg_callback(update: Update, context: ContextTypes.DEFAULT_
     bot_username = context.bot_data.get('bot_username', 'NunuAiBot')
     return_url = f"https://t.me/{bot_username}"
 
-    if not (YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY and YOOKASSA_SHOP_ID.isdigit()):
+    # первый вызов импортирует SDK — вне event loop
+    if not await asyncio.to_thread(ensure_yookassa_configured):
         await query.edit_message_text("❌ платежи недоступны", parse_mode=None)
         return
+    from yookassa import Payment
+    from yookassa.domain.request.payment_request_builder import PaymentRequestBuilder
+    from yookassa.domain.models.receipt import Receipt, ReceiptItem
 
     idempotence_key = str(uuid.uuid4())
     description = f"Покупка кредитов для @{bot_username}: {int(credits)} кр. (User ID: {user_id})"
@@ -4671,8 +4852,7 @@ async def proactive_chat_select_prompt(update: Update, context: ContextTypes.DEF
         target_bot = None
         try:
             if bot_inst and bot_inst.bot_token:
-                target_bot = Bot(token=bot_inst.bot_token)
-                await target_bot.initialize()
+                target_bot = await bot_registry.get(bot_inst.bot_token)
         except Exception as e_bot_init:
             logger.warning(f"Failed to init target bot for chat titles: {e_bot_init}")
 
@@ -4756,19 +4936,11 @@ async def proactive_chat_select_received(update: Update, context: ContextTypes.D
                 delay_sec = random.uniform(0.8, 2.5)
                 logger.info(f"Polite delay before AI request (proactive): {delay_sec:.2f}s")
                 await asyncio.sleep(delay_sec)
-                api_key_obj = get_next_api_key(db, service='gemini')
-                if not api_key_obj:
-                    logger.error("No active Gemini API keys available in DB (proactive). Skipping.")
+                # одна дополнительная попытка для проактивных (в рамках бюджета ретраев llm_gateway)
+                assistant_response_text, api_key_used = await call_gemini(system_prompt=system_prompt or "", messages=messages, max_retries=1)
+                if not api_key_used:
+                    logger.error("Gemini request not sent (no active API keys or provider unavailable) for proactive message. Skipping.")
                     return
-                assistant_response_text = await send_to_google_gemini(api_key=api_key_obj.api_key, system_prompt=system_prompt or "", messages=messages)
-                if assistant_response_text and str(assistant_response_text).startswith("[ошибка google api") and ("503" in assistant_response_text or "overload" in assistant_response_text.lower()):
-                    for attempt in range(1, 2):  # одна дополнительная попытка для проактивных
-                        backoff = 1.0 * attempt + random.uniform(0.2, 0.8)
-                        logger.warning(f"Google API overloaded (proactive). Retry {attempt}/1 after {backoff:.2f}s...")
-                        await asyncio.sleep(backoff)
-                        assistant_response_text = await send_to_google_gemini(api_key=api_key_obj.api_key, system_prompt=system_prompt or "", messages=messages)
-                        if not (assistant_response_text and str(assistant_response_text).startswith("[ошибка google api") and ("503" in assistant_response_text or "overload" in assistant_response_text.lower())):
-                            break
                 
                 # Списываем кредиты у владельца
                 try:
@@ -4784,8 +4956,7 @@ async def proactive_chat_select_received(update: Update, context: ContextTypes.D
                     # Инициализируем нужного бота
                     if not bot_inst or not bot_inst.bot_token:
                         raise ValueError("нет токена бота для отправки")
-                    target_bot_for_send = Bot(token=bot_inst.bot_token)
-                    await target_bot_for_send.initialize()
+                    target_bot_for_send = await bot_registry.get(bot_inst.bot_token)
 
                     # Легковесный контекст, содержащий только bot
                     class _BotOnlyContext:
@@ -5364,6 +5535,8 @@ async def edit_media_reaction_received(update: Update, context: ContextTypes.DEF
                 live_persona = db.merge(persona_from_cache)
                 live_persona.media_reaction = new_value
                 db.commit()
+                if live_persona.bot_instance:
+                    invalidate_bot_route(bot_instance_id=live_persona.bot_instance.id)
                 db.refresh(live_persona)
                 context.user_data['persona_object'] = live_persona
                 logger.info(f"Set media_reaction to {new_value} for persona {live_persona.id}")
@@ -5516,6 +5689,7 @@ async def clear_persona_context_from_wizard(update: Update, context: ContextType
                 links_count = len(links)
                 for link in links:
                     deleted = db.query(ChatContext).filter(ChatContext.chat_bot_instance_id == link.id).delete(synchronize_session=False)
+                    db.query(ChatSummary).filter(ChatSummary.chat_bot_instance_id == link.id).delete(synchronize_session=False)
                     total_deleted += int(deleted or 0)
                 db.commit()
                 logger.info(f"Cleared {total_deleted} context messages for persona {persona.id} across {links_count} chats")
@@ -6421,6 +6595,7 @@ async def mute_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if not chat_instance.is_muted:
                 chat_instance.is_muted = True
                 db.commit()
+                invalidate_bot_route(bot_instance_id=chat_instance.bot_instance_id)
                 logger.info(f"Persona '{persona.name}' muted in chat {chat_id_str} by user {user_id}.")
                 final_success_msg = success_muted_fmt_raw.format(name=persona_name_escaped)
                 await update.message.reply_text(final_success_msg, reply_markup=ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN_V2)
@@ -6474,6 +6649,7 @@ async def unmute_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             if active_instance.is_muted:
                 active_instance.is_muted = False
                 db.commit()
+                invalidate_bot_route(bot_instance_id=active_instance.bot_instance_id)
                 logger.info(f"Persona '{persona_name}' unmuted in chat {chat_id_str} by user {user_id}.")
                 final_success_msg = success_unmuted_fmt_raw.format(name=persona_name_escaped)
                 await update.message.reply_text(final_success_msg, reply_markup=ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN_V2)
@@ -6530,6 +6706,7 @@ async def mutebot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             link.is_muted = True
             db_session.commit()
+            invalidate_bot_route(bot_instance_id=link.bot_instance_id)
             logger.info(f"mutebot: set is_muted=True for ChatBotInstance id={link.id} chat={chat_id_str} bot_id={current_bot_id_str}")
             await update.message.reply_text("бот заглушен в этом чате")
         except Exception as e:
@@ -6563,6 +6740,7 @@ async def unmutebot(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             link.is_muted = False
             db_session.commit()
+            invalidate_bot_route(bot_instance_id=link.bot_instance_id)
             logger.info(f"unmutebot: set is_muted=False for ChatBotInstance id={link.id} chat={chat_id_str} bot_id={current_bot_id_str}")
             await update.message.reply_text("бот размьючен в этом чате")
         except Exception as e:
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка доступа к служебным HTTP-эндпоинтам (/metrics, /workers).
+
+Они живут на том же публичном порту, что и вебхуки, поэтому без METRICS_TOKEN
+отдаём 403. Токен передаётся заголовком X-Metrics-Token или параметром ?token=.
+"""
+
+import hmac
+from urllib.parse import parse_qs
+
+import config
+
+
+def _presented_token(scope) -> str | None:
+    for key, value in scope.get('headers') or []:
+        if key.lower() == b'x-metrics-token':
+            return value.decode('latin-1')
+    query = (scope.get('query_string') or b'').decode('latin-1')
+    if query:
+        values = parse_qs(query).get('token')
+        if values:
+            return values[0]
+    return None
+
+
+def metrics_authorized(scope) -> bool:
+    """True, если запрос предъявил METRICS_TOKEN. Пустой METRICS_TOKEN закрывает эндпоинты полностью."""
+    expected = config.METRICS_TOKEN
+    if not expected:
+        return False
+    presented = _presented_token(scope)
+    if presented is None:
+        return False
+    return hmac.compare_digest(presented.encode(), expected.encode())
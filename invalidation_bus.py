@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Шина инвалидации кешей между репликами/воркерами через Postgres LISTEN/NOTIFY.
+
+Локальные кеши (профиль, персоны, маршруты вебхуков, optimization.cache_manager)
+живут в памяти процесса. Когда процессов несколько, запись в одном из них должна
+сбрасывать кеш во всех остальных, иначе TTL (5-10 минут) показывает устаревшее.
+
+- publish(event, **fields) сразу точечно чистит локальные кеши и ставит событие
+  в очередь; фоновая задача отправляет очередь пачкой через pg_notify.
+- listen_forever() слушает канал и применяет чужие события (свои отфильтрованы
+  по NODE_ID). После обрыва соединения сбрасывает все кеши целиком — события за
+  время разрыва могли потеряться.
+
+События описываются id, без токенов и прочих секретов.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+import uuid
+from typing import Any, Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+EVENT_PERSONA_CHANGED = "persona_changed"   # persona_id, owner_telegram_id, bot_instance_id
+EVENT_CREDITS_CHANGED = "credits_changed"   # telegram_user_id
+EVENT_BOT_CHANGED = "bot_changed"           # bot_instance_id, chat_id
+
+# Уникальный id процесса: свои уведомления, вернувшиеся из LISTEN, пропускаем
+NODE_ID = uuid.uuid4().hex[:12]
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_queue: Optional[asyncio.Queue] = None
+
+# Метрики
+stats_counters: Dict[str, int] = {
+    "published": 0,
+    "sent": 0,
+    "send_errors": 0,
+    "received": 0,
+    "applied": 0,
+    "reconnects": 0,
+}
+
+
+def _listen_dsn() -> Optional[str]:
+    # psycopg не понимает SQLAlchemy-схему postgresql+psycopg://
+    url = config.DATABASE_URL
+    if not url or not url.startswith(("postgres://", "postgresql")):
+        return None
+    return url.replace("postgresql+psycopg://", "postgresql://", 1)
+
+
+def _handlers_caches():
+    # handlers импортирует db, db публикует события -> берём модуль из sys.modules без импорта
+    return sys.modules.get("handlers")
+
+
+def _evict_credits(fields: Dict[str, Any]) -> None:
+    tg_id = fields.get("telegram_user_id")
+    if tg_id is None:
+        return
+    handlers = _handlers_caches()
+    if handlers is not None:
+        handlers.profile_cache.invalidate(f"profile:{tg_id}")
+    cache_manager = sys.modules.get("optimization.cache_manager")
+    if cache_manager is not None:
+        cache_manager.cache.delete(f"user:{tg_id}")
+
+
+def _evict_persona(fields: Dict[str, Any]) -> None:
+    persona_id = fields.get("persona_id")
+    owner_tg_id = fields.get("owner_telegram_id")
+    handlers = _handlers_caches()
+    cache_manager = sys.modules.get("optimization.cache_manager")
+    if persona_id is not None:
+        if handlers is not None:
+            handlers.persona_cache.invalidate(f"persona:{persona_id}")
+        if cache_manager is not None:
+            cache_manager.cache.delete(f"persona:{persona_id}")
+        gemini_cache = sys.modules.get("gemini_cache")
+        if gemini_cache is not None:
+            # системный промпт персоны изменился — её cachedContents у Gemini больше не нужны
+            gemini_cache.invalidate_persona(persona_id)
+    if owner_tg_id is not None:
+        # число персон и меню в профиле владельца
+        if handlers is not None:
+            handlers.profile_cache.invalidate(f"profile:{owner_tg_id}")
+        if cache_manager is not None:
+            cache_manager.cache.clear_pattern(f"personas:{owner_tg_id}")
+            cache_manager.cache.clear_pattern(f"menu:{owner_tg_id}")
+    if fields.get("bot_instance_id") is not None:
+        _evict_bot(fields)
+
+
+def _evict_bot(fields: Dict[str, Any]) -> None:
+    bot_instance_id = fields.get("bot_instance_id")
+    bot_routing = sys.modules.get("bot_routing")
+    if bot_routing is not None and bot_instance_id is not None:
+        bot_routing.invalidate(bot_instance_id=bot_instance_id)
+    cache_manager = sys.modules.get("optimization.cache_manager")
+    if cache_manager is not None:
+        chat_id = fields.get("chat_id")
+        if chat_id is not None:
+            cache_manager.cache.clear_pattern(f"active_bot:{chat_id}:")
+        if bot_instance_id is not None:
+            cache_manager.cache.delete_matching(prefix="access:", suffix=f":{bot_instance_id}")
+
+
+_EVICTORS = {
+    EVENT_PERSONA_CHANGED: _evict_persona,
+    EVENT_CREDITS_CHANGED: _evict_credits,
+    EVENT_BOT_CHANGED: _evict_bot,
+}
+
+
+def apply_local(event: str, fields: Dict[str, Any]) -> None:
+    """Точечно сбрасывает локальные кеши по событию."""
+    evictor = _EVICTORS.get(event)
+    if evictor is None:
+        logger.debug(f"invalidation_bus: unknown event '{event}'")
+        return
+    try:
+        evictor(fields)
+    except Exception as e:
+        logger.warning(f"invalidation_bus: local eviction for {event} failed: {e}")
+
+
+def _evict_everything() -> None:
+    handlers = _handlers_caches()
+    if handlers is not None:
+        for name in ("profile_cache", "persona_cache", "menu_cache", "context_cache"):
+            getattr(handlers, name).cache.clear()
+    cache_manager = sys.modules.get("optimization.cache_manager")
+    if cache_manager is not None:
+        cache_manager.cache.clear_pattern("")
+    bot_routing = sys.modules.get("bot_routing")
+    if bot_routing is not None:
+        bot_routing.invalidate_all()
+
+
+def publish(event: str, **fields: Any) -> None:
+    """Сбрасывает локальные кеши и рассылает событие остальным процессам.
+
+    Безопасно вызывать из любого потока (в т.ч. из asyncio.to_thread) и до старта шины.
+    """
+    apply_local(event, fields)
+    stats_counters["published"] += 1
+    if _loop is None or _queue is None or _loop.is_closed():
+        return
+    payload = json.dumps({"n": NODE_ID, "e": event, "f": fields}, separators=(",", ":"), default=str)
+    try:
+        _loop.call_soon_threadsafe(_queue.put_nowait, payload)
+    except RuntimeError:
+        # event loop уже остановлен (shutdown)
+        pass
+
+
+def _handle_notification(payload: str) -> None:
+    stats_counters["received"] += 1
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning(f"invalidation_bus: bad payload: {payload[:200]}")
+        return
+    if message.get("n") == NODE_ID:
+        return
+    apply_local(message.get("e"), message.get("f") or {})
+    stats_counters["applied"] += 1
+
+
+async def _sender(dsn: str) -> None:
+    import psycopg  # local import: psycopg уже есть в зависимостях (драйвер SQLAlchemy)
+
+    conn = None
+    while True:
+        payload = await _queue.get()
+        batch: List[str] = [payload]
+        while not _queue.empty() and len(batch) < config.INVALIDATION_BUS_BATCH_SIZE:
+            batch.append(_queue.get_nowait())
+        # одинаковые события из одного всплеска отправляем один раз
+        batch = list(dict.fromkeys(batch))
+        try:
+            if conn is None or conn.closed:
+                conn = await psycopg.AsyncConnection.connect(dsn, autocommit=True)
+            async with conn.cursor() as cur:
+                await cur.executemany(
+                    "SELECT pg_notify(%s, %s)",
+                    [(config.INVALIDATION_BUS_CHANNEL, p) for p in batch],
+                )
+            stats_counters["sent"] += len(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats_counters["send_errors"] += len(batch)
+            logger.warning(f"invalidation_bus: failed to send {len(batch)} events: {e}")
+            if conn is not None:
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+                conn = None
+
+
+async def _listener(dsn: str) -> None:
+    import psycopg
+
+    backoff = 1.0
+    connected_before = False
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(dsn, autocommit=True) as conn:
+                await conn.execute(f'LISTEN "{config.INVALIDATION_BUS_CHANNEL}"')
+                if connected_before:
+                    # пока не слушали, события могли пройти мимо
+                    stats_counters["reconnects"] += 1
+                    _evict_everything()
+                    logger.info("invalidation_bus: reconnected, local caches flushed")
+                connected_before = True
+                backoff = 1.0
+                async for notify in conn.notifies():
+                    _handle_notification(notify.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"invalidation_bus: listener error: {e}; reconnecting in {backoff:.0f}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 30.0)
+
+
+async def run_bus() -> None:
+    """Фоновая задача шины: отправка и приём. Отменяется при остановке приложения."""
+    global _loop, _queue
+    dsn = _listen_dsn()
+    if not config.INVALIDATION_BUS_ENABLED or not dsn:
+        logger.info("invalidation_bus: disabled (INVALIDATION_BUS_ENABLED=false or non-Postgres DATABASE_URL)")
+        return
+    _loop = asyncio.get_running_loop()
+    _queue = asyncio.Queue()
+    logger.info(f"invalidation_bus: started (node={NODE_ID}, channel={config.INVALIDATION_BUS_CHANNEL})")
+    try:
+        await asyncio.gather(_sender(dsn), _listener(dsn))
+    finally:
+        _loop = None
+        _queue = None
+
+
+def stats() -> Dict[str, Any]:
+    return dict(stats_counters, node=NODE_ID, enabled=_loop is not None)
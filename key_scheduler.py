@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик API-ключей LLM в памяти процесса.
+
+Раньше на каждый вызов Gemini (включая проверки «отвечать ли в группе»)
+get_next_api_key делал SELECT ... ORDER BY last_used_at и UPDATE ключа, а без
+FOR UPDATE параллельные запросы выбирали один и тот же ключ.
+
+Теперь активные ключи загружаются один раз при старте (и перечитываются раз в
+KEY_SCHEDULER_RELOAD_INTERVAL; неудачную стартовую загрузку повторяет
+run_flusher). У каждого ключа два token bucket'а: запросы в минуту
+и токены в минуту. acquire() выбирает наименее загруженный ключ с запасом бюджета,
+report() по статусу ответа кладёт ключ на cooldown (429/503, с удвоением) и
+списывает фактические токены. Счётчики requests_count/last_used_at копятся в памяти
+и пачкой пишутся в БД фоновой задачей run_flusher().
+
+В режиме супервизора бюджет ключа делится на WORKERS_TOTAL процессов.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Статусы, после которых ключ временно не выдаётся
+COOLDOWN_STATUSES = (429, 503)
+# Пауза между попытками загрузить ключи, если стартовая загрузка не удалась (сек, с удвоением)
+_LOAD_RETRY_MIN = 5.0
+_LOAD_RETRY_MAX = 120.0
+
+
+class TokenBucket:
+    """Классический token bucket: capacity токенов, пополнение capacity за 60 секунд."""
+
+    __slots__ = ("capacity", "tokens", "rate", "updated")
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def fill_ratio(self, now: float) -> float:
+        return self.refill(now) / self.capacity if self.capacity else 0.0
+
+
+class KeyState:
+    """Ключ в памяти. Атрибуты id/api_key/service совместимы с прежним ApiKey."""
+
+    def __init__(self, key_id: int, service: str, api_key: str, rpm: float, tpm: float):
+        self.id = key_id
+        self.service = service
+        self.api_key = api_key
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.cooldown_until = 0.0
+        self.cooldown_streak = 0
+        self.last_used = 0.0
+        self.selected = 0
+        self.throttled = 0
+        # ещё не записано в БД
+        self.pending_requests = 0
+        self.pending_last_used_at: Optional[datetime] = None
+
+    def available(self, now: float) -> bool:
+        return (
+            self.cooldown_until <= now
+            and self.requests.refill(now) >= 1.0
+            and self.tokens.refill(now) > 0.0
+        )
+
+    def status(self, now: float) -> Dict[str, Any]:
+        # /metrics закрыт METRICS_TOKEN, но всё равно никаких фрагментов самого ключа — только id из БД
+        return {
+            "id": self.id,
+            "selected": self.selected,
+            "throttled": self.throttled,
+            "cooldown_sec": round(max(0.0, self.cooldown_until - now), 1),
+            "rpm_left": round(self.requests.refill(now), 1),
+            "tpm_left": int(self.tokens.refill(now)),
+        }
+
+
+# service -> ключи
+_keys: Dict[str, List[KeyState]] = {}
+# api_key -> KeyState (report() вызывают с самой строкой ключа)
+_by_secret: Dict[str, KeyState] = {}
+_lock = threading.Lock()
+_loaded_at: Optional[float] = None
+
+stats_counters: Dict[str, int] = {
+    "acquired": 0,
+    "over_budget": 0,   # свободных ключей не было — выдан наименее занятый сверх бюджета
+    "no_keys": 0,
+    "not_loaded": 0,    # acquire до первой успешной загрузки ключей
+    "load_errors": 0,
+    "cooldowns": 0,
+    "flushed": 0,
+    "flush_errors": 0,
+}
+
+
+def _process_share() -> int:
+    # Супервизор запускает WORKERS_TOTAL процессов с общими ключами
+    try:
+        return max(1, int(os.environ.get("WORKERS_TOTAL") or 1))
+    except ValueError:
+        return 1
+
+
+def _budget(service: str) -> tuple:
+    share = _process_share()
+    if service == 'gemini':
+        return config.GEMINI_KEY_RPM / share, config.GEMINI_KEY_TPM / share
+    return config.LLM_KEY_DEFAULT_RPM / share, config.LLM_KEY_DEFAULT_TPM / share
+
+
+def load_all() -> int:
+    """Перечитывает активные ключи из БД, сохраняя состояние уже известных. Синхронная."""
+    global _loaded_at
+    from db import get_db, ApiKey  # local import: db импортирует много модулей
+
+    with get_db() as session:
+        rows = [
+            (row.id, row.service or 'gemini', row.api_key)
+            for row in session.query(ApiKey.id, ApiKey.service, ApiKey.api_key).filter(ApiKey.is_active == True).all()
+            if row.api_key
+        ]
+
+    with _lock:
+        previous = {state.id: state for states in _keys.values() for state in states}
+        keys: Dict[str, List[KeyState]] = {}
+        for key_id, service, secret in rows:
+            state = previous.get(key_id)
+            if state is None or state.api_key != secret:
+                rpm, tpm = _budget(service)
+                state = KeyState(key_id, service, secret, rpm, tpm)
+            keys.setdefault(service, []).append(state)
+        _keys.clear()
+        _keys.update(keys)
+        _by_secret.clear()
+        _by_secret.update({state.api_key: state for states in keys.values() for state in states})
+        _loaded_at = time.monotonic()
+    logger.info(f"key_scheduler: loaded {len(rows)} active API keys ({', '.join(f'{s}={len(k)}' for s, k in keys.items()) or 'none'})")
+    return len(rows)
+
+
+def acquire(service: str = 'gemini', exclude: Optional[str] = None, strict: bool = False) -> Optional[KeyState]:
+    """Выбирает ключ без обращения к БД: наименее загруженный из тех, у кого есть бюджет.
+
+    exclude — ключ, который не выдавать (дублирующий hedge-запрос идёт на другой ключ);
+    strict — не выдавать ключ сверх бюджета, а вернуть None.
+    """
+    if _loaded_at is None:
+        # ключи ещё не загружены (стартовая загрузка не удалась): в БД отсюда не ходим —
+        # acquire вызывается из event loop на каждом запросе; повторяет загрузку run_flusher
+        stats_counters["not_loaded"] += 1
+        return None
+    now = time.monotonic()
+    with _lock:
+        states = _keys.get(service)
+        if states and exclude:
+            states = [state for state in states if state.api_key != exclude]
+        if not states:
+            if not exclude:
+                stats_counters["no_keys"] += 1
+            return None
+        best = None
+        best_score = None
+        for state in states:
+            if not state.available(now):
+                continue
+            # больше запаса запросов — меньше нагрузка; при равенстве — давно не использованный
+            score = (state.requests.tokens, -state.last_used)
+            if best_score is None or score > best_score:
+                best, best_score = state, score
+        if best is None and strict:
+            return None
+        if best is None:
+            # Все ключи на cooldown или без бюджета: лучше попробовать, чем сразу отказать пользователю
+            stats_counters["over_budget"] += 1
+            cooling_over = [s for s in states if s.cooldown_until <= now]
+            if cooling_over:
+                best = max(cooling_over, key=lambda s: (s.requests.fill_ratio(now), -s.last_used))
+            else:
+                best = min(states, key=lambda s: s.cooldown_until)
+        best.requests.tokens -= 1.0
+        best.last_used = now
+        best.selected += 1
+        best.pending_requests += 1
+        best.pending_last_used_at = datetime.now(timezone.utc)
+        stats_counters["acquired"] += 1
+    return best
+
+
+def report(api_key: Optional[str], status: Optional[int] = None, tokens: Optional[int] = None) -> None:
+    """Результат запроса с ключом: HTTP-статус (429/503 -> cooldown) и потраченные токены."""
+    if not api_key:
+        return
+    state = _by_secret.get(api_key)
+    if state is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        if tokens:
+            state.tokens.refill(now)
+            state.tokens.tokens -= tokens
+        if status in COOLDOWN_STATUSES:
+            state.cooldown_streak += 1
+            state.throttled += 1
+            pause = min(config.KEY_COOLDOWN_MAX_SECONDS, config.KEY_COOLDOWN_SECONDS * (2 ** (state.cooldown_streak - 1)))
+            state.cooldown_until = now + pause
+            stats_counters["cooldowns"] += 1
+            logger.warning(f"key_scheduler: key ID {state.id} got {status}, cooldown {pause:.0f}s")
+        elif status is not None and status < 400:
+            state.cooldown_streak = 0
+
+
+def flush() -> int:
+    """Пишет накопленные requests_count/last_used_at в БД одной пачкой. Синхронная."""
+    from sqlalchemy import bindparam, update
+    from db import get_db, ApiKey
+
+    with _lock:
+        rows = []
+        for states in _keys.values():
+            for state in states:
+                if state.pending_requests:
+                    rows.append({"key_id": state.id, "delta": state.pending_requests, "used_at": state.pending_last_used_at})
+                    state.pending_requests = 0
+    if not rows:
+        return 0
+    table = ApiKey.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("key_id"))
+        .values(requests_count=table.c.requests_count + bindparam("delta"), last_used_at=bindparam("used_at"))
+    )
+    try:
+        with get_db() as session:
+            session.execute(stmt, rows)
+            session.commit()
+    except Exception:
+        # вернём счётчики, чтобы записать их в следующий раз
+        with _lock:
+            for row in rows:
+                state = next((s for states in _keys.values() for s in states if s.id == row["key_id"]), None)
+                if state is not None:
+                    state.pending_requests += row["delta"]
+        raise
+    stats_counters["flushed"] += len(rows)
+    return len(rows)
+
+
+async def run_flusher() -> None:
+    """Фоновая задача: периодическая запись счётчиков и перечитывание списка ключей.
+
+    Если ключи ещё не загружены, повторяет загрузку с нарастающей паузой
+    (от _LOAD_RETRY_MIN до _LOAD_RETRY_MAX), не дожидаясь интервала записи.
+    """
+    retry_delay = _LOAD_RETRY_MIN
+    while True:
+        try:
+            if _loaded_at is None:
+                await asyncio.sleep(retry_delay)
+                try:
+                    await asyncio.to_thread(load_all)
+                    retry_delay = _LOAD_RETRY_MIN
+                except Exception as e:
+                    stats_counters["load_errors"] += 1
+                    logger.warning(f"key_scheduler: loading API keys failed, retry in {retry_delay * 2:.0f}s: {e}")
+                    retry_delay = min(retry_delay * 2, _LOAD_RETRY_MAX)
+                continue
+            await asyncio.sleep(config.KEY_SCHEDULER_FLUSH_INTERVAL)
+            await asyncio.to_thread(flush)
+            if time.monotonic() - _loaded_at >= config.KEY_SCHEDULER_RELOAD_INTERVAL:
+                await asyncio.to_thread(load_all)
+        except asyncio.CancelledError:
+            # последняя запись при остановке
+            try:
+                await asyncio.to_thread(flush)
+            except Exception as e:
+                logger.warning(f"key_scheduler: final flush failed: {e}")
+            raise
+        except Exception as e:
+            stats_counters["flush_errors"] += 1
+            logger.warning(f"key_scheduler: flush/reload failed: {e}")
+
+
+def stats() -> Dict[str, Any]:
+    now = time.monotonic()
+    with _lock:
+        services = {service: [state.status(now) for state in states] for service, states in _keys.items()}
+    return dict(stats_counters, services=services)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Долгоживущие HTTP/2 клиенты к LLM-провайдерам (Gemini, OpenRouter).
+
+Раньше каждый вызов (и каждый ретрай) открывал свой httpx.AsyncClient и платил
+за DNS, TCP+TLS и установку HTTP/2. Теперь на провайдера один клиент с keep-alive
+и пулом; закрывается при остановке приложения (main.py -> close_all()).
+
+Через trace-расширение httpcore считаем запросы и новые соединения:
+reused = requests - new_connections, handshake_ms_avg/handshake_ms_saved_est — цена handshake'а
+и сколько её сэкономил keep-alive (отдаётся в /metrics).
+"""
+
+import contextlib
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_GEMINI = "gemini"
+PROVIDER_OPENROUTER = "openrouter"
+
+
+class ProviderClient:
+    """Лениво создаваемый общий httpx.AsyncClient одного провайдера + статистика соединений."""
+
+    def __init__(self, name: str, read_timeout: float):
+        self.name = name
+        self.read_timeout = read_timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.handshake_time_total = 0.0
+
+    def _build(self) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(
+            connect=config.LLM_HTTP_CONNECT_TIMEOUT,
+            read=self.read_timeout,
+            write=config.LLM_HTTP_WRITE_TIMEOUT,
+            pool=config.LLM_HTTP_POOL_TIMEOUT,
+        )
+        limits = httpx.Limits(
+            max_connections=config.LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=config.LLM_HTTP_KEEPALIVE_EXPIRY,
+        )
+        try:
+            client = httpx.AsyncClient(http2=True, timeout=timeout, limits=limits, event_hooks={"request": [self._on_request]})
+        except ImportError:
+            # пакет h2 не установлен — остаёмся на HTTP/1.1 keep-alive
+            logger.warning(f"llm_clients[{self.name}]: h2 not installed, falling back to HTTP/1.1")
+            client = httpx.AsyncClient(timeout=timeout, limits=limits, event_hooks={"request": [self._on_request]})
+        logger.info(f"llm_clients[{self.name}]: shared client created (read_timeout={self.read_timeout}s)")
+        return client
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = self._build()
+        return self._client
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        handshake_started = None
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            # События httpcore: connection.connect_tcp.*, connection.start_tls.*, http2.* ...
+            nonlocal handshake_started
+            if event_name == "connection.connect_tcp.started":
+                self.new_connections += 1
+                handshake_started = time.monotonic()
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+                if handshake_started is not None:
+                    self.handshake_time_total += time.monotonic() - handshake_started
+
+        request.extensions["trace"] = trace
+
+    async def aclose(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        reused = max(0, self.requests - self.new_connections)
+        avg_handshake = (self.handshake_time_total / self.tls_handshakes) if self.tls_handshakes else 0.0
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused": reused,
+            "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+            "handshake_ms_avg": round(avg_handshake * 1000, 1),
+            # сколько handshake'ов не понадобилось благодаря keep-alive
+            "handshake_ms_saved_est": round(reused * avg_handshake * 1000, 1),
+        }
+
+
+_providers: Dict[str, ProviderClient] = {
+    PROVIDER_GEMINI: ProviderClient(PROVIDER_GEMINI, read_timeout=config.GEMINI_HTTP_READ_TIMEOUT),
+    PROVIDER_OPENROUTER: ProviderClient(PROVIDER_OPENROUTER, read_timeout=config.OPENROUTER_HTTP_READ_TIMEOUT),
+}
+
+
+def get_client(provider: str) -> httpx.AsyncClient:
+    """Общий клиент провайдера. Не закрывать после запроса (никаких `async with`)."""
+    return _providers[provider].client
+
+
+@contextlib.asynccontextmanager
+async def shared_client(provider: str):
+    """`async with shared_client(...) as client:` — как раньше с AsyncClient, но без закрытия соединений на выходе."""
+    yield get_client(provider)
+
+
+async def close_all() -> None:
+    for provider in _providers.values():
+        try:
+            await provider.aclose()
+        except Exception as e:
+            logger.warning(f"llm_clients[{provider.name}]: close failed: {e}")
+
+
+def stats() -> Dict[str, Any]:
+    return {name: provider.stats() for name, provider in _providers.items()}
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+Шлюз к LLM-провайдерам: адаптивный лимит параллельности, circuit breaker и
+общий бюджет ретраев.
+
+Раньше при 503 от Gemini каждый обработчик ретраил сам (handle_media — два раза
+со sleep, контекстная проверка — через 1.5с), и все запросы продолжали бить
+в перегруженный провайдер с полной параллельностью.
+
+Теперь на каждую пару (провайдер, модель) один ProviderGateway:
+- AIMDLimiter: лимит одновременных запросов растёт на 1/limit после быстрого
+  успешного ответа и уменьшается в LLM_GATEWAY_DECREASE раз при перегрузке
+  (429/503/таймаут) или медленном ответе. Лишние запросы ждут в очереди не
+  дольше LLM_GATEWAY_QUEUE_TIMEOUT, потом отклоняются.
+- CircuitBreaker: если в окне последних вызовов доля сбоев выше порога, шлюз
+  открывается и сразу отвечает отказом; через LLM_BREAKER_OPEN_SECONDS
+  пропускает один пробный запрос (half-open).
+- RetryBudget (общий на процесс): ретрай возможен, только пока ретраев не
+  больше LLM_RETRY_BUDGET_RATIO от обычных запросов — во время аварии ретраи не
+  умножают нагрузку.
+
+Hedging (ProviderGateway.hedged): если запрос не ответил за скользящий p90
+латентности успешных ответов, параллельно отправляется дубликат (на другой ключ),
+берётся первый успешный ответ, второй отменяется. Доля дубликатов ограничена
+отдельным бюджетом hedge_budget (LLM_HEDGE_BUDGET_RATIO от запросов), а сам
+дубликат занимает своё место в лимите — если свободного нет, дубликата не будет.
+
+Провайдерские функции в handlers.py возвращают ошибки строками, поэтому исход
+вызова определяет переданная в run() функция classify.
+"""
+
+import asyncio
+import collections
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Исходы вызова (их возвращает classify)
+OUTCOME_OK = "ok"
+OUTCOME_OVERLOAD = "overload"   # 429/503/таймаут: уменьшаем лимит, можно ретраить
+OUTCOME_FAILURE = "failure"     # прочие 5xx и сетевые ошибки: считаются breaker'ом
+OUTCOME_NEUTRAL = "neutral"     # ошибки запроса (400, нет ключа) — на здоровье провайдера не влияют
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class AIMDLimiter:
+    """Лимит параллельных запросов: additive increase / multiplicative decrease."""
+
+    def __init__(self, initial: float, minimum: float, maximum: float):
+        self.limit = float(initial)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        self._last_decrease = 0.0
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # место в лимите занимаем за ожидающего
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self, timeout: float) -> bool:
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            # место могли выдать одновременно с таймаутом
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            # место уже выдали в _wake(), а задачу отменили до возобновления — возвращаем его
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def try_acquire(self) -> bool:
+        """Место без ожидания: только если лимит не исчерпан и очереди нет."""
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def release(self) -> None:
+        self.in_flight = max(0, self.in_flight - 1)
+        self._wake()
+
+    def on_result(self, outcome: str, latency: float) -> None:
+        now = time.monotonic()
+        slow = latency > config.LLM_GATEWAY_LATENCY_TARGET
+        if outcome == OUTCOME_OVERLOAD or (outcome == OUTCOME_OK and slow):
+            # всплеск одновременных 503 — одно уменьшение, а не по разу на каждый ответ
+            if now - self._last_decrease >= 1.0:
+                self.limit = max(self.minimum, self.limit * config.LLM_GATEWAY_DECREASE)
+                self._last_decrease = now
+        elif outcome == OUTCOME_OK:
+            self.limit = min(self.maximum, self.limit + 1.0 / max(self.limit, 1.0))
+            self._wake()
+
+
+class CircuitBreaker:
+    """Размыкается по доле сбоев в скользящем окне, восстанавливается через пробный запрос."""
+
+    def __init__(self):
+        self.state = BREAKER_CLOSED
+        self.opened_at = 0.0
+        self.opens = 0
+        self._window: Deque[bool] = collections.deque(maxlen=config.LLM_BREAKER_WINDOW)
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.state == BREAKER_OPEN:
+            if time.monotonic() - self.opened_at < config.LLM_BREAKER_OPEN_SECONDS:
+                return False
+            self.state = BREAKER_HALF_OPEN
+            self._probe_in_flight = False
+        # half-open: только один пробный запрос
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def _open(self, name: str) -> None:
+        self.state = BREAKER_OPEN
+        self.opened_at = time.monotonic()
+        self.opens += 1
+        self._probe_in_flight = False
+        logger.warning(f"llm_gateway[{name}]: circuit OPEN for {config.LLM_BREAKER_OPEN_SECONDS:.0f}s")
+
+    def failure_ratio(self) -> float:
+        """Доля сбоев в текущем окне (0.0, пока окно пустое)."""
+        return sum(self._window) / len(self._window) if self._window else 0.0
+
+    def on_result(self, outcome: str, name: str) -> None:
+        if outcome == OUTCOME_NEUTRAL:
+            if self.state == BREAKER_HALF_OPEN:
+                self._probe_in_flight = False
+            return
+        failed = outcome in (OUTCOME_OVERLOAD, OUTCOME_FAILURE)
+        if self.state == BREAKER_HALF_OPEN:
+            if failed:
+                self._open(name)
+            else:
+                self.state = BREAKER_CLOSED
+                self._window.clear()
+                self._probe_in_flight = False
+                logger.info(f"llm_gateway[{name}]: circuit closed after successful probe")
+            return
+        self._window.append(failed)
+        if (
+            self.state == BREAKER_CLOSED
+            and len(self._window) >= config.LLM_BREAKER_MIN_CALLS
+            and sum(self._window) / len(self._window) >= config.LLM_BREAKER_FAILURE_RATIO
+        ):
+            self._window.clear()
+            self._open(name)
+
+
+class RetryBudget:
+    """Ретраев не больше ratio от обычных запросов (плюс небольшой постоянный минимум в секунду)."""
+
+    def __init__(self, ratio: float, min_per_sec: float, cap: float = 20.0):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.cap = cap
+        self.tokens = cap / 2
+        self.updated = time.monotonic()
+        self.granted = 0
+        self.denied = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self.updated) * self.min_per_sec)
+        self.updated = now
+
+    def deposit(self) -> None:
+        self._refill()
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.granted += 1
+            return True
+        self.denied += 1
+        return False
+
+
+retry_budget = RetryBudget(config.LLM_RETRY_BUDGET_RATIO, config.LLM_RETRY_BUDGET_MIN_PER_SEC)
+# Тот же механизм для дублирующих (hedge) запросов, без постоянного минимума
+hedge_budget = RetryBudget(config.LLM_HEDGE_BUDGET_RATIO, 0.0)
+
+
+class ProviderGateway:
+    def __init__(self, name: str):
+        self.name = name
+        self.limiter = AIMDLimiter(
+            initial=config.LLM_GATEWAY_INITIAL_LIMIT,
+            minimum=config.LLM_GATEWAY_MIN_LIMIT,
+            maximum=config.LLM_GATEWAY_MAX_LIMIT,
+        )
+        self.breaker = CircuitBreaker()
+        self.counters: Dict[str, int] = collections.Counter()
+        # латентность успешных ответов — для порога hedging
+        self.latencies: Deque[float] = collections.deque(maxlen=config.LLM_HEDGE_WINDOW)
+
+    async def run(
+        self,
+        attempt: Callable[[], Awaitable[Any]],
+        classify: Callable[[Any], str],
+        rejected: Any,
+        max_retries: Optional[int] = None,
+    ) -> Any:
+        """Выполняет attempt() через лимитер и breaker; при перегрузке ретраит в рамках бюджета.
+
+        rejected — что вернуть, если запрос не был отправлен (breaker открыт, очередь переполнена).
+        """
+        retries = config.LLM_GATEWAY_MAX_RETRIES if max_retries is None else max_retries
+        retry_budget.deposit()
+        result = rejected
+        for attempt_no in range(retries + 1):
+            if attempt_no > 0:
+                if not retry_budget.try_withdraw():
+                    self.counters["retry_budget_exhausted"] += 1
+                    break
+                self.counters["retries"] += 1
+                backoff = config.LLM_GATEWAY_RETRY_BACKOFF * attempt_no + random.uniform(0.1, 0.5)
+                logger.warning(f"llm_gateway[{self.name}]: overloaded, retry {attempt_no}/{retries} after {backoff:.2f}s")
+                await asyncio.sleep(backoff)
+            if not self.breaker.allow():
+                self.counters["rejected_open"] += 1
+                return result
+            if not await self.limiter.acquire(config.LLM_GATEWAY_QUEUE_TIMEOUT):
+                self.counters["rejected_queue"] += 1
+                # место так и не освободилось — пробный запрос не состоялся
+                self.breaker.on_result(OUTCOME_NEUTRAL, self.name)
+                return result
+            started = time.monotonic()
+            outcome = OUTCOME_FAILURE
+            try:
+                result = await attempt()
+                outcome = classify(result)
+            except asyncio.CancelledError:
+                outcome = OUTCOME_NEUTRAL
+                raise
+            finally:
+                latency = time.monotonic() - started
+                self.limiter.release()
+                self.limiter.on_result(outcome, latency)
+                self.breaker.on_result(outcome, self.name)
+                self.counters[outcome] += 1
+                if outcome == OUTCOME_OK:
+                    self.latencies.append(latency)
+            if outcome != OUTCOME_OVERLOAD:
+                return result
+        return result
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        """Квантиль латентности успешных ответов (None, пока мало замеров)."""
+        if len(self.latencies) < config.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def hedged(
+        self,
+        primary: Callable[[], Awaitable[Any]],
+        backup: Callable[[], Optional[Awaitable[Any]]],
+        classify: Callable[[Any], str],
+    ) -> Any:
+        """Запрос с дублированием после p90: первый успешный ответ выигрывает, второй отменяется.
+
+        backup() возвращает корутину дубликата или None (например, нет другого свободного ключа).
+        """
+        hedge_budget.deposit()
+        delay = self.latency_quantile(config.LLM_HEDGE_QUANTILE)
+        if delay is None:
+            return await primary()
+        first = asyncio.ensure_future(primary())
+        second = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done:
+                return first.result()
+            # дубликат — это ещё один запрос к провайдеру: без свободного места в лимите не отправляем
+            if not self.limiter.try_acquire():
+                self.counters["hedge_no_slot"] += 1
+                return await first
+            if not hedge_budget.try_withdraw():
+                self.limiter.release()
+                self.counters["hedge_budget_denied"] += 1
+                return await first
+            backup_coro = backup()
+            if backup_coro is None:
+                self.limiter.release()
+                self.counters["hedge_no_key"] += 1
+                return await first
+            second = asyncio.ensure_future(backup_coro)
+            # место возвращаем по завершении дубликата, в том числе если его отменили до старта
+            second.add_done_callback(lambda _task: self.limiter.release())
+            self.counters["hedges"] += 1
+            logger.info(f"llm_gateway[{self.name}]: no response after p90 {delay:.2f}s, hedging")
+
+            pending = {first, second}
+            fallback_result = None
+            fallback_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        if task is first or fallback_error is None:
+                            fallback_error = task.exception()
+                        continue
+                    result = task.result()
+                    if classify(result) == OUTCOME_OK:
+                        if task is second:
+                            self.counters["hedge_wins"] += 1
+                        return result
+                    # ошибка: ждём второй запрос, иначе вернём ответ основного
+                    if task is first or fallback_result is None:
+                        fallback_result = result
+            if fallback_result is not None:
+                return fallback_result
+            raise fallback_error
+        finally:
+            for task in (first, second):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        p90 = self.latency_quantile(config.LLM_HEDGE_QUANTILE)
+        return dict(
+            self.counters,
+            hedge_after_sec=round(p90, 2) if p90 is not None else None,
+            limit=round(self.limiter.limit, 2),
+            in_flight=self.limiter.in_flight,
+            queued=len(self.limiter._waiters),
+            breaker=self.breaker.state,
+            breaker_opens=self.breaker.opens,
+        )
+
+
+_gateways: Dict[Tuple[str, str], ProviderGateway] = {}
+
+
+def get_gateway(provider: str, model: str) -> ProviderGateway:
+    key = (provider, model)
+    gateway = _gateways.get(key)
+    if gateway is None:
+        gateway = _gateways[key] = ProviderGateway(f"{provider}:{model}")
+    return gateway
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "gateways": {gateway.name: gateway.stats() for gateway in _gateways.values()},
+        "retry_budget": {
+            "tokens": round(retry_budget.tokens, 2),
+            "granted": retry_budget.granted,
+            "denied": retry_budget.denied,
+        },
+        "hedge_budget": {
+            "enabled": config.LLM_HEDGE_ENABLED,
+            "tokens": round(hedge_budget.tokens, 2),
+            "granted": hedge_budget.granted,
+            "denied": hedge_budget.denied,
+        },
+    }
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Сборка тел запросов к LLM из заранее сериализованных фрагментов.
+
+Раньше на каждом ходе send_to_google_gemini заново проходил всю историю:
+re.sub(r"^\\w+:\\s", ...) на каждое сообщение (с import re внутри цикла), новые
+словари, а затем httpx снова кодировал весь payload в JSON. Ретраи (безопасный
+промпт, повтор OpenRouter) пересобирали и перекодировали всё, включая повторный
+base64 картинки.
+
+Теперь:
+- каждое сообщение истории кодируется в JSON-фрагмент один раз — при первом
+  появлении; префикс "username: " для Gemini снимается тогда же. Фрагменты лежат
+  в LRU по (провайдер, роль, текст), ограниченном по памяти
+  (LLM_PAYLOAD_FRAGMENT_CACHE_MB — сам текст в ключе плюс фрагмент): история
+  чата от хода к ходу только дописывается, поэтому на следующем ходе
+  кодируется лишь новое сообщение;
+- картинка кодируется в base64 один раз на запрос и переиспользуется ретраями и
+  hedge-дубликатом;
+- постоянные части (generationConfig, safetySettings) закодированы при импорте;
+- тело собирается склейкой байтов и уходит в общий клиент как content= (без
+  повторной сериализации в httpx). Кодировщик — orjson, если установлен, иначе
+  stdlib json.
+"""
+
+import base64
+import collections
+import json
+import logging
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson  # быстрый кодировщик; необязательная зависимость
+
+    def _dumps(value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    ENCODER = "orjson"
+except ImportError:
+    def _dumps(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    ENCODER = "json"
+
+PROVIDER_GEMINI = "gemini"
+PROVIDER_OPENROUTER = "openrouter"
+
+# Префикс "username: " в тексте сообщения (модели Gemini он не нужен)
+_SPEAKER_PREFIX_RE = re.compile(r"^\w+:\s")
+
+# Сколько последних картинок помнить в base64 (ретраи и hedge одного запроса)
+_MAX_IMAGES = 8
+
+# --- Постоянные части тел запросов ---
+GEMINI_GENERATION_CONFIG: Dict[str, Any] = {
+    "temperature": 1.0,
+    "topP": 0.95,
+    "topK": 64,
+    "maxOutputTokens": 8192,
+    # Запрашиваем JSON, чтобы модель сразу вернула валидный JSON-массив
+    "responseMimeType": "application/json",
+}
+# Чуть ослабляем фильтры на базовом запросе, чтобы не ловить блок на безобидных сообщениях в группах
+GEMINI_SAFETY_SETTINGS: List[Dict[str, str]] = [
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+    {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_ONLY_HIGH"},
+]
+# Ретрай после блокировки промпта: ослабленные пороги и более короткий ответ
+GEMINI_SAFE_GENERATION_CONFIG: Dict[str, Any] = {
+    "temperature": 0.9,
+    "topP": 0.95,
+    "maxOutputTokens": 2048,
+}
+GEMINI_SAFE_SAFETY_SETTINGS: List[Dict[str, str]] = [
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_CIVIC_INTEGRITY", "threshold": "BLOCK_NONE"},
+]
+# Pass-through Gemini safety settings via OpenRouter
+OPENROUTER_SAFETY_SETTINGS: List[Dict[str, str]] = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+_GEMINI_TAIL = b',"generationConfig":' + _dumps(GEMINI_GENERATION_CONFIG) + b',"safetySettings":' + _dumps(GEMINI_SAFETY_SETTINGS)
+_GEMINI_SAFE_TAIL = b',"generationConfig":' + _dumps(GEMINI_SAFE_GENERATION_CONFIG) + b',"safetySettings":' + _dumps(GEMINI_SAFE_SAFETY_SETTINGS)
+_OPENROUTER_STATIC = (
+    b',"response_format":{"type":"json_object"}'
+    # usage в ответе (в т.ч. prompt_tokens_details.cached_tokens) — для метрик кеша промпта
+    + b',"usage":{"include":true}'
+    + b',"safety_settings":' + _dumps(OPENROUTER_SAFETY_SETTINGS)
+)
+_GEMINI_STARTER = _dumps({"role": "user", "parts": [{"text": "Начни диалог."}]})
+_GEMINI_OPENER = _dumps({"role": "user", "parts": [{"text": "(начало диалога)"}]})
+
+# (провайдер, роль, текст) -> закодированный фрагмент
+_fragments: "collections.OrderedDict[Tuple[str, str, str], bytes]" = collections.OrderedDict()
+_fragment_bytes = 0
+# id(bytes) -> (сами bytes — чтобы id не переиспользовался, base64)
+_images: "collections.OrderedDict[int, Tuple[bytes, str]]" = collections.OrderedDict()
+
+stats_counters: Dict[str, int] = collections.Counter()
+
+
+def _fragment_size(text: str, encoded: bytes) -> int:
+    # текст ключа хранится целиком (кириллица в str — 2 байта на символ)
+    return sys.getsizeof(text) + len(encoded)
+
+
+def _fragment(provider: str, role: str, text: str) -> bytes:
+    global _fragment_bytes
+    key = (provider, role, text)
+    encoded = _fragments.get(key)
+    if encoded is not None:
+        _fragments.move_to_end(key)
+        stats_counters["fragment_hits"] += 1
+        return encoded
+    stats_counters["fragment_misses"] += 1
+    if provider == PROVIDER_GEMINI:
+        encoded = _dumps({"role": role, "parts": [{"text": _SPEAKER_PREFIX_RE.sub("", text, count=1)}]})
+    else:
+        encoded = _dumps({"role": role, "content": text})
+    size = _fragment_size(text, encoded)
+    limit = int(config.LLM_PAYLOAD_FRAGMENT_CACHE_MB * 1024 * 1024)
+    if size > limit:
+        return encoded
+    _fragments[key] = encoded
+    _fragment_bytes += size
+    while _fragment_bytes > limit and _fragments:
+        (_, _, old_text), old_encoded = _fragments.popitem(last=False)
+        _fragment_bytes -= _fragment_size(old_text, old_encoded)
+    return encoded
+
+
+def image_base64(image_data: bytes) -> str:
+    """base64 картинки; повторные вызовы с теми же bytes (ретраи, hedge) не кодируют заново."""
+    cached = _images.get(id(image_data))
+    if cached is not None and cached[0] is image_data:
+        stats_counters["image_reused"] += 1
+        return cached[1]
+    encoded = base64.b64encode(image_data).decode("ascii")
+    stats_counters["image_encoded"] += 1
+    _images[id(image_data)] = (image_data, encoded)
+    if len(_images) > _MAX_IMAGES:
+        _images.popitem(last=False)
+    return encoded
+
+
+def gemini_body(
+    system_prompt: str,
+    messages: List[Dict[str, Any]],
+    image_data: Optional[bytes] = None,
+    cached_content: Optional[str] = None,
+    safe_retry: bool = False,
+) -> bytes:
+    """Тело generateContent / streamGenerateContent.
+
+    cached_content — имя cachedContents (gemini_cache) вместо system_instruction;
+    safe_retry — ослабленные фильтры и короткий ответ для ретрая после блокировки.
+    """
+    roles: List[str] = []
+    fragments: List[bytes] = []
+    last_text = ""
+    for msg in messages:
+        # Skip legacy system entries in history; pass system via system_instruction
+        if msg.get("role") == "system":
+            continue
+        role = "model" if msg.get("role") == "assistant" else "user"
+        last_text = str(msg.get("content") or "")
+        roles.append(role)
+        fragments.append(_fragment(PROVIDER_GEMINI, role, last_text))
+
+    # If there are no messages (e.g., proactive "напиши что-нибудь"),
+    # add a minimal starter so Google API doesn't reject empty contents
+    if not fragments:
+        roles.append("user")
+        fragments.append(_GEMINI_STARTER)
+        last_text = "Начни диалог."
+    # Ensure conversation doesn't start with model role
+    if roles[0] == "model":
+        roles.insert(0, "user")
+        fragments.insert(0, _GEMINI_OPENER)
+
+    # Attach image to the last user message, if any
+    if image_data and roles[-1] == "user":
+        fragments[-1] = _dumps({
+            "role": "user",
+            "parts": [
+                {"text": _SPEAKER_PREFIX_RE.sub("", last_text, count=1)},
+                {"inline_data": {"mime_type": "image/jpeg", "data": image_base64(image_data)}},
+            ],
+        })
+
+    parts = [b'{"contents":[', b",".join(fragments), b"]"]
+    if cached_content:
+        parts.append(b',"cachedContent":' + _dumps(cached_content))
+    else:
+        parts.append(b',"system_instruction":' + _dumps({"parts": [{"text": system_prompt or ""}]}))
+    parts.append(_GEMINI_SAFE_TAIL if safe_retry else _GEMINI_TAIL)
+    parts.append(b"}")
+    body = b"".join(parts)
+    stats_counters["gemini_bodies"] += 1
+    stats_counters["bytes"] += len(body)
+    return body
+
+
+def openrouter_body(
+    system_prompt: str,
+    messages: List[Dict[str, Any]],
+    model_name: str,
+    image_data: Optional[bytes] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    stream: bool = False,
+) -> bytes:
+    """Тело chat/completions для OpenRouter."""
+    fragments: List[bytes] = []
+    if system_prompt:
+        fragments.append(_dumps({"role": "system", "content": system_prompt}))
+    history = list(messages)
+    if image_data:
+        last_user_message = next((m for m in reversed(history) if m.get("role") == "user"), None)
+        text_content = last_user_message["content"] if last_user_message else "Опиши картинку кратко, затем задай 1-2 вопроса. Ответ в JSON."
+        # Пересобираем последнее пользовательское сообщение вместе с картинкой в универсальном формате
+        if last_user_message:
+            history = [m for m in history if m is not last_user_message]
+    fragments.extend(_fragment(PROVIDER_OPENROUTER, str(m.get("role")), str(m.get("content") or "")) for m in history)
+    if image_data:
+        fragments.append(_dumps({
+            "role": "user",
+            "content": [
+                {"type": "text", "text": text_content},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64(image_data)}"}},
+            ],
+        }))
+
+    # Temperature: если явно не задано — используем немного творческий режим по умолчанию
+    options: Dict[str, Any] = {"temperature": float(temperature) if temperature is not None else 0.9}
+    if max_tokens is not None:
+        options["max_tokens"] = int(max_tokens)
+    body = b"".join([
+        # Напрямую используем имя модели из конфига; позволяем OpenRouter маршрутизировать запрос автоматически
+        b'{"model":', _dumps(model_name),
+        b',"messages":[', b",".join(fragments), b"]",
+        b',"stream":', b"true" if stream else b"false",
+        _OPENROUTER_STATIC,
+        b",", _dumps(options)[1:],
+    ])
+    stats_counters["openrouter_bodies"] += 1
+    stats_counters["bytes"] += len(body)
+    return body
+
+
+def stats() -> Dict[str, Any]:
+    return dict(stats_counters, encoder=ENCODER, fragments=len(_fragments), fragment_bytes=_fragment_bytes)
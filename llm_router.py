@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Маршрутизация запросов к LLM между провайдерами и моделями.
+
+Раньше get_llm_response жёстко выбирал провайдера по балансу: пользователи с
+кредитами — OpenRouter (OPENROUTER_MODEL_NAME), остальные — Gemini напрямую.
+Если выбранный провайдер деградировал (breaker открыт, p95 в десятки секунд),
+запасного варианта не было.
+
+Теперь у каждого тарифа (paid / paid_image / free) упорядоченный список
+кандидатов "провайдер:модель" из конфига (LLM_ROUTES_*). plan() каждый раз
+пересортировывает его по живому здоровью пары (провайдер, модель) из llm_gateway:
+- breaker открыт — кандидат в самый конец;
+- p95 успешных ответов выше LLM_ROUTE_P95_BUDGET или доля сбоев в окне выше
+  LLM_ROUTE_MAX_FAILURE_RATIO — после здоровых кандидатов;
+- при равном здоровье сохраняется порядок из конфига.
+
+Ограничение по стоимости: запасной кандидат не дороже основного (множитель
+MODEL_PRICE_MULTIPLIERS * LLM_ROUTE_COST_CEILING), а бесплатный тариф не уходит к
+провайдерам, за которые платит владелец бота (OpenRouter). Так платный
+пользователь при деградации OpenRouter получает ответ от Gemini напрямую, а
+get_llm_response возвращает фактическую модель — по ней
+deduct_credits_for_interaction берёт множитель.
+"""
+
+import collections
+import logging
+from typing import Any, Dict, List
+
+import config
+import llm_clients
+import llm_gateway
+
+logger = logging.getLogger(__name__)
+
+TIER_PAID = "paid"
+TIER_PAID_IMAGE = "paid_image"
+TIER_FREE = "free"
+
+# Провайдеры без оплаты по запросу — только они доступны бесплатному тарифу
+FREE_PROVIDERS = (llm_clients.PROVIDER_GEMINI,)
+
+# Штрафы при сортировке кандидатов
+_HEALTHY = 0
+_DEGRADED = 1
+_OPEN = 2
+
+
+class Candidate:
+    """Пара (провайдер, модель) в маршруте тарифа."""
+
+    __slots__ = ("provider", "model")
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.model}"
+
+    def __repr__(self) -> str:
+        return f"Candidate({self.name})"
+
+
+def _parse_routes(spec: str) -> List[Candidate]:
+    candidates: List[Candidate] = []
+    for raw in (spec or "").split(","):
+        raw = raw.strip()
+        if not raw:
+            continue
+        provider, sep, model = raw.partition(":")
+        provider, model = provider.strip().lower(), model.strip()
+        if not sep or not model or provider not in (llm_clients.PROVIDER_GEMINI, llm_clients.PROVIDER_OPENROUTER):
+            logger.warning(f"llm_router: bad route candidate '{raw}' skipped")
+            continue
+        if provider == llm_clients.PROVIDER_GEMINI and model != config.GEMINI_MODEL_NAME_FOR_API:
+            # прямые запросы к Gemini идут только в GEMINI_MODEL_NAME_FOR_API
+            logger.warning(f"llm_router: gemini model '{model}' is not GEMINI_MODEL_NAME_FOR_API, candidate skipped")
+            continue
+        candidates.append(Candidate(provider, model))
+    return candidates
+
+
+_routes: Dict[str, List[Candidate]] = {
+    TIER_PAID: _parse_routes(config.LLM_ROUTES_PAID),
+    TIER_PAID_IMAGE: _parse_routes(config.LLM_ROUTES_PAID_IMAGE),
+    TIER_FREE: _parse_routes(config.LLM_ROUTES_FREE),
+}
+
+stats_counters: Dict[str, int] = collections.Counter()
+
+
+def tier_for(has_credits: bool, is_image: bool = False) -> str:
+    if not has_credits:
+        return TIER_FREE
+    return TIER_PAID_IMAGE if is_image else TIER_PAID
+
+
+def _price(model: str) -> float:
+    return float(config.MODEL_PRICE_MULTIPLIERS.get(model, 1.0))
+
+
+def _configured(candidate: Candidate) -> bool:
+    if candidate.provider == llm_clients.PROVIDER_OPENROUTER:
+        return bool(config.OPENROUTER_API_KEY)
+    return True
+
+
+def health(candidate: Candidate) -> Dict[str, Any]:
+    """Живое состояние кандидата по данным его шлюза."""
+    gateway = llm_gateway.get_gateway(candidate.provider, candidate.model)
+    p95 = gateway.latency_quantile(0.95)
+    failure_ratio = gateway.breaker.failure_ratio()
+    if gateway.breaker.state == llm_gateway.BREAKER_OPEN:
+        penalty = _OPEN
+    elif (p95 is not None and p95 > config.LLM_ROUTE_P95_BUDGET) or failure_ratio > config.LLM_ROUTE_MAX_FAILURE_RATIO:
+        penalty = _DEGRADED
+    else:
+        penalty = _HEALTHY
+    return {
+        "candidate": candidate.name,
+        "penalty": penalty,
+        "p95_sec": round(p95, 2) if p95 is not None else None,
+        "failure_ratio": round(failure_ratio, 3),
+        "breaker": gateway.breaker.state,
+        "price_multiplier": _price(candidate.model),
+    }
+
+
+def route_models(tier: str) -> List[str]:
+    """Модели тарифа, к которым запрос может уйти (без учёта здоровья и без счётчиков)."""
+    return [
+        candidate.model
+        for candidate in _routes.get(tier, [])
+        if _configured(candidate) and (tier != TIER_FREE or candidate.provider in FREE_PROVIDERS)
+    ]
+
+
+def plan(tier: str) -> List[Candidate]:
+    """Кандидаты тарифа в порядке попыток: сначала здоровые, дорогие сверх потолка отброшены."""
+    eligible: List[Candidate] = []
+    for candidate in _routes.get(tier, []):
+        if not _configured(candidate):
+            stats_counters["skipped_unconfigured"] += 1
+            continue
+        if tier == TIER_FREE and candidate.provider not in FREE_PROVIDERS:
+            stats_counters["skipped_paid_provider"] += 1
+            continue
+        eligible.append(candidate)
+    if not eligible:
+        return []
+
+    # Потолок цены — от основного кандидата тарифа, каким бы ни было его здоровье
+    ceiling = _price(eligible[0].model) * config.LLM_ROUTE_COST_CEILING
+    affordable = [eligible[0]]
+    for candidate in eligible[1:]:
+        if _price(candidate.model) <= ceiling:
+            affordable.append(candidate)
+        else:
+            stats_counters["skipped_cost"] += 1
+    if not config.LLM_ROUTE_FAILOVER_ENABLED:
+        return affordable[:1]
+
+    penalties = [health(candidate)["penalty"] for candidate in affordable]
+    order = sorted(range(len(affordable)), key=lambda i: (penalties[i], i))
+    if order[0] != 0:
+        stats_counters["demoted_primary"] += 1
+        logger.info(
+            f"llm_router[{tier}]: primary {affordable[0].name} degraded, routing to {affordable[order[0]].name} first"
+        )
+    return [affordable[i] for i in order]
+
+
+def record(tier: str, candidate: Candidate, position: int, ok: bool) -> None:
+    """Итог попытки кандидата (position — номер в плане, 0 — первый)."""
+    stats_counters[f"{tier}:{candidate.name}:{'ok' if ok else 'error'}"] += 1
+    if position > 0:
+        stats_counters["failovers"] += 1
+        if ok:
+            stats_counters["failover_ok"] += 1
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "routes": {tier: [health(candidate) for candidate in candidates] for tier, candidates in _routes.items()},
+        "counters": dict(stats_counters),
+    }
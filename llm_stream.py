@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Разбор ответа LLM: инкрементальный (стриминг) и целиком (parse_llm_output).
+
+Модель отвечает JSON-массивом строк (["часть 1", "часть 2"]) или объектом
+{"response": [...]}, иногда в ```json-блоке. При стриминге текст приходит
+кусками; ArrayStreamParser.feed() возвращает элементы массива сразу, как только
+закрылась их кавычка, чтобы первую часть ответа можно было отправить в чат,
+пока модель ещё пишет остальные.
+
+Парсер ничего не «угадывает»: если структура не похожа на массив строк
+(число/объект внутри массива, битый литерал), он перестаёт выдавать элементы
+(broken=True), и вызывающий код разбирает полный текст через parse_llm_output.
+
+parse_llm_output() — единый разбор полного ответа для Gemini, OpenRouter и
+стриминга: один проход ArrayStreamParser, а если массива нет или он битый —
+один json.loads по внешним скобкам. Понимает ```-блоки, {"response": [...]},
+голый массив, оборванный на середине JSON и ответ обычным текстом.
+"""
+
+import json
+import re
+from typing import Any, List, Optional
+
+_SEEK = 0       # ищем начало целевого массива
+_ARRAY = 1      # внутри массива, ждём элемент / ',' / ']'
+_DONE = 2       # массив закрыт или разбор прерван
+
+_WHITESPACE = " \t\r\n"
+_FENCE_LANG_RE = re.compile(r"[A-Za-z0-9_+.-]*")
+
+# Запасные ключи, если в объекте нет "response"
+_FALLBACK_KEYS = ("answer", "text", "parts", "messages", "message", "content", "body")
+
+
+class ArrayStreamParser:
+    """Выдаёт строковые элементы JSON-массива по мере их поступления."""
+
+    def __init__(self, key: str = "response"):
+        self.key = key
+        self.items: List[str] = []
+        self.completed = False   # встретили закрывающую ']'
+        self.broken = False      # структура не та — дальше не разбираем
+        self._buf = ""
+        self._pos = 0
+        # Строка в конце _buf ещё не закрыта: новые куски копятся в _parts и склеиваются
+        # с _buf один раз, когда придёт закрывающая кавычка (иначе длинный элемент,
+        # пришедший мелкими кусками, копировался и пересканировался бы на каждом feed)
+        self._in_string = False
+        self._parts: List[str] = []
+        self._trailing_backslashes = 0
+        self._state = _SEEK
+        # для поиска массива: глубина объектов и последняя строка (ключ) на этой глубине
+        self._depth = 0
+        self._last_string: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self._state == _DONE
+
+    def feed(self, chunk: str) -> List[str]:
+        """Добавляет кусок текста, возвращает новые завершённые элементы."""
+        if self._state == _DONE or not chunk:
+            return []
+        if self._in_string:
+            self._parts.append(chunk)
+            if not self._closes_string(chunk):
+                return []
+            self._buf += "".join(self._parts)
+            self._parts = []
+            self._in_string = False
+        else:
+            self._buf += chunk
+        emitted: List[str] = []
+        while self._state != _DONE:
+            if self._state == _SEEK:
+                if not self._seek():
+                    break
+            else:
+                item = self._next_item()
+                if item is None:
+                    break
+                self.items.append(item)
+                emitted.append(item)
+        if self._pos:
+            # разобранное начало буфера больше не нужно
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        return emitted
+
+    def tail(self) -> Optional[str]:
+        """Незакрытая строка в конце массива (ответ оборван) или None."""
+        if self._state != _ARRAY or self._pos >= len(self._buf) or self._buf[self._pos] != '"':
+            return None
+        raw = self._buf[self._pos + 1:] + "".join(self._parts)
+        try:
+            return json.loads(f'"{raw}"', strict=False)
+        except ValueError:
+            pass
+        # обрезанная escape-последовательность в самом конце (\u04, \)
+        cut = raw.rfind('\\', max(0, len(raw) - 6))
+        if cut >= 0:
+            raw = raw[:cut]
+        try:
+            return json.loads(f'"{raw}"', strict=False)
+        except ValueError:
+            return raw
+
+    def _closes_string(self, chunk: str) -> bool:
+        """Есть ли в новом куске закрывающая кавычка открытой строки (с учётом '\\' на стыке)."""
+        i = 0
+        while True:
+            quote = chunk.find('"', i)
+            if quote < 0:
+                stripped = chunk.rstrip('\\')
+                run = len(chunk) - len(stripped)
+                self._trailing_backslashes = run if stripped else self._trailing_backslashes + run
+                return False
+            backslashes = 0
+            j = quote - 1
+            while j >= 0 and chunk[j] == '\\':
+                backslashes += 1
+                j -= 1
+            if j < 0:
+                backslashes += self._trailing_backslashes
+            if backslashes % 2 == 0:
+                return True
+            i = quote + 1
+
+    def _scan_string(self, start: int) -> Optional[int]:
+        """Индекс закрывающей кавычки строки, открытой в start, или None, если она ещё не пришла."""
+        buf = self._buf
+        i = start + 1
+        while True:
+            quote = buf.find('"', i)
+            if quote < 0:
+                self._in_string = True
+                self._trailing_backslashes = min(len(buf) - len(buf.rstrip('\\')), len(buf) - start - 1)
+                return None
+            # закрывающая, если перед ней чётное число обратных слэшей
+            backslashes = 0
+            j = quote - 1
+            while j > start and buf[j] == '\\':
+                backslashes += 1
+                j -= 1
+            if backslashes % 2 == 0:
+                return quote
+            i = quote + 1
+
+    def _seek(self) -> bool:
+        """Двигается к '[' целевого массива. False — нужно больше данных."""
+        buf = self._buf
+        n = len(buf)
+        while self._pos < n:
+            ch = buf[self._pos]
+            if ch == '"':
+                end = self._scan_string(self._pos)
+                if end is None:
+                    return False
+                try:
+                    self._last_string = json.loads(buf[self._pos:end + 1], strict=False)
+                except ValueError:
+                    self._last_string = None
+                self._pos = end + 1
+                continue
+            if ch == '{':
+                self._depth += 1
+                self._last_string = None
+            elif ch == '}':
+                self._depth = max(0, self._depth - 1)
+            elif ch == '[':
+                # корневой массив или значение ключа "response" объекта верхнего уровня
+                if self._depth == 0 or (self._depth == 1 and self._last_string == self.key):
+                    self._pos += 1
+                    self._state = _ARRAY
+                    return True
+            self._pos += 1
+        return False
+
+    def _next_item(self) -> Optional[str]:
+        buf = self._buf
+        n = len(buf)
+        while self._pos < n and (buf[self._pos] in _WHITESPACE or buf[self._pos] == ','):
+            self._pos += 1
+        if self._pos >= n:
+            return None
+        ch = buf[self._pos]
+        if ch == ']':
+            self.completed = True
+            self._state = _DONE
+            return None
+        if ch != '"':
+            self.broken = True
+            self._state = _DONE
+            return None
+        end = self._scan_string(self._pos)
+        if end is None:
+            return None
+        try:
+            # strict=False: модели иногда пишут переносы строк прямо внутри литерала
+            item = json.loads(buf[self._pos:end + 1], strict=False)
+        except ValueError:
+            self.broken = True
+            self._state = _DONE
+            return None
+        self._pos = end + 1
+        return item
+
+
+def _strip_fence(text: str) -> str:
+    """Текст без внешнего ```lang ... ``` блока."""
+    text = text.strip()
+    if not text.startswith("```"):
+        return text
+    body = text[3:]
+    # Тег языка (```json) — только латинское слово в начале; текст на той же
+    # строке (```текст ... или ```json{...}) остаётся в ответе
+    lang = _FENCE_LANG_RE.match(body).end()
+    rest = body[lang:]
+    if not rest.strip(" \t") or rest.lstrip(" \t")[0] in "\n{[":
+        body = rest
+    end = body.rfind("```")
+    if end >= 0:
+        body = body[:end]
+    if not body.strip():
+        # пустой блок (```\n```\nтекст) — берём то, что после последней ограды
+        return text[text.rfind("```") + 3:].strip()
+    return body.strip()
+
+
+def _load_outer_value(text: str) -> Any:
+    """json.loads куска от первой '{'/'[' до последней '}'/']' (None, если не JSON)."""
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        return None
+    start = min(starts)
+    end = max(text.rfind("}"), text.rfind("]"))
+    if end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1], strict=False)
+    except ValueError:
+        return None
+
+
+def _strings(values: list) -> List[str]:
+    return [str(it).strip() for it in values if str(it).strip()]
+
+
+def _items_from_value(value: Any, key: str) -> Optional[List[str]]:
+    if isinstance(value, list):
+        return _strings(value)
+    if not isinstance(value, dict):
+        return None
+    for name in (key,) + _FALLBACK_KEYS:
+        val = value.get(name)
+        if isinstance(val, list):
+            items = _strings(val)
+            if items:
+                return items
+        elif isinstance(val, str) and val.strip():
+            # {"response": "[\"...\"]"} — массив, упакованный в строку
+            inner = val.strip()
+            if inner.startswith("["):
+                try:
+                    nested = json.loads(inner, strict=False)
+                    if isinstance(nested, list):
+                        return _strings(nested)
+                except ValueError:
+                    pass
+            return [inner]
+    return None
+
+
+def parse_llm_output(text: Optional[str], key: str = "response") -> List[str]:
+    """Полный ответ модели -> список сообщений. Не бросает исключений.
+
+    Порядок: целый массив из ArrayStreamParser; иначе JSON по внешним скобкам
+    (объект с ответом в другом ключе, строка с массивом, нестроковые элементы);
+    иначе уже разобранные элементы оборванного массива; иначе весь текст одним
+    сообщением.
+    """
+    if not text or not text.strip():
+        return []
+    parser = ArrayStreamParser(key)
+    parser.feed(text)
+    if parser.completed:
+        items = _strings(parser.items)
+        if items:
+            return items
+
+    value = _load_outer_value(text)
+    if value is not None:
+        items = _items_from_value(value, key)
+        if items:
+            return items
+
+    if not parser.broken:
+        # оборванный ответ: берём всё, что успело прийти, включая недописанную строку
+        items = _strings(parser.items)
+        tail = parser.tail()
+        if tail and tail.strip():
+            items.append(tail.strip())
+        if items:
+            return items
+
+    plain = _strip_fence(text)
+    return [plain] if plain else []
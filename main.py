@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import time
+_PROCESS_START = time.monotonic()  # для отчёта о времени старта (включая импорты)
+
 import logging
 import asyncio
+import contextlib
 import os
 from datetime import timedelta
 import signal
@@ -26,7 +30,28 @@ import db
 import handlers
 import tasks
 import config
-from utils import escape_markdown_v2, format_visual_text
+import bot_routing
+import invalidation_bus
+import key_scheduler
+import llm_gateway
+import llm_router
+import group_relevance
+import context_window
+import context_summarizer
+import prompt_layout
+import gemini_cache
+import llm_payload
+import media_preprocess
+import llm_clients
+from http_auth import metrics_authorized
+from bot_registry import bot_registry
+from update_scheduler import update_scheduler, ACCEPTED, REJECTED_LANE_FULL
+from update_dedup import update_deduplicator
+from update_envelope import (
+    UpdateEnvelope, classify_update, set_current_envelope, reset_current_envelope,
+    KIND_CALLBACK, KIND_OTHER, KIND_TEXT,
+)
+from utils import escape_markdown_v2, format_visual_text, warm_up_tokenizer
 
 # ОПТИМИЗАЦИЯ: Импорт модулей оптимизации
 try:
@@ -42,278 +67,364 @@ from telegram.ext import (
     Application, Defaults, CommandHandler, MessageHandler, CallbackQueryHandler,
     ConversationHandler, ChatMemberHandler
 )
-from telegram import Update, BotCommand, Bot
+from telegram import Update, BotCommand
 from telegram.constants import ParseMode
 
-from flask import Flask, request, abort, Response
-from yookassa import Configuration as YookassaConfig
-from yookassa.domain.notification import WebhookNotification
 from hypercorn.asyncio import serve
 from hypercorn.config import Config as HypercornConfig
-from asgiref.wsgi import WsgiToAsgi
-import threading
-
-# --- Новые импорты для Telegra.ph ---
-from telegraph import Telegraph
-from telegraph.exceptions import TelegraphException
-from handlers import formatted_tos_text_for_bot
 
+# yookassa и telegraph импортируются лениво: на старте они не нужны
+from handlers import formatted_tos_text_for_bot, TEXT_IGNORING_MEDIA_REACTIONS
 
-# --- 1. Определение веб-сервера (Flask) ---
-flask_app = Flask(__name__)
-flask_logger = logging.getLogger('flask_webhook')
 
-@flask_app.get("/")
-def root_health():
-    return "ok", 200
-
-@flask_app.get("/healthz")
-def healthz():
-    return "ok", 200
-
-try:
-    if config.YOOKASSA_SHOP_ID and config.YOOKASSA_SECRET_KEY and config.YOOKASSA_SHOP_ID.isdigit():
-        YookassaConfig.configure(account_id=int(config.YOOKASSA_SHOP_ID), secret_key=config.YOOKASSA_SECRET_KEY)
-        flask_logger.info(f"Yookassa SDK configured for webhook (Shop ID: {config.YOOKASSA_SHOP_ID}).")
-    else:
-        flask_logger.warning("YOOKASSA_SHOP_ID or YOOKASSA_SECRET_KEY invalid/missing.")
-except Exception as e:
-    flask_logger.error(f"Failed to configure Yookassa SDK for webhook: {e}")
+# --- 1. Определение веб-сервера (нативный ASGI) ---
+# Вебхуки обрабатываются прямо в event loop PTB: без WSGI-моста, без потоков на запрос.
+webhook_logger = logging.getLogger('webhook')
 
 # Глобальные переменные для доступа к PTB Application и его event loop из вебхука
 application_instance: Application | None = None
 application_loop: asyncio.AbstractEventLoop | None = None
 # ОПТИМИЗИРОВАНО: Заменено threading.RLock на asyncio.Lock для лучшей производительности
 bot_swap_lock = asyncio.Lock()
+# Режим супервизора: индекс воркера (None — одиночный процесс). Фоновые задачи и настройку вебхука делает только воркер 0
+WORKER_INDEX = os.environ.get("WORKER_INDEX")
+IS_PRIMARY_WORKER = WORKER_INDEX in (None, "", "0")
+# Готовность к приёму апдейтов (для /readyz и проверок супервизора)
+_app_ready = False
+# Ссылки на фоновые задачи обработки апдейтов (иначе их может собрать GC до завершения)
+_background_tasks: set = set()
+
+
+def _spawn_background(coro) -> asyncio.Task:
+    """Запускает корутину в текущем loop и держит ссылку до её завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _read_body(receive) -> bytes:
+    """Читает тело HTTP-запроса целиком из ASGI receive."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message.get('type') == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def _send_response(send, status: int, body: bytes = b'', content_type: bytes = b'text/plain; charset=utf-8', extra_headers=None) -> None:
+    headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    if extra_headers:
+        headers.extend(extra_headers)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _drop_reason(envelope: UpdateEnvelope, route: bot_routing.BotRoute) -> str | None:
+    """Решает по конверту, можно ли отбросить апдейт без построения объектов PTB. None — обрабатывать."""
+    # ACL. Если отправителя нет (например, channel_post) — пропускаем проверку (не пользовательская инициатива)
+    if envelope.actor_id and not route.is_allowed(envelope.actor_id):
+        return f"access denied for user {envelope.actor_id} (access_level={route.access_level})"
+
+    main_bot_id = application_instance and application_instance.bot_data.get('main_bot_id')
+    is_main_bot = bool(main_bot_id) and str(main_bot_id) == str(route.telegram_bot_id or '')
+
+    # Главный бот: игнорируем НЕ-командные апдейты в НЕ-приватных чатах, кроме callback'ов.
+    # Разрешаем команды, кнопки и любые сообщения в приватных чатах (ввод токена и т.п.)
+    if is_main_bot and not envelope.is_command and envelope.kind != KIND_CALLBACK and not envelope.is_private:
+        return "non-command non-callback non-private update for main bot"
+
+    # Attached-боты: команды полностью запрещены
+    if main_bot_id and not is_main_bot and envelope.is_command:
+        return f"command {envelope.command} on attached bot"
+
+    # Сообщения без текста/фото/голоса (стикеры, сервисные и т.п.) — хендлеров для них нет
+    if envelope.kind == KIND_OTHER:
+        return "no handler for this update kind"
+
+    # Личность не реагирует на текст и заглушена в этом чате — handle_message ничего бы не сделал
+    if (envelope.kind == KIND_TEXT and route.media_reaction in TEXT_IGNORING_MEDIA_REACTIONS
+            and str(envelope.chat_id) in route.muted_chat_ids):
+        return f"text ignored by media_reaction={route.media_reaction} in muted chat"
+
+    return None
+
+
+def _get_header(scope, name: bytes) -> str | None:
+    name = name.lower()
+    for key, value in scope.get('headers') or []:
+        if key.lower() == name:
+            try:
+                return value.decode('latin-1')
+            except Exception:
+                return None
+    return None
+
 
-async def process_telegram_update(update_data, token: str, bot_username_for_log: str) -> None:
+async def process_telegram_update(update_data, token: str, bot_username_for_log: str, envelope: UpdateEnvelope | None = None) -> None:
     """Асинхронная функция для обработки одного Telegram-апдейта без подмены глобального бота.
-    Создаёт корректный Update с привязанным к нему Bot и передаёт его в PTB.
+    Берёт Bot из общего реестра (getMe один раз на токен) и передаёт Update в PTB.
+    Конверт предклассификации доступен хендлерам через update_envelope.current_envelope().
     """
     global application_instance
     if not application_instance:
         return
 
     try:
-        # Создаём экземпляр бота ТОЛЬКО для этого апдейта и инициализируем его
-        user_bot = Bot(token=token)
-        await user_bot.initialize()
+        # Инициализированный бот из общего реестра (общий HTTP-транспорт для всех ботов)
+        user_bot = await bot_registry.get(token)
         # Формируем Update, связанный с нужным ботом
         update = Update.de_json(update_data, user_bot)
-        # Передаём апдейт в PTB — он будет использовать update.bot
-        await application_instance.process_update(update)
+        # Передаём апдейт в PTB — он будет использовать update.bot.
+        # Хендлеры выполняются в этой же задаче (block=True), поэтому видят конверт через contextvar.
+        envelope_token = set_current_envelope(envelope)
+        try:
+            await application_instance.process_update(update)
+        finally:
+            reset_current_envelope(envelope_token)
     except Exception as e:
-        flask_logger.error(f"error processing telegram webhook for @{bot_username_for_log}: {e}", exc_info=True)
-    finally:
-        # Ничего не восстанавливаем — глобальное состояние не меняли
-        pass
+        webhook_logger.error(f"error processing telegram webhook for @{bot_username_for_log}: {e}", exc_info=True)
 
-@flask_app.route('/telegram/<string:token>', methods=['POST'])
-def handle_telegram_webhook(token: str):
-    """Синхронный обработчик, который запускает асинхронную обработку апдейта."""
-    global application_instance, application_loop
-    if not application_instance or application_loop is None:
-        flask_logger.error("telegram webhook received but application is not fully initialized.")
-        return Response(status=500)
 
-    # Проверка токена и секрета по БД
+def _self_heal_main_bot(token: str) -> None:
+    """Пересоздаёт/активирует BotInstance основного бота. Синхронная, вызывается через asyncio.to_thread."""
+    with db.get_db() as _s:
+        # владелец = первый админ
+        owner_tg_id = None
+        try:
+            owner_tg_id = (config.ADMIN_USER_ID[0] if getattr(config, 'ADMIN_USER_ID', None) else None)
+        except Exception:
+            owner_tg_id = None
+        if not owner_tg_id:
+            return
+        owner = _s.query(db.User).filter(db.User.telegram_id == owner_tg_id).first() or db.get_or_create_user(_s, owner_tg_id, username="admin")
+        persona = _s.query(db.PersonaConfig).filter(
+            db.PersonaConfig.owner_id == owner.id,
+            db.PersonaConfig.name == 'Main Bot'
+        ).first() or db.create_persona_config(_s, owner_id=owner.id, name='Main Bot', description='System main bot persona')
+        # Узнаем данные бота из application_instance
+        me_id = application_instance and application_instance.bot_data.get('main_bot_id')
+        me_username = application_instance and application_instance.bot_data.get('main_bot_username')
+        inst, st = db.set_bot_instance_token(_s, owner.id, persona.id, token, me_id or "", me_username or "")
+        try:
+            if inst is not None and hasattr(inst, 'access_level') and inst.access_level != 'public':
+                inst.access_level = 'public'
+                _s.commit()
+        except Exception:
+            _s.rollback()
+    bot_routing.invalidate(token=token)
+
+
+async def handle_telegram_webhook(scope, receive, send, token: str) -> None:
+    """Асинхронный обработчик вебхука Telegram: проверки и постановка апдейта в обработку в том же loop."""
+    global application_instance
+    if not application_instance or not _app_ready:
+        # Ещё стартуем (или уже останавливаемся): Telegram повторит доставку
+        webhook_logger.warning("telegram webhook received but application is not ready yet.")
+        await _send_response(send, 503, extra_headers=[(b'retry-after', str(config.UPDATE_BACKPRESSURE_RETRY_AFTER).encode())])
+        return
+
+    body = await _read_body(receive)
+
+    # Проверка токена и секрета по таблице маршрутизации (в БД идём только при промахе)
     try:
-        from db import get_db, BotInstance, User  # локальный импорт, чтобы избежать циклов
-        from sqlalchemy.orm import selectinload
-        with get_db() as db_session:
-            bot_instance = (
-                db_session.query(BotInstance)
-                .options(selectinload(BotInstance.owner))
-                .filter(BotInstance.bot_token == token)
-                .first()
-            )
+        route = await bot_routing.get_route(token)
     except Exception as e:
-        flask_logger.error(f"db error while fetching bot_instance for token ...{token[-6:]}: {e}")
-        return Response(status=500)
+        webhook_logger.error(f"db error while fetching bot_instance for token ...{token[-6:]}: {e}")
+        await _send_response(send, 500)
+        return
 
-    if not bot_instance or bot_instance.status != 'active':
+    if not route or not route.is_active:
         # Самовосстановление для основного бота: если токен совпадает, пытаемся заново создать/активировать инстанс
         try:
             if token == getattr(config, 'TELEGRAM_TOKEN', None):
-                flask_logger.warning("main bot token received but instance is unknown/inactive -> attempting self-heal upsert")
-                with db.get_db() as _s:
-                    # владелец = первый админ
-                    owner_tg_id = None
-                    try:
-                        owner_tg_id = (config.ADMIN_USER_ID[0] if getattr(config, 'ADMIN_USER_ID', None) else None)
-                    except Exception:
-                        owner_tg_id = None
-                    if owner_tg_id:
-                        owner = _s.query(db.User).filter(db.User.telegram_id == owner_tg_id).first() or db.get_or_create_user(_s, owner_tg_id, username="admin")
-                        persona = _s.query(db.PersonaConfig).filter(
-                            db.PersonaConfig.owner_id == owner.id,
-                            db.PersonaConfig.name == 'Main Bot'
-                        ).first() or db.create_persona_config(_s, owner_id=owner.id, name='Main Bot', description='System main bot persona')
-                        # Узнаем данные бота из application_instance
-                        me_id = application_instance and application_instance.bot_data.get('main_bot_id')
-                        me_username = application_instance and application_instance.bot_data.get('main_bot_username')
-                        inst, st = db.set_bot_instance_token(_s, owner.id, persona.id, token, me_id or "", me_username or "")
-                        try:
-                            if inst is not None and hasattr(inst, 'access_level') and inst.access_level != 'public':
-                                inst.access_level = 'public'
-                                _s.commit()
-                        except Exception:
-                            _s.rollback()
+                webhook_logger.warning("main bot token received but instance is unknown/inactive -> attempting self-heal upsert")
+                await asyncio.to_thread(_self_heal_main_bot, token)
                 # Возвращаем 200: Telegram перешлёт апдейты снова, а инстанс уже будет восстановлен
-                return Response(status=200)
+                await _send_response(send, 200)
+                return
         except Exception as _heal_err:
-            flask_logger.error(f"self-heal upsert for main bot failed: {_heal_err}", exc_info=True)
-        flask_logger.warning(f"webhook for unknown/inactive token ...{token[-6:]} (status={getattr(bot_instance, 'status', None)})")
-        return Response(status=404)
+            webhook_logger.error(f"self-heal upsert for main bot failed: {_heal_err}", exc_info=True)
+        webhook_logger.warning(f"webhook for unknown/inactive token ...{token[-6:]} (status={getattr(route, 'status', None)})")
+        await _send_response(send, 404)
+        return
 
-    secret_header = request.headers.get("X-Telegram-Bot-Api-Secret-Token") or request.headers.get("x-telegram-bot-api-secret-token")
-    if bot_instance.webhook_secret and secret_header != bot_instance.webhook_secret:
-        flask_logger.error(f"invalid secret for bot @{bot_instance.telegram_username} (id={bot_instance.telegram_bot_id})")
-        return Response(status=403)
+    secret_header = _get_header(scope, b"x-telegram-bot-api-secret-token")
+    if route.webhook_secret and secret_header != route.webhook_secret:
+        webhook_logger.error(f"invalid secret for bot @{route.telegram_username} (id={route.telegram_bot_id})")
+        await _send_response(send, 403)
+        return
 
     # Готовим апдейт
     try:
-        update_data = request.get_json(force=True)
+        update_data = json.loads(body)
     except Exception:
-        return Response(status=400)
+        await _send_response(send, 400)
+        return
+
+    if not isinstance(update_data, dict):
+        await _send_response(send, 400)
+        return
+
+    # --- Повторная доставка (Telegram не дождался 200) — отбрасываем до любой обработки ---
+    update_id = update_data.get('update_id')
+    if update_deduplicator.is_duplicate(route.bot_instance_id, update_id):
+        webhook_logger.info(f"skip duplicate update_id={update_id} for bot @{route.telegram_username}")
+        await _send_response(send, 200)
+        return
 
-    # --- ACL: проверка доступа ---
+    # --- Однопроходная предклассификация сырого JSON (до Update.de_json) ---
     try:
-        actor_id = None
-        if isinstance(update_data, dict):
-            # самые частые случаи
-            actor_id = (
-                update_data.get('message', {}).get('from', {}).get('id') or
-                update_data.get('edited_message', {}).get('from', {}).get('id') or
-                (update_data.get('callback_query', {}) or {}).get('from', {}).get('id') or
-                (update_data.get('my_chat_member', {}) or {}).get('from', {}).get('id') or
-                (update_data.get('chat_member', {}) or {}).get('from', {}).get('id')
-            )
+        envelope = classify_update(update_data, int(route.telegram_bot_id) if route.telegram_bot_id else None)
+    except Exception as e:
+        webhook_logger.error(f"failed to classify update_id={update_id}: {e}", exc_info=True)
+        await _send_response(send, 200)
+        return
 
-        # Если не нашли отправителя (например, channel_post) — просто пропускаем ACL (не пользовательская инициатива)
-        if actor_id:
-            owner_tg_id = bot_instance.owner.telegram_id if bot_instance.owner else None
-            access_level = (bot_instance.access_level or 'owner_only').lower()
+    drop_reason = _drop_reason(envelope, route)
+    if drop_reason:
+        webhook_logger.info(f"skip update_id={update_id} for bot @{route.telegram_username}: {drop_reason}")
+        await _send_response(send, 200)
+        return
 
-            allowed = False
-            # 1) Полный доступ для админов системы независимо от владения ботом/ACL
-            try:
-                if int(actor_id) in (getattr(config, 'ADMIN_USER_ID', []) or []):
-                    allowed = True
-            except Exception:
-                pass
-            # 2) Владелец бота
-            if not allowed and owner_tg_id and int(actor_id) == int(owner_tg_id):
-                allowed = True  # владелец всегда имеет доступ
-            # 3) Режимы доступа
-            elif not allowed and access_level == 'public':
-                allowed = True
-            elif not allowed and access_level == 'owner_only':
-                allowed = False
-            elif not allowed and access_level == 'whitelist':
-                try:
-                    import json as _json
-                    wl = _json.loads(bot_instance.whitelisted_users_json or '[]')
-                    wl_ids = {int(x) for x in wl if str(x).strip()}
-                    allowed = int(actor_id) in wl_ids
-                except Exception:
-                    allowed = False
-
-            if not allowed:
-                # молча игнорируем апдейт для неавторизованных пользователей
-                flask_logger.info(
-                    f"access denied for user {actor_id} on bot @{bot_instance.telegram_username} (access_level={access_level})"
-                )
-                return Response(status=200)
+    # Ставим апдейт в планировщик: глобальный лимит + последовательная полоса на чат
+    try:
+        username_for_log = route.telegram_username or "unknown"
+        result = update_scheduler.submit(
+            envelope.chat_id,
+            lambda: process_telegram_update(update_data, token, username_for_log, envelope),
+        )
     except Exception as e:
-        flask_logger.error(f"acl check failed (fallback to deny): {e}", exc_info=True)
-        return Response(status=200)
+        webhook_logger.error(f"failed to schedule telegram update processing: {e}")
+        update_deduplicator.forget(route.bot_instance_id, update_id)
+        await _send_response(send, 500)
+        return
+    if result != ACCEPTED:
+        # Апдейт не принят — Telegram пришлёт его снова, это не должно считаться дублем
+        update_deduplicator.forget(route.bot_instance_id, update_id)
+        # Перегрузка: Telegram повторит доставку позже
+        webhook_logger.warning(f"update scheduler saturated ({result}) for @{route.telegram_username}; depth={update_scheduler.depth}")
+        await _send_response(
+            send,
+            429 if result == REJECTED_LANE_FULL else 503,
+            extra_headers=[(b'retry-after', str(config.UPDATE_BACKPRESSURE_RETRY_AFTER).encode())],
+        )
+        return
+
+    if envelope.kind == KIND_TEXT and envelope.is_group:
+        # отметка для окна решений «отвечать ли»: соседние сообщения ещё ждут в полосе чата
+        group_relevance.note_incoming(envelope.chat_id, envelope.message_id, (update_data.get('message') or {}).get('text') or '')
+
+    # Возвращаем 200 сразу; обработка идет в фоне
+    await _send_response(send, 200)
 
-    # --- Disable commands on attached (non-main) bots, except a small allowlist ---
+
+def _credit_user_for_payment(telegram_user_id: int, pkg_id, credits_to_add: float, payment_id: str):
+    """Идемпотентно начисляет кредиты (ledger по payment_id + атомарный UPDATE). Синхронная, через asyncio.to_thread.
+    Возвращает (status, credits_to_add, new_balance)."""
+    if credits_to_add <= 0:
+        # Попытка определить из конфига по package_id
+        try:
+            if pkg_id and pkg_id in (config.CREDIT_PACKAGES or {}):
+                credits_to_add = float(config.CREDIT_PACKAGES[pkg_id]['credits'])
+        except Exception:
+            pass
+
+    with db.get_db() as db_session:
+        status, new_balance = db.apply_payment_credit(db_session, payment_id, telegram_user_id, float(credits_to_add or 0), package_id=pkg_id)
+
+    if status == "credited":
+        webhook_logger.info(f"Credited {credits_to_add} credits to user {telegram_user_id} via webhook (payment {payment_id}). New balance: {new_balance}")
+    elif status == "duplicate":
+        webhook_logger.info(f"Webhook: payment {payment_id} for user {telegram_user_id} was already credited, ignoring redelivery.")
+    elif status == "user_not_found":
+        webhook_logger.error(f"Webhook: user {telegram_user_id} not found for payment {payment_id}.")
+    return status, credits_to_add, new_balance
+
+
+# Очередь уведомлений о пополнении: ответ YooKassa не ждёт отправки сообщения в Telegram
+_topup_notifications: asyncio.Queue | None = None
+
+
+def _enqueue_topup_notification(telegram_user_id: int, pkg_id, credits_to_add: float, new_balance: float) -> None:
+    if _topup_notifications is None:
+        # Воркер не запущен (например, polling-режим) — отправляем отдельной задачей
+        _spawn_background(_notify_user_about_topup(telegram_user_id, pkg_id, credits_to_add, new_balance))
+        return
+    _topup_notifications.put_nowait((telegram_user_id, pkg_id, credits_to_add, new_balance))
+
+
+async def topup_notification_worker() -> None:
+    """Последовательно отправляет уведомления о пополнении из очереди."""
+    global _topup_notifications
+    _topup_notifications = asyncio.Queue()
     try:
-        is_command_update = False
-        is_callback_update = False
-        is_private_chat = False
-        text = ''
-        if isinstance(update_data, dict):
-            # message/edited_message branch
-            msg = update_data.get('message') or update_data.get('edited_message')
-            if msg:
-                entities = msg.get('entities') or []
-                text = msg.get('text') or ''
-                is_command_update = any((e or {}).get('type') == 'bot_command' for e in entities) or text.startswith('/')
-                try:
-                    chat_type_val = ((msg.get('chat') or {}).get('type'))
-                    is_private_chat = str(chat_type_val) == 'private'
-                except Exception:
-                    is_private_chat = False
-            # callback_query branch (нажатия на inline-кнопки)
-            if update_data.get('callback_query'):
-                is_callback_update = True
-
-        main_bot_id = application_instance and application_instance.bot_data.get('main_bot_id')
-        current_bot_id = bot_instance.telegram_bot_id
-        # 0) Главный бот: игнорируем только НЕ-командные апдейты в НЕ-приватных чатах и не callback'и
-        #    Разрешаем:
-        #      - команды
-        #      - callback_query (кнопки)
-        #      - любые сообщения в приватных чатах (для ввода токена и т.п.)
-        if (not is_command_update) and (not is_callback_update) and (not is_private_chat) and \
-           main_bot_id and str(main_bot_id) == str(current_bot_id or ''):
-            flask_logger.info(
-                f"skip non-command non-callback non-private update for main bot @{bot_instance.telegram_username} (id={current_bot_id})"
-            )
-            return Response(status=200)
-        # 1) Attached-боты: блокируем команды, кроме allowlist
-        if is_command_update and main_bot_id and str(main_bot_id) != str(current_bot_id or ''):
-            # Полный запрет команд на attached-ботах
-            allowed_on_attached = set()
-            cmd_name = None
+        while True:
+            item = await _topup_notifications.get()
             try:
-                first_token = (text or '').split()[0].lower()
-                # учитываем формат /cmd@username
-                cmd_name = first_token.split('@')[0]
-            except Exception:
-                cmd_name = None
-            if cmd_name not in allowed_on_attached:
-                flask_logger.info(
-                    f"skip command update for attached bot @{bot_instance.telegram_username} (bot_id={current_bot_id}, main_id={main_bot_id})"
-                )
-                return Response(status=200)
-    except Exception as e:
-        flask_logger.error(f"error while checking command disable for attached bots: {e}")
+                await _notify_user_about_topup(*item)
+            finally:
+                _topup_notifications.task_done()
+    finally:
+        _topup_notifications = None
 
-    # Планируем асинхронную обработку апдейта в event loop PTB
+
+async def _notify_user_about_topup(telegram_user_id: int, pkg_id, credits_to_add: float, new_balance: float) -> None:
+    """Отправляет пользователю уведомление о пополнении баланса."""
+    if not application_instance:
+        return
     try:
-        asyncio.run_coroutine_threadsafe(
-            process_telegram_update(update_data, token, bot_instance.telegram_username or "unknown"),
-            application_loop
+        pkg_title = None
+        try:
+            if pkg_id and pkg_id in (config.CREDIT_PACKAGES or {}):
+                pkg_title = config.CREDIT_PACKAGES[pkg_id].get('title')
+        except Exception:
+            pkg_title = None
+        credited_part = f"зачислено {credits_to_add:.0f} кредитов" if credits_to_add else "оплата успешно проведена"
+        pkg_part = f" ({pkg_title})" if pkg_title else ""
+        success_text_raw = (
+            f"{credited_part}{pkg_part}.\n"
+            f"текущий баланс: {new_balance:.2f} кредитов.\n\n"
+            f"спасибо за поддержку"
         )
-    except Exception as e:
-        flask_logger.error(f"failed to schedule telegram update processing: {e}")
-        return Response(status=500)
+        prepared = format_visual_text(success_text_raw)
+        success_text_escaped = escape_markdown_v2(prepared)
+        await application_instance.bot.send_message(
+            chat_id=telegram_user_id,
+            text=success_text_escaped,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    except Exception as notify_e:
+        webhook_logger.error(f"Failed to notify user {telegram_user_id} about credit top-up: {notify_e}")
 
-    # Возвращаем 200 сразу; обработка идет в фоне
-    return Response(status=200)
 
-@flask_app.route('/yookassa/webhook', methods=['POST'])
-def handle_yookassa_webhook():
-    """Обработчик вебхуков от YooKassa."""
-    global application_instance, application_loop
-    event_json = None
+async def handle_yookassa_webhook(scope, receive, send) -> None:
+    """Обработчик вебхуков от YooKassa. Идемпотентен: повторная доставка того же платежа ничего не начисляет."""
+    if not _app_ready:
+        # БД ещё не инициализирована — YooKassa повторит уведомление
+        await _send_response(send, 503)
+        return
     try:
-        event_json = request.get_json(force=True)
-        # (Весь ваш код для обработки вебхука остается здесь без изменений)
-        # Для краткости я его сокращу, но у вас он должен быть полностью
+        from yookassa.domain.notification import WebhookNotification
+        event_json = json.loads(await _read_body(receive))
         notification_object = WebhookNotification(event_json)
         payment = notification_object.object
-        flask_logger.info(f"Processing event: {notification_object.event}, Payment ID: {payment.id}, Status: {payment.status}")
+        webhook_logger.info(f"Processing event: {notification_object.event}, Payment ID: {payment.id}, Status: {payment.status}")
 
         if notification_object.event == 'payment.succeeded' and payment.status == 'succeeded':
             metadata = payment.metadata or {}
             if 'telegram_user_id' not in metadata:
-                flask_logger.error(f"Webhook error: 'telegram_user_id' missing in metadata for payment {payment.id}.")
-                return Response(status=200)
+                webhook_logger.error(f"Webhook error: 'telegram_user_id' missing in metadata for payment {payment.id}.")
+                await _send_response(send, 200)
+                return
 
             telegram_user_id = int(metadata['telegram_user_id'])
             pkg_id = metadata.get('package_id')
@@ -323,58 +434,91 @@ def handle_yookassa_webhook():
             except Exception:
                 credits_to_add = 0.0
 
-            # Начисление кредитов в БД
-            with db.get_db() as db_session:
-                user = db_session.query(db.User).filter(db.User.telegram_id == telegram_user_id).first()
-                if not user:
-                    flask_logger.error(f"Webhook: user {telegram_user_id} not found for payment {payment.id}.")
-                    return Response(status=200)
-
-                if credits_to_add <= 0:
-                    # Попытка определить из конфига по package_id
-                    try:
-                        if pkg_id and pkg_id in (config.CREDIT_PACKAGES or {}):
-                            credits_to_add = float(config.CREDIT_PACKAGES[pkg_id]['credits'])
-                    except Exception:
-                        pass
-
-                user.credits = float(user.credits or 0) + float(credits_to_add or 0)
-                db_session.commit()
-
-                flask_logger.info(f"Credited {credits_to_add} credits to user {telegram_user_id} via webhook. New balance: {user.credits}")
-
-                # Отправка уведомления пользователю
-                if application_instance:
-                    try:
-                        pkg_title = None
-                        try:
-                            if pkg_id and pkg_id in (config.CREDIT_PACKAGES or {}):
-                                pkg_title = config.CREDIT_PACKAGES[pkg_id].get('title')
-                        except Exception:
-                            pkg_title = None
-                        credited_part = f"зачислено {credits_to_add:.0f} кредитов" if credits_to_add else "оплата успешно проведена"
-                        pkg_part = f" ({pkg_title})" if pkg_title else ""
-                        success_text_raw = (
-                            f"{credited_part}{pkg_part}.\n"
-                            f"текущий баланс: {user.credits:.2f} кредитов.\n\n"
-                            f"спасибо за поддержку"
-                        )
-                        prepared = format_visual_text(success_text_raw)
-                        success_text_escaped = escape_markdown_v2(prepared)
-                        asyncio.run_coroutine_threadsafe(
-                            application_instance.bot.send_message(
-                                chat_id=telegram_user_id,
-                                text=success_text_escaped,
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            ),
-                            application_loop
-                        )
-                    except Exception as notify_e:
-                        flask_logger.error(f"Failed to notify user {telegram_user_id} about credit top-up: {notify_e}")
-        return Response(status=200)
+            # Начисление кредитов в БД (вне event loop)
+            status, credited, new_balance = await asyncio.to_thread(_credit_user_for_payment, telegram_user_id, pkg_id, credits_to_add, payment.id)
+            if status == "error":
+                # Ничего не начислено — просим YooKassa повторить доставку
+                await _send_response(send, 500)
+                return
+            if status == "credited":
+                _enqueue_topup_notification(telegram_user_id, pkg_id, credited, new_balance)
+        await _send_response(send, 200)
     except Exception as e:
-        flask_logger.error(f"Unexpected error in webhook handler: {e}", exc_info=True)
-        abort(500)
+        webhook_logger.error(f"Unexpected error in webhook handler: {e}", exc_info=True)
+        await _send_response(send, 500)
+
+
+async def webhook_asgi_app(scope, receive, send) -> None:
+    """Минимальное ASGI-приложение: health-проверки, вебхуки Telegram и YooKassa."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    path = scope.get('path') or '/'
+    method = scope.get('method', 'GET').upper()
+
+    if path in ('/', '/healthz'):
+        if method in ('GET', 'HEAD'):
+            await _send_response(send, 200, b'ok')
+        else:
+            await _send_response(send, 405)
+        return
+
+    if path == '/readyz':
+        await _send_response(send, 200 if _app_ready else 503, b'ready' if _app_ready else b'starting')
+        return
+
+    if path == '/metrics':
+        # Тот же публичный порт, что и вебхуки: без METRICS_TOKEN статистику не отдаём
+        if not metrics_authorized(scope):
+            await _send_response(send, 403)
+            return
+        metrics = {
+            "update_scheduler": update_scheduler.stats(),
+            "bot_registry": bot_registry.stats(),
+            "update_dedup": update_deduplicator.stats(),
+            "invalidation_bus": invalidation_bus.stats(),
+            "llm_http": llm_clients.stats(),
+            "api_keys": key_scheduler.stats(),
+            "llm_gateway": llm_gateway.stats(),
+            "llm_router": llm_router.stats(),
+            "group_prefilter": group_relevance.stats(),
+            "context_window": context_window.stats(),
+            "context_summarizer": context_summarizer.stats(),
+            "prompt_layout": prompt_layout.stats(),
+            "gemini_cache": gemini_cache.stats(),
+            "llm_payload": llm_payload.stats(),
+            "media_preprocess": media_preprocess.stats(),
+        }
+        await _send_response(send, 200, json.dumps(metrics).encode(), content_type=b'application/json')
+        return
+
+    if path.startswith('/telegram/'):
+        token = path[len('/telegram/'):]
+        if not token or '/' in token:
+            await _send_response(send, 404)
+            return
+        if method != 'POST':
+            await _send_response(send, 405)
+            return
+        await handle_telegram_webhook(scope, receive, send, token)
+        return
+
+    if path == '/yookassa/webhook':
+        if method != 'POST':
+            await _send_response(send, 405)
+            return
+        await handle_yookassa_webhook(scope, receive, send)
+        return
+
+    await _send_response(send, 404)
 
 
 async def create_or_update_tos_page(application: Application) -> None:
@@ -383,13 +527,18 @@ async def create_or_update_tos_page(application: Application) -> None:
         logger.warning("TELEGRAPH_ACCESS_TOKEN not set. Cannot create or update ToS page.")
         return
 
+    from telegraph import Telegraph
+    from telegraph.exceptions import TelegraphException
+
     try:
         telegraph = Telegraph(access_token=config.TELEGRAPH_ACCESS_TOKEN)
         
         # Заменяем переносы строк на тег <p> для лучшего форматирования
         html_content = "".join(f"<p>{line}</p>" for line in formatted_tos_text_for_bot.splitlines() if line.strip())
         
-        response = telegraph.create_page(
+        # Клиент telegraph синхронный — выполняем вне event loop
+        response = await asyncio.to_thread(
+            telegraph.create_page,
             title="Пользовательское соглашение",
             html_content=html_content,
             author_name=config.TELEGRAPH_AUTHOR_NAME,
@@ -406,37 +555,230 @@ async def create_or_update_tos_page(application: Application) -> None:
         logger.error(f"An unexpected error occurred while creating ToS page: {e}", exc_info=True)
 
 
+class _StartupTimer:
+    """Замеры этапов старта; отчёт пишется в лог одной строкой на фазу."""
+
+    def __init__(self):
+        self.stages: list = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.monotonic() - started))
+
+    async def timed(self, name: str, awaitable):
+        with self.stage(name):
+            return await awaitable
+
+    def report(self, phase: str) -> None:
+        parts = ", ".join(f"{name}={elapsed * 1000:.0f}ms" for name, elapsed in self.stages)
+        logger.info(f"startup timing [{phase}] t+{(time.monotonic() - _PROCESS_START) * 1000:.0f}ms: {parts}")
+        self.stages = []
+
+
+def _init_database(startup: _StartupTimer) -> None:
+    """Критичная часть старта, синхронная (вызывается через asyncio.to_thread)."""
+    with startup.stage("db_engine"):
+        db.initialize_database()
+    with startup.stage("db_schema"):
+        # create_all только если миграции не применены: на живой БД это десятки запросов к каталогу
+        if not db.schema_is_current():
+            db.create_tables()
+    with startup.stage("routing_table"):
+        try:
+            bot_routing.load_all()
+        except Exception as e:
+            logger.error(f"Failed to preload bot routing table: {e}", exc_info=True)
+    with startup.stage("api_keys"):
+        try:
+            key_scheduler.load_all()
+        except Exception as e:
+            logger.error(f"Failed to load API keys: {e}", exc_info=True)
+
+
+def _upsert_main_bot_instance(bot_id, bot_username) -> tuple[int, str | None] | None:
+    """Авто-upsert BotInstance главного бота. Синхронная, вызывается через asyncio.to_thread.
+
+    Возвращает (id инстанса, текущий webhook_secret) или None, если владельца нет.
+    """
+    with db.get_db() as db_session:
+        # Определяем владельца: используем первого ADMIN_USER_ID, если задан
+        owner_tg_id = None
+        try:
+            owner_tg_id = (config.ADMIN_USER_ID[0] if getattr(config, 'ADMIN_USER_ID', None) else None)
+        except Exception:
+            owner_tg_id = None
+
+        if not owner_tg_id:
+            logger.warning("ADMIN_USER_ID пуст. Пропускаю авто-upsert главного бота (нет владельца).")
+            return None
+
+        # Получаем/создаем пользователя-владельца
+        user = db_session.query(db.User).filter(db.User.telegram_id == owner_tg_id).first()
+        if not user:
+            user = db.get_or_create_user(db_session, owner_tg_id, username="admin")
+            db_session.commit();
+            try:
+                db_session.refresh(user)
+            except Exception:
+                pass
+
+        # Получаем/создаем специальную персону для главного бота
+        persona = db_session.query(db.PersonaConfig).filter(
+            db.PersonaConfig.owner_id == user.id,
+            db.PersonaConfig.name == 'Main Bot'
+        ).first()
+        if not persona:
+            persona = db.create_persona_config(db_session, owner_id=user.id, name='Main Bot', description='System main bot persona')
+            db_session.commit();
+            try:
+                db_session.refresh(persona)
+            except Exception:
+                pass
+
+        # Создаем/обновляем BotInstance для главного бота
+        instance, status = db.set_bot_instance_token(
+            db_session,
+            owner_id=user.id,
+            persona_config_id=persona.id,
+            token=config.TELEGRAM_TOKEN,
+            bot_id=bot_id,
+            bot_username=bot_username
+        )
+        if instance is None:
+            return None
+        # Делаем главный бот публичным
+        try:
+            if hasattr(instance, 'access_level') and instance.access_level != 'public':
+                instance.access_level = 'public'
+                db_session.commit()
+        except Exception:
+            db_session.rollback()
+        return instance.id, getattr(instance, 'webhook_secret', None)
+
+
+def _record_main_bot_webhook(instance_id: int, secret: str | None, ok: bool) -> None:
+    """Сохраняет секрет/время/статус после set_webhook. Синхронная, вызывается через asyncio.to_thread."""
+    from datetime import datetime, timezone as _tz
+    with db.get_db() as db_session:
+        try:
+            instance = db_session.get(db.BotInstance, instance_id)
+            if instance is None:
+                return
+            if ok:
+                instance.webhook_secret = secret
+                instance.last_webhook_set_at = datetime.now(_tz.utc)
+                instance.status = 'active'
+            else:
+                instance.status = 'webhook_error'
+            db_session.commit()
+        except Exception as e_commit:
+            logger.error(f"Auto-upsert main bot: commit failed after set_webhook: {e_commit}", exc_info=True)
+            db_session.rollback()
+
+
+async def _setup_main_bot_webhook(application: Application, me) -> None:
+    """Авто-upsert BotInstance главного бота и установка его вебхука (только воркер 0).
+
+    Запросы к БД идут в потоке: к этому моменту вебхуки уже обслуживаются в этом loop.
+    """
+    # --- Авто-upsert главного бота в БД и установка вебхука ---
+    try:
+        if not config.WEBHOOK_URL_BASE:
+            logger.warning("WEBHOOK_URL_BASE не задан, пропускаю авто-настройку вебхука для главного бота.")
+            return
+        if not IS_PRIMARY_WORKER:
+            logger.info(f"worker #{WORKER_INDEX}: авто-настройку вебхука главного бота выполняет воркер 0.")
+            return
+
+        upserted = await asyncio.to_thread(_upsert_main_bot_instance, me.id, me.username)
+        if upserted is None:
+            return
+        instance_id, existing_secret = upserted
+
+        # Устанавливаем webhook для главного бота
+        webhook_url = f"{config.WEBHOOK_URL_BASE}/telegram/{config.TELEGRAM_TOKEN}"
+        # Переиспользуем существующий секрет: при рестарте (в т.ч. rolling restart воркеров)
+        # другие процессы продолжают принимать апдейты со старым секретом
+        secret = existing_secret or str(uuid.uuid4())
+        try:
+            await application.bot.set_webhook(
+                url=webhook_url,
+                allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"],
+                secret_token=secret
+            )
+            webhook_ok = True
+            logger.info(f"Main bot webhook set to {webhook_url}")
+        except Exception as e_webhook:
+            webhook_ok = False
+            logger.error(f"Failed to set webhook for main bot @{me.username}: {e_webhook}", exc_info=True)
+        await asyncio.to_thread(_record_main_bot_webhook, instance_id, secret, webhook_ok)
+        # Секрет/статус/доступ могли измениться — сбрасываем запись маршрутизации
+        bot_routing.invalidate(token=config.TELEGRAM_TOKEN)
+    except Exception as e_auto:
+        logger.error(f"Auto-upsert of main bot failed: {e_auto}", exc_info=True)
+
+
+async def _background_init(application: Application, me, commands, startup: _StartupTimer, setup_webhook: bool) -> None:
+    """Некритичная инициализация после того, как бот уже принимает апдейты. Этапы идут параллельно."""
+    stages = [
+        startup.timed("tos_page", create_or_update_tos_page(application)),
+        startup.timed("yookassa_sdk", asyncio.to_thread(handlers.ensure_yookassa_configured)),
+        startup.timed("tokenizer", asyncio.to_thread(warm_up_tokenizer)),
+    ]
+    if IS_PRIMARY_WORKER:
+        stages.append(startup.timed("set_my_commands", application.bot.set_my_commands(commands)))
+    if setup_webhook:
+        stages.append(startup.timed("main_bot_webhook", _setup_main_bot_webhook(application, me)))
+    if handlers.VOSK_AVAILABLE:
+        stages.append(startup.timed("vosk_model", asyncio.to_thread(handlers.load_vosk_model, handlers.VOSK_MODEL_PATH)))
+    if OPTIMIZATION_ENABLED:
+        stages.append(startup.timed("cache_warm_up", warm_up_cache()))
+
+    results = await asyncio.gather(*stages, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"background init stage failed: {result}", exc_info=result)
+    startup.report("background init")
+
+
 # --- 2. Основная асинхронная функция запуска ---
 async def main():
-    """Запускает бота и веб-сервер в одной асинхронной среде."""
-    
-    # --- Инициализация БД ---
-    logger.info("Initializing database...")
-    try:
-        db.initialize_database()
-        db.create_tables()
-        logger.info("Database initialized successfully.")
-    except Exception as e:
-        logger.critical(f"FATAL: Database initialization failed: {e}", exc_info=True)
-        return
+    """Запускает бота и веб-сервер в одной асинхронной среде.
+
+    Порядок старта: сборка приложения -> сразу слушаем порт (/readyz отвечает 503) ->
+    параллельно БД и getMe -> приём апдейтов -> в фоне ToS, команды, вебхук, Vosk и т.п.
+    """
+    startup = _StartupTimer()
+    startup.stages.append(("imports", time.monotonic() - _PROCESS_START))
+
+    # Режим запуска: webhook (по умолчанию для Railway) или polling
+    run_mode = os.environ.get("RUN_MODE", "webhook").strip().lower()
+    logger.info(f"RUN_MODE={run_mode}")
 
     # --- Создание экземпляра бота ---
     logger.info("Building PTB application...")
-    global application_instance
+    global application_instance, application_loop, _app_ready
     
+    build_started = time.monotonic()
     # Создаем билдер
     builder = Application.builder().token(config.TELEGRAM_TOKEN)
-    
+
     # Настраиваем параметры
     # ОПТИМИЗИРОВАНО: Увеличены пулы и таймауты для лучшей производительности
-    builder.defaults(Defaults(parse_mode=ParseMode.MARKDOWN_V2, block=False))
+    # block=True: process_update дожидается хендлеров, иначе полосы update_scheduler не сохраняли бы порядок.
+    # Параллелизм ограничивает сам планировщик (webhook) или concurrent_updates (polling).
+    builder.defaults(Defaults(parse_mode=ParseMode.MARKDOWN_V2, block=True))
     builder.pool_timeout(30.0).connect_timeout(30.0).read_timeout(30.0).write_timeout(30.0)
     builder.connection_pool_size(config.CONNECTION_POOL_SIZE)  # Используем настройку из конфига (100)
-    
+
     # Включаем параллельную обработку апдейтов (PTB создаёт независимые задачи на апдейты)
     try:
-        builder.concurrent_updates(True)
-        logger.info("PTB: concurrent updates enabled")
+        builder.concurrent_updates(config.MAX_CONCURRENT_UPDATES)
+        logger.info(f"PTB: concurrent updates enabled (limit={config.MAX_CONCURRENT_UPDATES})")
     except Exception as cu_err:
         logger.warning(f"PTB: failed to enable concurrent updates: {cu_err}")
 
@@ -444,9 +786,6 @@ async def main():
     application = builder.build()
     application_instance = application # Сохраняем для вебхука
 
-    # --- Публикация ToS ---
-    await create_or_update_tos_page(application)
-
     # --- Регистрация хендлеров ---
     # (Вся ваша логика регистрации ConversationHandler, CommandHandler и т.д.)
     # --- Conversation Handlers Definition ---
@@ -580,31 +919,62 @@ async def main():
     application.add_handler(CallbackQueryHandler(handlers.handle_callback_query))
     application.add_error_handler(handlers.error_handler)
     logger.info("All handlers registered.")
+    startup.stages.append(("build_application", time.monotonic() - build_started))
+
+    # Подготовка к graceful shutdown
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+    except NotImplementedError:
+        # На Windows сигналов может не быть — игнорируем
+        pass
+    application_loop = loop
+
+    web_server_task = None
+    if run_mode == 'webhook':
+        # Порт слушаем сразу: пока идёт инициализация, /readyz и вебхуки отвечают 503 + Retry-After
+        port = int(os.environ.get("PORT", 8080))
+        hypercorn_config = HypercornConfig()
+        hypercorn_config.bind = [f"{os.environ.get('BIND_HOST', '0.0.0.0')}:{port}"]
+        web_server_task = asyncio.create_task(serve(webhook_asgi_app, hypercorn_config))
+        logger.info(f"Web server listening on port {port} (webhook mode), initializing...")
+
+    # --- Критичная инициализация: БД и getMe параллельно ---
+    logger.info("Initializing database and bot...")
+    try:
+        await asyncio.gather(
+            startup.timed("database", asyncio.to_thread(_init_database, startup)),
+            # Bot.initialize() делает getMe; результат потом берём из application.bot.bot
+            startup.timed("bot_initialize", application.initialize()),
+        )
+        logger.info("Database initialized successfully.")
+    except Exception as e:
+        logger.critical(f"FATAL: startup initialization failed: {e}", exc_info=True)
+        if web_server_task:
+            web_server_task.cancel()
+        with contextlib.suppress(Exception):
+            await application.shutdown()
+        return
 
     # --- Запуск фоновых задач и веб-сервера в контексте приложения ---
     async with application:
-        # Инициализация приложения
-        await application.initialize()
-        
-        # ОПТИМИЗАЦИЯ: Инициализация кеша и прогрев
+        # ОПТИМИЗАЦИЯ: Инициализация кеша (прогрев — в фоне)
         if OPTIMIZATION_ENABLED:
             try:
                 await init_cache()
                 logger.info("Cache manager initialized")
-                await warm_up_cache()
-                logger.info("Cache warmed up")
             except Exception as e:
                 logger.error(f"Failed to initialize optimization: {e}")
 
-        # Режим запуска: webhook (по умолчанию для Railway) или polling
-        run_mode = os.environ.get("RUN_MODE", "webhook").strip().lower()
-        logger.info(f"RUN_MODE={run_mode}")
-
         # Общая пост-инициализация
-        me = await application.bot.get_me()
+        me = application.bot.bot
         logger.info(f"Bot started as @{me.username} (ID: {me.id})")
         application.bot_data['bot_username'] = me.username
         application.bot_data['main_bot_id'] = me.id
+        # Главный бот уже инициализирован — закрепляем его в реестре, чтобы вебхук не создавал второй экземпляр
+        bot_registry.pin(config.TELEGRAM_TOKEN, application.bot)
         commands = [
             BotCommand("start", "начало работы"),
             BotCommand("menu", "главное меню"),
@@ -613,141 +983,41 @@ async def main():
             BotCommand("buycredits", "пополнить кредиты"),
             BotCommand("botsettings", "настройки бота (ACL)"),
         ]
-        await application.bot.set_my_commands(commands)
-        logger.info("Bot menu commands set.")
-
-        # --- Авто-upsert главного бота в БД и установка вебхука ---
-        try:
-            if not config.WEBHOOK_URL_BASE:
-                logger.warning("WEBHOOK_URL_BASE не задан, пропускаю авто-настройку вебхука для главного бота.")
-            else:
-                with db.get_db() as db_session:
-                    # Определяем владельца: используем первого ADMIN_USER_ID, если задан
-                    owner_tg_id = None
-                    try:
-                        owner_tg_id = (config.ADMIN_USER_ID[0] if getattr(config, 'ADMIN_USER_ID', None) else None)
-                    except Exception:
-                        owner_tg_id = None
-
-                    if not owner_tg_id:
-                        logger.warning("ADMIN_USER_ID пуст. Пропускаю авто-upsert главного бота (нет владельца).")
-                    else:
-                        # Получаем/создаем пользователя-владельца
-                        user = db_session.query(db.User).filter(db.User.telegram_id == owner_tg_id).first()
-                        if not user:
-                            user = db.get_or_create_user(db_session, owner_tg_id, username="admin")
-                            db_session.commit();
-                            try:
-                                db_session.refresh(user)
-                            except Exception:
-                                pass
-
-                        # Получаем/создаем специальную персону для главного бота
-                        persona = db_session.query(db.PersonaConfig).filter(
-                            db.PersonaConfig.owner_id == user.id,
-                            db.PersonaConfig.name == 'Main Bot'
-                        ).first()
-                        if not persona:
-                            persona = db.create_persona_config(db_session, owner_id=user.id, name='Main Bot', description='System main bot persona')
-                            db_session.commit();
-                            try:
-                                db_session.refresh(persona)
-                            except Exception:
-                                pass
-
-                        # Создаем/обновляем BotInstance для главного бота
-                        instance, status = db.set_bot_instance_token(
-                            db_session,
-                            owner_id=user.id,
-                            persona_config_id=persona.id,
-                            token=config.TELEGRAM_TOKEN,
-                            bot_id=me.id,
-                            bot_username=me.username
-                        )
-                        # Делаем главный бот публичным
-                        try:
-                            if instance is not None and hasattr(instance, 'access_level') and instance.access_level != 'public':
-                                instance.access_level = 'public'
-                                db_session.commit()
-                        except Exception:
-                            db_session.rollback()
-
-                        # Устанавливаем webhook для главного бота
-                        webhook_url = f"{config.WEBHOOK_URL_BASE}/telegram/{config.TELEGRAM_TOKEN}"
-                        secret = str(uuid.uuid4())
-                        try:
-                            await application.bot.set_webhook(
-                                url=webhook_url,
-                                allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"],
-                                secret_token=secret
-                            )
-                            # Сохраняем секрет/время/статус
-                            from datetime import datetime, timezone as _tz
-                            try:
-                                if instance is not None:
-                                    if hasattr(instance, 'webhook_secret'):
-                                        instance.webhook_secret = secret
-                                    if hasattr(instance, 'last_webhook_set_at'):
-                                        instance.last_webhook_set_at = datetime.now(_tz.utc)
-                                    if hasattr(instance, 'status'):
-                                        instance.status = 'active'
-                                    db_session.commit()
-                            except Exception as e_commit:
-                                logger.error(f"Auto-upsert main bot: commit failed after set_webhook: {e_commit}", exc_info=True)
-                                db_session.rollback()
-                            logger.info(f"Main bot webhook set to {webhook_url}")
-                        except Exception as e_webhook:
-                            logger.error(f"Failed to set webhook for main bot @{me.username}: {e_webhook}", exc_info=True)
-                            try:
-                                if instance is not None and hasattr(instance, 'status'):
-                                    instance.status = 'webhook_error'
-                                    db_session.commit()
-                            except Exception:
-                                db_session.rollback()
-        except Exception as e_auto:
-            logger.error(f"Auto-upsert of main bot failed: {e_auto}", exc_info=True)
-
-        # Подготовка к graceful shutdown
-        stop_event = asyncio.Event()
-        loop = asyncio.get_running_loop()
-        try:
-            loop.add_signal_handler(signal.SIGTERM, stop_event.set)
-            loop.add_signal_handler(signal.SIGINT, stop_event.set)
-        except NotImplementedError:
-            # На Windows сигналов может не быть — игнорируем
-            pass
-
-        global application_loop
-        application_loop = asyncio.get_running_loop()
-
-        web_server_task = None
 
         # Общая фон. задача проактивных сообщений
         proactive_task = None
 
         if run_mode == 'webhook':
-            # Запускаем только веб-сервер для приема вебхуков; polling не запускаем
-            port = int(os.environ.get("PORT", 8080))
-            hypercorn_config = HypercornConfig()
-            hypercorn_config.bind = [f"0.0.0.0:{port}"]
-
-            asgi_app = WsgiToAsgi(flask_app)
-
             # Запускаем PTB (без polling), чтобы работали контексты/очереди
-            await application.start()
-            # Старт фоновой задачи проактивных сообщений
-            try:
-                proactive_task = asyncio.create_task(tasks.proactive_messaging_task(application))
-            except Exception as e:
-                logger.error(f"failed to start proactive_messaging_task: {e}")
-
-            web_server_task = asyncio.create_task(serve(asgi_app, hypercorn_config))
+            with startup.stage("application_start"):
+                await application.start()
+            # Старт фоновой задачи проактивных сообщений (в режиме супервизора — только на воркере 0)
+            if IS_PRIMARY_WORKER:
+                try:
+                    proactive_task = asyncio.create_task(tasks.proactive_messaging_task(application))
+                except Exception as e:
+                    logger.error(f"failed to start proactive_messaging_task: {e}")
+
+            topup_notifier_task = asyncio.create_task(topup_notification_worker())
+            # Межпроцессная инвалидация кешей (LISTEN/NOTIFY)
+            invalidation_bus_task = asyncio.create_task(invalidation_bus.run_bus())
+            # Пакетная запись счётчиков API-ключей
+            key_flusher_task = asyncio.create_task(key_scheduler.run_flusher())
+            # Сворачивание старого контекста в конспекты
+            summarizer_task = asyncio.create_task(context_summarizer.run_summarizer())
+            # Продление и удаление кешей контекста Gemini
+            gemini_cache_task = asyncio.create_task(gemini_cache.run_maintainer())
+            _app_ready = True
+            startup.report("ready")
             logger.info(f"Web server running on port {port} (webhook mode). Waiting for shutdown signal...")
+            # ToS, команды, вебхук главного бота, Vosk и т.п. — уже после готовности
+            background_init_task = asyncio.create_task(_background_init(application, me, commands, startup, setup_webhook=True))
 
             # Ждём сигнал остановки
             await stop_event.wait()
 
             logger.info("Shutdown signal received. Stopping web server and application...")
+            _app_ready = False
             if web_server_task:
                 web_server_task.cancel()
                 try:
@@ -755,6 +1025,16 @@ async def main():
                 except asyncio.CancelledError:
                     pass
 
+            # Даём уже принятым апдейтам завершиться
+            await update_scheduler.drain(timeout=10.0)
+
+            for bg_task in (background_init_task, topup_notifier_task, invalidation_bus_task, key_flusher_task, summarizer_task, gemini_cache_task):
+                bg_task.cancel()
+                try:
+                    await bg_task
+                except asyncio.CancelledError:
+                    pass
+
             # Останавливаем фоновую задачу
             if proactive_task:
                 proactive_task.cancel()
@@ -765,24 +1045,39 @@ async def main():
 
             await application.stop()
             await application.shutdown()
+            await bot_registry.close()
+            await llm_clients.close_all()
 
         else:
             # Polling mode: запускаем только polling без веб-сервера
+            # Вебхук главного бота (upsert в БД) — до start_polling, который его снимает
+            await startup.timed("main_bot_webhook", _setup_main_bot_webhook(application, me))
             await application.start()
             logger.info("Starting polling (no web server)...")
             # Старт фоновой задачи проактивных сообщений
-            proactive_task = None
             try:
                 proactive_task = asyncio.create_task(tasks.proactive_messaging_task(application))
             except Exception as e:
                 logger.error(f"failed to start proactive_messaging_task: {e}")
 
+            key_flusher_task = asyncio.create_task(key_scheduler.run_flusher())
+            summarizer_task = asyncio.create_task(context_summarizer.run_summarizer())
+            gemini_cache_task = asyncio.create_task(gemini_cache.run_maintainer())
             await application.updater.start_polling()
+            startup.report("ready")
+            background_init_task = asyncio.create_task(_background_init(application, me, commands, startup, setup_webhook=False))
 
             # Ждем сигнал остановки
             await stop_event.wait()
 
             logger.info("Shutdown signal received. Stopping polling and application...")
+            background_init_task.cancel()
+            for bg_task in (key_flusher_task, summarizer_task, gemini_cache_task):
+                bg_task.cancel()
+                try:
+                    await bg_task
+                except asyncio.CancelledError:
+                    pass
             # Останавливаем фоновую задачу
             if proactive_task:
                 proactive_task.cancel()
@@ -793,13 +1088,20 @@ async def main():
             await application.updater.stop()
             await application.stop()
             await application.shutdown()
+            await bot_registry.close()
+            await llm_clients.close_all()
 
 
 # --- 3. Точка входа ---
 if __name__ == "__main__":
     logger.info("--- Application starting up ---")
     try:
-        asyncio.run(main())
+        if config.WORKERS > 1 and WORKER_INDEX is None and os.environ.get("RUN_MODE", "webhook").strip().lower() == 'webhook':
+            # Супервизор: фронт-роутер + N воркеров (каждый воркер — этот же main.py с WORKER_INDEX)
+            from supervisor import run_supervisor
+            asyncio.run(run_supervisor(config.WORKERS))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Application stopped by user (KeyboardInterrupt).")
     except Exception as e:
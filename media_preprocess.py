@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Подготовка фото перед vision-запросом.
+
+Раньше handle_media всегда скачивал update.message.photo[-1] — самый большой
+размер (до 2560px) — и кодировал сырые байты в base64 для Gemini/OpenRouter:
+лишние сотни килобайт в запросе и лишние vision-токены (Gemini режет картинку
+на тайлы 768x768, каждый тайл — отдельные токены).
+
+Теперь:
+1. select — из размеров, которые Telegram уже подготовил, берётся наименьший,
+   у которого длинная сторона не меньше цели модели (MEDIA_IMAGE_TARGETS или
+   MEDIA_IMAGE_TARGET_PX; для маршрута с несколькими моделями — наибольшая цель,
+   чтобы запасной модели хватило разрешения);
+2. download — скачивается только он;
+3. process — в отдельном потоке: поворот по EXIF, уменьшение до цели,
+   перекодирование в JPEG с подбором качества под MEDIA_IMAGE_MAX_BYTES, без
+   EXIF и прочих метаданных.
+
+Готовый результат кешируется по file_unique_id (пересланное фото не качается и
+не перекодируется заново). Pillow необязателен: без него работают выбор размера
+и кеш. Сэкономленные байты и время каждого этапа видны в /metrics.
+"""
+
+import asyncio
+import collections
+import io
+import logging
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps  # необязательная зависимость
+except ImportError:
+    Image = None
+    ImageOps = None
+
+STAGES = ("select", "download", "process")
+
+# (file_unique_id, цель) -> готовые байты
+_cache: "collections.OrderedDict[Tuple[str, int], bytes]" = collections.OrderedDict()
+_cache_bytes = 0
+
+stats_counters: Dict[str, int] = collections.Counter()
+# этап -> {"count", "total_ms", "max_ms"}
+_stage_timings: Dict[str, Dict[str, float]] = {stage: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for stage in STAGES}
+
+
+def _record_stage(stage: str, started: float) -> None:
+    elapsed_ms = (time.monotonic() - started) * 1000
+    timing = _stage_timings[stage]
+    timing["count"] += 1
+    timing["total_ms"] += elapsed_ms
+    timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+
+
+def target_for(models: Sequence[str]) -> int:
+    """Длинная сторона картинки для маршрута: наибольшая из целей его моделей."""
+    targets = [config.MEDIA_IMAGE_TARGETS.get(model, config.MEDIA_IMAGE_TARGET_PX) for model in models]
+    return max(targets) if targets else config.MEDIA_IMAGE_TARGET_PX
+
+
+def select_size(photo_sizes: Sequence[Any], target_px: int) -> Any:
+    """Наименьший PhotoSize с длинной стороной не меньше target_px (или самый большой из имеющихся)."""
+    ordered = sorted(photo_sizes, key=lambda size: max(size.width or 0, size.height or 0))
+    for size in ordered:
+        if max(size.width or 0, size.height or 0) >= target_px:
+            return size
+    return ordered[-1]
+
+
+def _recompress(data: bytes, target_px: int) -> bytes:
+    """Уменьшение и перекодирование в JPEG без метаданных. Синхронная (вызывается в потоке)."""
+    with Image.open(io.BytesIO(data)) as source:
+        had_exif = bool(source.info.get("exif"))
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        resized = max(image.size) > target_px
+        if resized:
+            image.thumbnail((target_px, target_px), Image.LANCZOS)
+        quality = config.MEDIA_IMAGE_JPEG_QUALITY
+        while True:
+            out = io.BytesIO()
+            # exif не передаём — метаданные в результат не попадают
+            image.save(out, "JPEG", quality=quality, optimize=True)
+            if out.tell() <= config.MEDIA_IMAGE_MAX_BYTES or quality <= config.MEDIA_IMAGE_MIN_QUALITY:
+                break
+            quality = max(config.MEDIA_IMAGE_MIN_QUALITY, quality - 10)
+    result = out.getvalue()
+    if not resized and not had_exif and len(result) >= len(data):
+        # Telegram уже пережал фото этого размера, и метаданных в нём нет — перекодирование ничего не даёт
+        return data
+    return result
+
+
+def _cache_get(key: Tuple[str, int]) -> Optional[bytes]:
+    data = _cache.get(key)
+    if data is not None:
+        _cache.move_to_end(key)
+    return data
+
+
+def _cache_put(key: Tuple[str, int], data: bytes) -> None:
+    global _cache_bytes
+    limit = int(config.MEDIA_IMAGE_CACHE_MB * 1024 * 1024)
+    if key in _cache or len(data) > limit:
+        return
+    _cache[key] = data
+    _cache_bytes += len(data)
+    while _cache_bytes > limit and _cache:
+        _, evicted = _cache.popitem(last=False)
+        _cache_bytes -= len(evicted)
+
+
+async def prepare_photo(bot: Any, photo_sizes: Sequence[Any], target_px: int) -> Optional[bytes]:
+    """Байты фото для vision-запроса: подходящий размер, уменьшенный и без метаданных."""
+    if not photo_sizes:
+        return None
+    if not config.MEDIA_IMAGE_PREPROCESS_ENABLED:
+        file = await bot.get_file(photo_sizes[-1].file_id)
+        return bytes(await file.download_as_bytearray())
+
+    started = time.monotonic()
+    largest = max(photo_sizes, key=lambda size: max(size.width or 0, size.height or 0))
+    chosen = select_size(photo_sizes, target_px)
+    _record_stage("select", started)
+
+    key = (chosen.file_unique_id, target_px)
+    cached = _cache_get(key)
+    if cached is not None:
+        stats_counters["cache_hits"] += 1
+        return cached
+    stats_counters["cache_misses"] += 1
+
+    started = time.monotonic()
+    file = await bot.get_file(chosen.file_id)
+    data = bytes(await file.download_as_bytearray())
+    _record_stage("download", started)
+    stats_counters["downloaded_bytes"] += len(data)
+    if chosen is not largest:
+        stats_counters["smaller_size_selected"] += 1
+        if largest.file_size:
+            stats_counters["download_bytes_saved"] += max(0, largest.file_size - len(data))
+
+    result = data
+    if Image is not None:
+        started = time.monotonic()
+        try:
+            result = await asyncio.to_thread(_recompress, data, target_px)
+        except Exception as e:
+            stats_counters["process_errors"] += 1
+            logger.warning(f"media_preprocess: recompress of {chosen.file_unique_id} failed, sending as is: {e}")
+            result = data
+        _record_stage("process", started)
+    stats_counters["sent_bytes"] += len(result)
+    stats_counters["process_bytes_saved"] += max(0, len(data) - len(result))
+    logger.info(
+        f"media_preprocess: photo {chosen.width}x{chosen.height} (target {target_px}px), "
+        f"{len(data)} -> {len(result)} bytes"
+    )
+    _cache_put(key, result)
+    return result
+
+
+def stats() -> Dict[str, Any]:
+    stages = {
+        stage: {
+            "count": int(timing["count"]),
+            "avg_ms": round(timing["total_ms"] / timing["count"], 1) if timing["count"] else None,
+            "max_ms": round(timing["max_ms"], 1),
+        }
+        for stage, timing in _stage_timings.items()
+    }
+    return dict(
+        stats_counters,
+        pillow=Image is not None,
+        stages=stages,
+        cache_entries=len(_cache),
+        cache_bytes=_cache_bytes,
+    )
@@ -90,6 +90,13 @@ class InMemoryCache:
             del self._cache[key]
         return len(keys_to_delete)
     
+    def delete_matching(self, prefix: str = "", suffix: str = "") -> int:
+        """Удалить все ключи с данным префиксом и суффиксом"""
+        keys_to_delete = [k for k in self._cache.keys() if k.startswith(prefix) and k.endswith(suffix)]
+        for key in keys_to_delete:
+            del self._cache[key]
+        return len(keys_to_delete)
+    
     def get_stats(self) -> Dict[str, Any]:
         """Получить статистику кеша"""
         return {
@@ -6,7 +6,7 @@
 
 import asyncio
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.constants import ChatAction, ParseMode
@@ -206,44 +206,6 @@ def invalidate_user_keyboards(user_id: int):
         cache.delete(pattern)
 
 
-# Оптимизированная функция для парсинга ответов LLM
-def parse_llm_response_optimized(text: str) -> List[str]:
-    """
-    Упрощенный и быстрый парсинг ответов от LLM
-    Без множественных regex fallback
-    """
-    import json
-    
-    # Быстрая очистка markdown
-    if text.startswith("```") and text.endswith("```"):
-        text = text[3:-3].strip()
-        if text.startswith("json\n"):
-            text = text[5:]
-    
-    # Попытка парсинга JSON
-    try:
-        parsed = json.loads(text)
-        
-        # Основной формат
-        if isinstance(parsed, dict) and "response" in parsed:
-            resp = parsed["response"]
-            if isinstance(resp, list):
-                return [str(x).strip() for x in resp if x]
-            if isinstance(resp, str):
-                return [resp.strip()] if resp.strip() else []
-        
-        # Альтернативный формат - просто список
-        if isinstance(parsed, list):
-            return [str(x).strip() for x in parsed if x]
-            
-    except json.JSONDecodeError:
-        pass
-    
-    # Простой fallback - разбить по строкам
-    lines = text.strip().split('\n')
-    return [line.strip() for line in lines if line.strip()]
-
-
 # HTTP клиент с connection pooling
 import httpx
 
@@ -50,6 +50,20 @@ VOICE_SYSTEM_PROMPT_TEMPLATE = """[СИСТЕМНОЕ СООБЩЕНИЕ]
 3) Не используй backticks и ```json.
 """
 
+# Проверка контекста для пачки сообщений группы (group_relevance): одно решение на всё окно
+BATCH_SHOULD_RESPOND_TEMPLATE = """Ты — {persona_name} (@{bot_username}), участник группового чата.
+За последние секунды в чат пришло несколько сообщений:
+
+{numbered_messages}
+
+Недавняя история диалога:
+{context_summary}
+
+Выбери ОДНО сообщение, на которое тебе стоит ответить: обращение к тебе, вопрос по теме твоего разговора, продолжение диалога с тобой.
+Если ни одно не требует твоего ответа, ответь «Нет».
+Ответь ТОЛЬКО номером сообщения (например: 2) или словом «Нет».
+Ответ:"""
+
 PHOTO_SYSTEM_PROMPT_TEMPLATE_FALLBACK = '''[SYSTEM MANDATORY INSTRUCTIONS - FOLLOW THESE RULES EXACTLY]
 You are an AI assistant. Your ONLY task is to role-play as a character reacting to a photo. Your entire output MUST be a valid JSON array of strings.
 
@@ -75,6 +89,7 @@ Example: `["о, на фото кот, какой пушистый", "сразу
 
 [YOUR JSON RESPONSE]:'''
 
+import prompt_layout
 from utils import get_time_info
 
 logger = logging.getLogger(__name__)
@@ -262,9 +277,9 @@ class Persona:
         # Could potentially load from self.config.system_prompt_template if needed
         return DEFAULT_SYSTEM_PROMPT_TEMPLATE
 
-    def format_system_prompt(self, user_id: int, username: str, chat_type: Optional[str] = None) -> Optional[str]:
-        """Formats the main system prompt using template and dynamic info.
-           The user's message is NO LONGER part of this prompt.
+    def build_prompt_layout(self, user_id: int, username: str, chat_type: Optional[str] = None) -> Optional[prompt_layout.PromptLayout]:
+        """Builds the system prompt ordered from static to volatile (see prompt_layout).
+           Per-turn facts (user, chat, time) go to layout.turn_context, not into the template.
            Returns None if persona should not respond to text based on media_reaction.
         """
         # Check if text responses are disabled by media_reaction setting
@@ -297,23 +312,21 @@ class Persona:
         verbosity_text = verbosity_map.get(verbosity_key, verbosity_map["medium"])
 
         chat_id_info = self.chat_id_info
+        chat_type_text = "group" if chat_type in {"group", "supergroup"} else "private"
 
         # --- Блок try...except для форматирования ---
         try:
-            # Словарь с плейсхолдерами для шаблона V18. Добавлена информация о времени.
+            # Словарь с плейсхолдерами для шаблона V18. Настроение и данные хода (пользователь, чат, время)
+            # в шаблон не подставляются: там постоянные ссылки на блоки [MOOD] и [CURRENT TURN],
+            # чтобы описание персоны было одинаковым от хода к ходу (кеш префиксов у провайдера)
             placeholders = {
                 'persona_name': self.name,
                 'persona_description': safe_description,
                 'communication_style': style_text,
                 'verbosity_level': verbosity_text,
-                'mood_name': mood_name,
-                'mood_prompt': mood_instruction,
-                'username': username, # Keep username for context
-                'user_id': user_id,     # Keep user_id for context
-                'chat_id': chat_id_info, # Keep chat_id for context
-                'current_time_info': get_time_info(), # <-- НОВОЕ
-                'chat_type': ("group" if chat_type in {"group", "supergroup"} else "private"),
             }
+            placeholders.update({key: prompt_layout.MOOD_POINTER for key in prompt_layout.MOOD_PLACEHOLDERS})
+            placeholders.update({key: prompt_layout.TURN_POINTER for key in prompt_layout.TURN_PLACEHOLDERS})
             # Безопасное форматирование: не падаем на неизвестных ключах (например, в JSON-примерах c фигурными скобками)
             class SafeDict(dict):
                 def __missing__(self, key):
@@ -328,9 +341,8 @@ class Persona:
             fallback_parts = [
                 f"Ты {self.name}. {self.description}.",
                 f"Стиль: {style_text}. Разговорчивость: {verbosity_text}.",
-                f"Настроение: {mood_name} ({mood_instruction}).",
                 "Формат ответа: выведи ТОЛЬКО валидный JSON-массив строк (каждый элемент — отдельное сообщение). Пример: [\"привет\", \"как дела?\"].",
-                f"Ответь на последнее сообщение от {username} (id: {user_id}) в чате {chat_id_info}."
+                f"Ответь на последнее сообщение пользователя ({prompt_layout.TURN_POINTER})."
             ]
             formatted_prompt = " ".join(fallback_parts)
             logger.warning("Using fallback system prompt due to template error.")
@@ -342,21 +354,29 @@ class Persona:
             fallback_parts = [
                 f"Ты {self.name}. {self.description}.",
                 f"Стиль: {style_text}. Разговорчивость: {verbosity_text}.",
-                f"Настроение: {mood_name} ({mood_instruction}).",
                 f"Формат ответа: JSON-объект с ключом 'response', значением является список строк. Пример: {{\"response\":[\"привет\",\"как дела?\"]}}.",
-                f"Ответь на последнее сообщение от {username} (id: {user_id}) в чате {chat_id_info}."
+                f"Ответь на последнее сообщение пользователя ({prompt_layout.TURN_POINTER})."
             ]
             formatted_prompt = " ".join(fallback_parts)
             logger.warning("Using fallback system prompt due to unexpected formatting error.")
         # --- Конец блока try...except ---
 
-        # Собираем дополнительные инструкции
-        additional_instructions = [BASE_PROMPT_SUFFIX, INTERNET_INFO_PROMPT]
-        if chat_type in {"group", "supergroup"}:
-            additional_instructions.append(GROUP_CHAT_INSTRUCTION)
+        # Общие правила идут первыми, инструкция для групп — после описания персоны
+        return prompt_layout.assemble(
+            persona_id=self.id,
+            global_rules="\n".join(part.strip() for part in (BASE_PROMPT_SUFFIX, INTERNET_INFO_PROMPT)),
+            persona_definition=formatted_prompt,
+            chat_rules=(f"[CHAT RULES]\n{GROUP_CHAT_INSTRUCTION.strip()}" if chat_type_text == "group" else ""),
+            mood=prompt_layout.mood_block(mood_name, mood_instruction),
+            turn_context=prompt_layout.turn_block(username, user_id, chat_id_info, chat_type_text, get_time_info()),
+        )
 
-        final_prompt = f"{formatted_prompt}\n\n[ADDITIONAL INSTRUCTIONS]\n" + "\n".join(additional_instructions)
-        return final_prompt.strip()
+    def format_system_prompt(self, user_id: int, username: str, chat_type: Optional[str] = None) -> Optional[str]:
+        """Formats the main system prompt as a single string (turn context at the very end).
+           Returns None if persona should not respond to text based on media_reaction.
+        """
+        layout = self.build_prompt_layout(user_id, username, chat_type)
+        return layout.combined() if layout else None
 
     def format_conversation_starter_prompt(self, history: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, str]]]:
         """Формирует системный промпт для старта диалога с учетом последних сообщений.
@@ -395,6 +415,19 @@ class Persona:
 
         return system_prompt, []
 
+    @staticmethod
+    def _should_respond_context_summary(history: List[Dict[str, str]]) -> str:
+        """Краткое саммари последних сообщений истории для проверок контекста."""
+        history_limit = 5
+        relevant_history = history[-history_limit:]
+        context_lines = []
+        for msg in relevant_history:
+            role = "Ты" if msg.get("role") == "assistant" else "User"
+            content_preview = str(msg.get("content", ""))[:80]
+            if len(str(msg.get("content", ""))) > 80: content_preview += "..."
+            context_lines.append(f"{role}: {content_preview}")
+        return "\n".join(context_lines) if context_lines else "Нет истории."
+
     def format_should_respond_prompt(self, message_text: str, bot_username: str, history: List[Dict[str, str]]) -> Optional[str]:
         """Formats the prompt to decide if the bot should respond in a group based on context."""
         if self.group_reply_preference != "mentioned_or_contextual":
@@ -408,17 +441,7 @@ class Persona:
             logger.warning(f"should_respond_prompt_template is empty for persona {self.id}. Cannot generate contextual check prompt. Using default.")
             template = DEFAULT_SHOULD_RESPOND_TEMPLATE # Используем дефолтный из db.py как fallback
 
-        # --- Создание краткого саммари истории ---
-        history_limit = 5
-        relevant_history = history[-history_limit:]
-        context_lines = []
-        for msg in relevant_history:
-            role = "Ты" if msg.get("role") == "assistant" else "User"
-            content_preview = str(msg.get("content", ""))[:80]
-            if len(str(msg.get("content", ""))) > 80: content_preview += "..."
-            context_lines.append(f"{role}: {content_preview}")
-        context_summary = "\n".join(context_lines) if context_lines else "Нет истории."
-        # --- Конец саммари ---
+        context_summary = self._should_respond_context_summary(history)
 
         # Подставляем значения в шаблон V5 из db.py
         # Плейсхолдеры: {persona_name}, {bot_username}, {last_user_message}, {context_summary}
@@ -438,6 +461,25 @@ class Persona:
              logger.error(f"Error formatting should_respond prompt: {e}", exc_info=True)
              return None
 
+    def format_batch_should_respond_prompt(self, numbered_messages: str, bot_username: str, history: List[Dict[str, str]]) -> Optional[str]:
+        """Formats the prompt that picks which message of a group batch (if any) the bot should answer.
+        The model is asked for the message number or 'Нет' (see group_relevance.parse_batch_answer)."""
+        if self.group_reply_preference != "mentioned_or_contextual":
+            logger.error("format_batch_should_respond_prompt called for non-contextual preference.")
+            return None
+        try:
+            formatted_prompt = BATCH_SHOULD_RESPOND_TEMPLATE.format(
+                persona_name=self.name,
+                bot_username=bot_username,
+                numbered_messages=numbered_messages,
+                context_summary=self._should_respond_context_summary(history),
+            )
+            logger.debug(f"Generated batch should_respond prompt for persona {self.id}:\n---\n{formatted_prompt}\n---")
+            return formatted_prompt
+        except Exception as e:
+            logger.error(f"Error formatting batch should_respond prompt: {e}", exc_info=True)
+            return None
+
     def _format_media_prompt(self, media_type_text: str, user_id: Optional[int] = None, username: Optional[str] = None, chat_id: Optional[str] = None) -> Optional[str]:
         """Helper method to format prompts for media reactions based on media_reaction setting.
         
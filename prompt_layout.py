@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Порядок сегментов промпта: от статичных к изменчивым.
+
+Раньше Persona.format_system_prompt подставлял get_time_info(), user_id,
+username и chat_id в середину шаблона, а [ADDITIONAL INSTRUCTIONS] дописывал в
+конец. Префикс промпта менялся на каждом вызове (время — каждую минуту), и
+неявный кеш префиксов у провайдеров (Gemini implicit caching, кеш OpenRouter)
+не срабатывал.
+
+Теперь запрос собирается так:
+1. глобальные правила (одинаковы для всех персон);
+2. описание персоны (шаблон, в котором изменчивые плейсхолдеры заменены
+   постоянными ссылками на блоки ниже);
+3. правила типа чата (инструкция для групп);
+4. настроение [MOOD];
+5. история (сообщения);
+6. [CURRENT TURN] — пользователь, чат и время; приклеивается к последнему
+   сообщению пользователя, после истории.
+
+Сегменты 1–2 — стабильный префикс персоны: его хеш и размер в токенах видны в
+/metrics вместе с числом смен (смена = правка персоны или шаблона). Там же —
+сколько токенов промпта провайдеры отдали из кеша (Gemini
+usageMetadata.cachedContentTokenCount, OpenRouter
+usage.prompt_tokens_details.cached_tokens).
+"""
+
+import collections
+import hashlib
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import llm_clients
+from utils import count_openai_compatible_tokens
+
+logger = logging.getLogger(__name__)
+
+# Плейсхолдеры шаблона, меняющиеся от хода к ходу, и что подставляется вместо них
+TURN_PLACEHOLDERS = ("username", "user_id", "chat_id", "current_time_info", "chat_type")
+MOOD_PLACEHOLDERS = ("mood_name", "mood_prompt")
+TURN_POINTER = "see [CURRENT TURN]"
+MOOD_POINTER = "see [MOOD]"
+
+# Сколько персон держать в реестре префиксов
+_MAX_PERSONAS = 1000
+
+stats_counters: Dict[str, int] = collections.Counter()
+# persona_id -> {"hash", "tokens", "changes"}
+_prefixes: Dict[Any, Dict[str, Any]] = {}
+# "провайдер:модель" -> запросы / токены промпта / токены из кеша
+_usage: Dict[str, Dict[str, int]] = {}
+
+
+class PromptLayout:
+    """Собранный запрос: system (стабильная часть) и turn_context (в конец последнего сообщения)."""
+
+    __slots__ = ("system", "turn_context", "prefix_hash")
+
+    def __init__(self, system: str, turn_context: str, prefix_hash: str):
+        self.system = system
+        self.turn_context = turn_context
+        self.prefix_hash = prefix_hash
+
+    def combined(self) -> str:
+        """Всё одной строкой — для вызовов, где нет отдельного последнего сообщения."""
+        return f"{self.system}\n\n{self.turn_context}".strip()
+
+
+def mood_block(mood_name: Optional[str], mood_prompt: Optional[str]) -> str:
+    return f"[MOOD]\n- Current Mood: {mood_name or 'neutral'} ({mood_prompt or ''})."
+
+
+def turn_block(username: Any, user_id: Any, chat_id: Any, chat_type: str, time_info: str) -> str:
+    return (
+        "[CURRENT TURN]\n"
+        f"- User: '{username}' (id: {user_id})\n"
+        f"- Chat: {chat_id} ({chat_type})\n"
+        f"- Current Time: {time_info}"
+    )
+
+
+def _note_prefix(persona_id: Any, prefix: str) -> str:
+    """Регистрирует стабильный префикс персоны; возвращает его sha256 (первые 16 символов)."""
+    prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+    entry = _prefixes.get(persona_id)
+    if entry is not None and entry["hash"] == prefix_hash:
+        stats_counters["prefix_reused"] += 1
+        return prefix_hash
+    if entry is None:
+        if len(_prefixes) >= _MAX_PERSONAS:
+            _prefixes.pop(next(iter(_prefixes)))
+        entry = _prefixes[persona_id] = {"hash": prefix_hash, "tokens": 0, "changes": 0}
+    else:
+        entry["changes"] += 1
+        stats_counters["prefix_changed"] += 1
+        logger.info(f"prompt_layout: stable prefix of persona {persona_id} changed ({entry['hash']} -> {prefix_hash})")
+        entry["hash"] = prefix_hash
+    entry["tokens"] = count_openai_compatible_tokens(prefix)
+    return prefix_hash
+
+
+def assemble(
+    persona_id: Any,
+    global_rules: str,
+    persona_definition: str,
+    chat_rules: str,
+    mood: str,
+    turn_context: str,
+) -> PromptLayout:
+    """Складывает сегменты в порядке от статичных к изменчивым."""
+    prefix = f"[GLOBAL RULES]\n{global_rules.strip()}\n\n{persona_definition.strip()}"
+    prefix_hash = _note_prefix(persona_id, prefix)
+    system = "\n\n".join(part for part in (prefix, chat_rules.strip(), mood.strip()) if part)
+    stats_counters["layouts"] += 1
+    return PromptLayout(system, turn_context.strip(), prefix_hash)
+
+
+def append_turn_context(message_content: str, turn_context: str) -> str:
+    """Последнее сообщение пользователя + блок текущего хода (после всей истории)."""
+    if not turn_context:
+        return message_content
+    return f"{message_content}\n\n{turn_context}"
+
+
+def _record(provider: str, model: Optional[str], prompt_tokens: Any, cached_tokens: Any) -> None:
+    key = f"{provider}:{model or 'unknown'}"
+    entry = _usage.setdefault(key, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "requests_with_cache": 0})
+    entry["requests"] += 1
+    entry["prompt_tokens"] += int(prompt_tokens or 0)
+    if cached_tokens:
+        entry["cached_tokens"] += int(cached_tokens)
+        entry["requests_with_cache"] += 1
+
+
+def gemini_usage(data: Any) -> Tuple[Optional[int], Optional[int]]:
+    """(promptTokenCount, cachedContentTokenCount) из ответа Gemini."""
+    if not isinstance(data, dict):
+        return None, None
+    usage = data.get("usageMetadata") or {}
+    return usage.get("promptTokenCount"), usage.get("cachedContentTokenCount")
+
+
+def openrouter_usage(data: Any) -> Tuple[Optional[int], Optional[int]]:
+    """(prompt_tokens, prompt_tokens_details.cached_tokens) из ответа OpenRouter."""
+    if not isinstance(data, dict):
+        return None, None
+    usage = data.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    return usage.get("prompt_tokens"), details.get("cached_tokens")
+
+
+def record_gemini_usage(model: Optional[str], data: Any) -> None:
+    prompt_tokens, cached_tokens = gemini_usage(data)
+    if prompt_tokens is not None:
+        _record(llm_clients.PROVIDER_GEMINI, model, prompt_tokens, cached_tokens)
+
+
+def record_openrouter_usage(model: Optional[str], data: Any) -> None:
+    prompt_tokens, cached_tokens = openrouter_usage(data)
+    if prompt_tokens is not None:
+        _record(llm_clients.PROVIDER_OPENROUTER, model, prompt_tokens, cached_tokens)
+
+
+def stats() -> Dict[str, Any]:
+    usage = {}
+    for key, entry in list(_usage.items()):
+        ratio = entry["cached_tokens"] / entry["prompt_tokens"] if entry["prompt_tokens"] else 0.0
+        usage[key] = dict(entry, cached_ratio=round(ratio, 3))
+    return {
+        "counters": dict(stats_counters),
+        "cache_usage": usage,
+        "prefixes": {str(persona_id): dict(entry) for persona_id, entry in list(_prefixes.items())[-50:]},
+    }
@@ -0,0 +1,177 @@
+"""Corpus check, benchmark and fuzz harness for llm_stream.parse_llm_output.
+
+Corpus: scripts/llm_parser_corpus.jsonl, one {"name", "input", "expected"} per
+line (fenced blocks, {"response": [...]}, bare arrays, truncated JSON, raw
+newlines, arrays packed into a string, plain text).
+
+  check  - every corpus case parses to its expected list, and streaming the same
+           text through ArrayStreamParser in random chunks yields a prefix of it
+  bench  - mean time per response over a mixed corpus of --responses items
+  fuzz   - --iterations random mutations (truncate, drop/insert/duplicate/swap
+           characters) of corpus inputs; parse_llm_output must never raise and
+           must always return a list of non-empty strings, and feeding the text in
+           random chunks must match a single feed of the whole text (empty only for
+           input that is nothing but fence markup)
+
+tests/test_llm_stream.py runs the same corpus check and a seeded fuzz under pytest;
+this script keeps the benchmark and long fuzz runs.
+
+Usage:
+  python scripts/bench_llm_parser.py            # check + bench + fuzz
+  python scripts/bench_llm_parser.py fuzz --iterations 20000 --seed 1
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from llm_stream import ArrayStreamParser, parse_llm_output  # noqa: E402
+
+CORPUS = Path(__file__).with_name("llm_parser_corpus.jsonl")
+# characters that break JSON structure most often
+_NOISE = '[]{}",:\\\\\n `ё'
+# input with nothing but fence markup (``` / ```json) may legitimately parse to []
+_MARKUP_ONLY_RE = re.compile(r"^[\s`]*[A-Za-z0-9_+.-]*[\s`]*$")
+
+
+def load_corpus():
+    with CORPUS.open(encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check(corpus, rng) -> int:
+    failures = 0
+    for case in corpus:
+        got = parse_llm_output(case["input"])
+        if got != case["expected"]:
+            failures += 1
+            print(f"FAIL {case['name']}: expected {case['expected']!r}, got {got!r}")
+            continue
+        # streaming must never emit something the full parse would not return
+        parser = ArrayStreamParser()
+        streamed = []
+        text, pos = case["input"], 0
+        while pos < len(text):
+            step = rng.randint(1, 16)
+            streamed.extend(parser.feed(text[pos:pos + step]))
+            pos += step
+        streamed = [item.strip() for item in streamed if item.strip()]
+        if streamed != got[:len(streamed)]:
+            failures += 1
+            print(f"FAIL {case['name']} (stream): {streamed!r} is not a prefix of {got!r}")
+    print(f"check: {len(corpus) - failures}/{len(corpus)} cases ok")
+    return failures
+
+
+def bench(corpus, responses: int, rounds: int, rng) -> None:
+    mixed = [rng.choice(corpus)["input"] for _ in range(responses)]
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for text in mixed:
+            parse_llm_output(text)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    total_chars = sum(len(text) for text in mixed)
+    print(
+        f"bench: {responses} responses ({total_chars / responses:.0f} chars avg), "
+        f"best of {rounds}: {best / responses * 1e6:.1f} us/response"
+    )
+    # one long element streamed in small chunks: feed() must stay linear in its length
+    for length in (20_000, 200_000):
+        text = '{"response": ["' + ("длинный ответ \\\" " * (length // 16))[:length] + '", "конец"]}'
+        parser = ArrayStreamParser()
+        started = time.perf_counter()
+        for pos in range(0, len(text), 16):
+            parser.feed(text[pos:pos + 16])
+        elapsed = time.perf_counter() - started
+        print(f"bench: {len(text)} chars streamed in 16-char chunks: {elapsed * 1000:.1f} ms ({len(parser.items)} items)")
+
+
+def mutate(text: str, rng) -> str:
+    for _ in range(rng.randint(1, 4)):
+        op = rng.randrange(5)
+        pos = rng.randint(0, len(text))
+        if op == 0:
+            text = text[:pos]
+        elif op == 1:
+            text = text[:pos] + text[pos + 1:]
+        elif op == 2:
+            text = text[:pos] + rng.choice(_NOISE) + text[pos:]
+        elif op == 3:
+            end = min(len(text), pos + rng.randint(1, 20))
+            text = text[:end] + text[pos:end] + text[end:]
+        elif len(text) > 1:
+            i, j = sorted(rng.sample(range(len(text)), 2))
+            text = text[:i] + text[j] + text[i + 1:j] + text[i] + text[j + 1:]
+    return text
+
+
+def _stream(text: str, rng) -> ArrayStreamParser:
+    parser = ArrayStreamParser()
+    pos = 0
+    while pos < len(text):
+        step = rng.randint(1, 8)
+        parser.feed(text[pos:pos + step])
+        pos += step
+    return parser
+
+
+def fuzz(corpus, iterations: int, rng) -> int:
+    failures = 0
+    for n in range(iterations):
+        text = mutate(rng.choice(corpus)["input"], rng)
+        # chunked streaming must see exactly what a single feed of the whole text sees
+        whole = ArrayStreamParser()
+        whole.feed(text)
+        streamed = _stream(text, rng)
+        if (streamed.items, streamed.completed, streamed.broken, streamed.tail()) != (whole.items, whole.completed, whole.broken, whole.tail()):
+            failures += 1
+            print(f"FAIL #{n} (stream): {streamed.items!r} != {whole.items!r} on {text!r}")
+        try:
+            result = parse_llm_output(text)
+        except Exception as e:
+            failures += 1
+            print(f"FAIL #{n}: raised {type(e).__name__}: {e} on {text!r}")
+            continue
+        if not isinstance(result, list) or not all(isinstance(item, str) and item.strip() for item in result):
+            failures += 1
+            print(f"FAIL #{n}: {result!r} on {text!r}")
+        elif not result and not _MARKUP_ONLY_RE.match(text):
+            failures += 1
+            print(f"FAIL #{n}: empty result for non-empty input {text!r}")
+    print(f"fuzz: {iterations - failures}/{iterations} mutated inputs ok")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check, benchmark and fuzz the LLM output parser")
+    parser.add_argument("mode", nargs="?", choices=("all", "check", "bench", "fuzz"), default="all")
+    parser.add_argument("--responses", type=int, default=200, help="size of the mixed benchmark corpus")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=20000, help="number of fuzz mutations")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = load_corpus()
+    failures = 0
+    if args.mode in ("all", "check"):
+        failures += check(corpus, rng)
+    if args.mode in ("all", "bench"):
+        bench(corpus, args.responses, args.rounds, rng)
+    if args.mode in ("all", "fuzz"):
+        failures += fuzz(corpus, args.iterations, rng)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Local fake of the Gemini REST API for offline runs of the bot and gemini_cache.
+
+Implements just enough of v1beta for handlers.py:
+  POST   /v1beta/models/{model}:generateContent
+  POST   /v1beta/models/{model}:streamGenerateContent?alt=sse
+  POST   /v1beta/cachedContents
+  PATCH  /v1beta/cachedContents/{id}?updateMask=ttl
+  DELETE /v1beta/cachedContents/{id}
+  GET    /stats   (what was uploaded vs served from cache)
+
+Prompt "processing" costs --us-per-token microseconds for every uncached token,
+so enabling GEMINI_CONTEXT_CACHE_ENABLED shows up both in latency and in /stats.
+
+Usage:
+  python scripts/fake_gemini_server.py --port 8089
+  GEMINI_API_BASE_URL_TEMPLATE="http://127.0.0.1:8089/v1beta/models/{model}:generateContent" \
+  GEMINI_CONTEXT_CACHE_ENABLED=true python main.py
+
+tests/test_gemini_cache.py starts Handler in-process on an ephemeral port.
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("fake_gemini")
+
+_MODEL_RE = re.compile(r"^/v1beta/models/(?P<model>[^:/]+):(?P<method>generateContent|streamGenerateContent)$")
+_CACHE_RE = re.compile(r"^/v1beta/(?P<name>cachedContents/[\w-]+)$")
+
+_lock = threading.Lock()
+_caches = {}  # name -> {"model", "tokens", "expires_at"}
+_stats = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "cache_created": 0,
+    "cache_refreshed": 0,
+    "cache_deleted": 0,
+    "cache_misses": 0,
+}
+
+
+def _tokens(obj) -> int:
+    """Rough token estimate (4 chars per token) of all text parts in a JSON fragment."""
+    if isinstance(obj, dict):
+        return sum(_tokens(v) for k, v in obj.items() if k in ("text", "parts", "contents", "systemInstruction", "system_instruction"))
+    if isinstance(obj, list):
+        return sum(_tokens(v) for v in obj)
+    if isinstance(obj, str):
+        return max(1, len(obj) // 4)
+    return 0
+
+
+def _ttl_seconds(value, default: float) -> float:
+    try:
+        return float(str(value).rstrip("s"))
+    except (TypeError, ValueError):
+        return default
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakeGemini/1.0"
+    options = None  # argparse.Namespace, set in main()
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _json(self, status: int, data) -> None:
+        raw = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _error(self, status: int, message: str) -> None:
+        self._json(status, {"error": {"code": status, "message": message}})
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            with _lock:
+                self._json(200, dict(_stats, live_caches=len(_caches)))
+            return
+        self._error(404, "not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/v1beta/cachedContents":
+            self._create_cache(self._body())
+            return
+        match = _MODEL_RE.match(url.path)
+        if not match:
+            self._error(404, "not found")
+            return
+        self._generate(match.group("model"), match.group("method") == "streamGenerateContent", self._body())
+
+    def do_PATCH(self):
+        url = urlparse(self.path)
+        match = _CACHE_RE.match(url.path)
+        if not match or "ttl" not in parse_qs(url.query).get("updateMask", [""])[0]:
+            self._error(400, "only ttl updates are supported")
+            return
+        ttl = _ttl_seconds(self._body().get("ttl"), self.options.default_ttl)
+        with _lock:
+            cache = _caches.get(match.group("name"))
+            if cache is None or cache["expires_at"] < time.time():
+                _caches.pop(match.group("name"), None)
+                self._error(404, "cached content not found")
+                return
+            cache["expires_at"] = time.time() + ttl
+            _stats["cache_refreshed"] += 1
+        self._json(200, {"name": match.group("name"), "ttl": f"{ttl}s"})
+
+    def do_DELETE(self):
+        match = _CACHE_RE.match(urlparse(self.path).path)
+        with _lock:
+            removed = match is not None and _caches.pop(match.group("name"), None) is not None
+            if removed:
+                _stats["cache_deleted"] += 1
+        if removed:
+            self._json(200, {})
+        else:
+            self._error(404, "cached content not found")
+
+    def _create_cache(self, body) -> None:
+        tokens = _tokens(body.get("systemInstruction")) + _tokens(body.get("contents"))
+        if tokens < self.options.min_cache_tokens:
+            self._error(400, f"cached content is too small: {tokens} < {self.options.min_cache_tokens} tokens")
+            return
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        ttl = _ttl_seconds(body.get("ttl"), self.options.default_ttl)
+        with _lock:
+            _caches[name] = {"model": body.get("model"), "tokens": tokens, "expires_at": time.time() + ttl}
+            _stats["cache_created"] += 1
+        # uploading the prompt into a cache is not free either
+        time.sleep(tokens * self.options.us_per_token / 1e6)
+        self._json(200, {"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+
+    def _generate(self, model: str, stream: bool, body) -> None:
+        cached_tokens = 0
+        cache_name = body.get("cachedContent")
+        if cache_name:
+            with _lock:
+                cache = _caches.get(cache_name)
+                if cache is None or cache["expires_at"] < time.time() or cache["model"] != f"models/{model}":
+                    _stats["cache_misses"] += 1
+                    cache = None
+            if cache is None:
+                self._error(404, f"cached content {cache_name} not found")
+                return
+            if body.get("system_instruction") or body.get("systemInstruction"):
+                self._error(400, "system_instruction is not allowed together with cachedContent")
+                return
+            cached_tokens = cache["tokens"]
+        uncached_tokens = _tokens(body.get("system_instruction")) + _tokens(body.get("systemInstruction")) + _tokens(body.get("contents"))
+        prompt_tokens = uncached_tokens + cached_tokens
+        with _lock:
+            _stats["requests"] += 1
+            _stats["prompt_tokens"] += prompt_tokens
+            _stats["cached_tokens"] += cached_tokens
+        time.sleep(self.options.base_latency_ms / 1000 + uncached_tokens * self.options.us_per_token / 1e6)
+
+        answer = json.dumps({"response": ["fake reply", f"prompt {prompt_tokens} tokens, cached {cached_tokens}"]}, ensure_ascii=False)
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": 12, "totalTokenCount": prompt_tokens + 12}
+        if cached_tokens:
+            usage["cachedContentTokenCount"] = cached_tokens
+        if not stream:
+            self._json(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}}], "usageMetadata": usage})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        middle = len(answer) // 2
+        for piece in (answer[:middle], answer[middle:]):
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}], "usageMetadata": usage}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode())
+            self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini API server for offline runs and cache benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--base-latency-ms", type=float, default=150.0, help="fixed latency of every generate call")
+    parser.add_argument("--us-per-token", type=float, default=50.0, help="extra latency per uncached prompt token")
+    parser.add_argument("--min-cache-tokens", type=int, default=1024, help="smaller cachedContents are rejected with 400")
+    parser.add_argument("--default-ttl", type=float, default=3600.0)
+    Handler.options = parser.parse_args()
+    server = ThreadingHTTPServer((Handler.options.host, Handler.options.port), Handler)
+    logger.info(f"Fake Gemini API on http://{Handler.options.host}:{Handler.options.port}/v1beta (stats: /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Режим супервизора: N процессов-воркеров за лёгким фронт-роутером.
+
+Супервизор слушает публичный PORT и пересылает вебхуки воркерам на 127.0.0.1.
+Telegram-апдейты маршрутизируются по chat_id % N, поэтому порядок в чате
+и локальные кеши воркера остаются корректными. Супервизор следит за здоровьем
+воркеров (/readyz), перезапускает упавшие и по SIGHUP делает rolling restart.
+
+Запуск: WORKERS=4 python main.py
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+from hypercorn.asyncio import serve
+from hypercorn.config import Config as HypercornConfig
+
+import config
+from http_auth import metrics_authorized
+from update_envelope import classify_update
+
+logger = logging.getLogger(__name__)
+
+# Заголовки, которые не пересылаем воркеру (hop-by-hop)
+_HOP_HEADERS = {b'host', b'connection', b'keep-alive', b'transfer-encoding', b'content-length'}
+
+
+class WorkerProcess:
+    """Один процесс-воркер: python main.py с WORKER_INDEX и своим портом."""
+
+    def __init__(self, index: int, port: int, total: int):
+        self.index = index
+        self.port = port
+        self.total = total
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.healthy = False
+        self.restarts = 0
+        self.started_at: Optional[float] = None
+        self.last_health_at: Optional[float] = None
+        self.forwarded = 0
+        self.forward_errors = 0
+        # Во время rolling restart супервизор сам управляет процессом
+        self.restarting = False
+        # Падения подряд без периода стабильной работы: задают паузу перед перезапуском
+        self.consecutive_crashes = 0
+        self.next_restart_at: Optional[float] = None
+        # Слишком много падений подряд — больше не перезапускаем сами (до SIGHUP)
+        self.failed = False
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self) -> None:
+        env = dict(os.environ)
+        env.update({
+            "WORKER_INDEX": str(self.index),
+            "WORKERS_TOTAL": str(self.total),
+            "PORT": str(self.port),
+            "BIND_HOST": "127.0.0.1",
+            "RUN_MODE": "webhook",
+        })
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+            env=env,
+        )
+        self.healthy = False
+        self.started_at = time.monotonic()
+        logger.info(f"supervisor: started worker #{self.index} (pid={self.process.pid}, port={self.port})")
+
+    async def stop(self, timeout: float) -> None:
+        if not self.process or self.process.returncode is not None:
+            return
+        self.healthy = False
+        try:
+            self.process.send_signal(signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"supervisor: worker #{self.index} did not stop in {timeout}s, killing")
+            self.process.kill()
+            await self.process.wait()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def status(self) -> Dict:
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process else None,
+            "port": self.port,
+            "alive": self.alive,
+            "healthy": self.healthy,
+            "restarts": self.restarts,
+            "consecutive_crashes": self.consecutive_crashes,
+            "failed": self.failed,
+            "uptime_sec": round(time.monotonic() - self.started_at, 1) if self.started_at else None,
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors,
+        }
+
+
+class Supervisor:
+    def __init__(self, num_workers: int, public_port: int, base_port: int):
+        self.workers: List[WorkerProcess] = [
+            WorkerProcess(i, base_port + i, num_workers) for i in range(num_workers)
+        ]
+        self.public_port = public_port
+        self._client: Optional[httpx.AsyncClient] = None
+        self._rolling_lock = asyncio.Lock()
+        self._stopping = False
+
+    def _pick_worker(self, chat_id: Optional[int]) -> WorkerProcess:
+        if chat_id is None:
+            # Апдейты без чата и платёжные вебхуки — на воркер 0 (там же проактивные задачи)
+            return self.workers[0]
+        return self.workers[int(chat_id) % len(self.workers)]
+
+    # --- Health ---
+
+    async def _check_health(self, worker: WorkerProcess) -> None:
+        if not worker.alive:
+            worker.healthy = False
+            return
+        try:
+            resp = await self._client.get(f"{worker.base_url}/readyz", timeout=config.WORKER_HEALTH_TIMEOUT)
+            worker.healthy = resp.status_code == 200
+        except Exception:
+            worker.healthy = False
+        if worker.healthy:
+            worker.last_health_at = time.monotonic()
+
+    def _schedule_restart(self, worker: WorkerProcess) -> None:
+        """Учитывает падение воркера и назначает перезапуск с экспоненциальной паузой."""
+        code = worker.process.returncode if worker.process else None
+        worker.consecutive_crashes += 1
+        if worker.consecutive_crashes >= config.WORKER_MAX_CONSECUTIVE_CRASHES:
+            worker.failed = True
+            logger.critical(
+                f"supervisor: worker #{worker.index} exited (code={code}) {worker.consecutive_crashes} times in a row; "
+                f"marking it failed, send SIGHUP to retry"
+            )
+            return
+        delay = min(
+            config.WORKER_RESTART_BACKOFF_BASE * (2 ** (worker.consecutive_crashes - 1)),
+            config.WORKER_RESTART_BACKOFF_MAX,
+        )
+        worker.next_restart_at = time.monotonic() + delay
+        logger.error(f"supervisor: worker #{worker.index} exited (code={code}), restarting in {delay:.1f}s")
+
+    async def health_loop(self) -> None:
+        while not self._stopping:
+            for worker in self.workers:
+                if worker.restarting or worker.failed:
+                    continue
+                if not worker.alive:
+                    if worker.next_restart_at is None:
+                        self._schedule_restart(worker)
+                    elif time.monotonic() >= worker.next_restart_at:
+                        worker.next_restart_at = None
+                        worker.restarts += 1
+                        await worker.start()
+                    continue
+                await self._check_health(worker)
+                # Проработал достаточно долго и отвечает на /readyz — прошлые падения больше не считаем
+                if (worker.healthy and worker.consecutive_crashes
+                        and time.monotonic() - worker.started_at >= config.WORKER_STABLE_UPTIME):
+                    worker.consecutive_crashes = 0
+            await asyncio.sleep(config.WORKER_HEALTH_INTERVAL)
+
+    async def _wait_ready(self, worker: WorkerProcess, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await self._check_health(worker)
+            if worker.healthy:
+                return True
+            if not worker.alive:
+                return False
+            await asyncio.sleep(0.5)
+        return False
+
+    async def rolling_restart(self) -> None:
+        """Перезапускает воркеры по одному: следующий — только когда предыдущий снова готов."""
+        async with self._rolling_lock:
+            logger.info("supervisor: rolling restart started")
+            for worker in self.workers:
+                worker.restarting = True
+                # Ручной rolling restart даёт упавшим воркерам новый шанс
+                worker.failed = False
+                worker.consecutive_crashes = 0
+                worker.next_restart_at = None
+                try:
+                    await worker.stop(timeout=config.WORKER_STOP_TIMEOUT)
+                    worker.restarts += 1
+                    await worker.start()
+                    ready = await self._wait_ready(worker, timeout=config.WORKER_START_TIMEOUT)
+                    if not ready:
+                        logger.error(f"supervisor: worker #{worker.index} not ready after restart; aborting rolling restart")
+                        return
+                finally:
+                    worker.restarting = False
+            logger.info("supervisor: rolling restart finished")
+
+    # --- Front router (ASGI) ---
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message.get('type') == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    async def _respond(self, send, status: int, body: bytes = b'', content_type: bytes = b'text/plain; charset=utf-8', extra_headers=None) -> None:
+        headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+        if extra_headers:
+            headers.extend(extra_headers)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def asgi_app(self, scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        path = scope.get('path') or '/'
+        if path in ('/', '/healthz'):
+            await self._respond(send, 200, b'ok')
+            return
+        if path in ('/workers', '/metrics'):
+            if not metrics_authorized(scope):
+                await self._respond(send, 403)
+                return
+            body = json.dumps({"workers": [w.status() for w in self.workers]}).encode()
+            await self._respond(send, 200, body, content_type=b'application/json')
+            return
+
+        body = await self._read_body(receive)
+        chat_id = None
+        if path.startswith('/telegram/'):
+            try:
+                update_data = json.loads(body)
+                if isinstance(update_data, dict):
+                    chat_id = classify_update(update_data).chat_id
+            except Exception:
+                chat_id = None
+        worker = self._pick_worker(chat_id)
+
+        if not worker.healthy:
+            # Не перекидываем на другой воркер, чтобы не нарушить порядок в чате: Telegram повторит доставку
+            await self._respond(send, 503, extra_headers=[(b'retry-after', str(config.UPDATE_BACKPRESSURE_RETRY_AFTER).encode())])
+            return
+
+        headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope.get('headers') or [] if k.lower() not in _HOP_HEADERS]
+        url = f"{worker.base_url}{path}"
+        if scope.get('query_string'):
+            url += "?" + scope['query_string'].decode('latin-1')
+        try:
+            resp = await self._client.request(scope.get('method', 'POST'), url, content=body, headers=headers)
+            worker.forwarded += 1
+        except Exception as e:
+            worker.forward_errors += 1
+            logger.error(f"supervisor: forward to worker #{worker.index} failed: {e}")
+            await self._respond(send, 503)
+            return
+        passthrough = [(b'retry-after', resp.headers['retry-after'].encode())] if 'retry-after' in resp.headers else None
+        await self._respond(
+            send, resp.status_code, resp.content,
+            content_type=resp.headers.get('content-type', 'text/plain; charset=utf-8').encode(),
+            extra_headers=passthrough,
+        )
+
+    # --- Lifecycle ---
+
+    async def run(self) -> None:
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config.CONNECTION_POOL_SIZE, max_keepalive_connections=config.CONNECTION_POOL_SIZE),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+        for worker in self.workers:
+            await worker.start()
+
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+            loop.add_signal_handler(signal.SIGINT, stop_event.set)
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+        except NotImplementedError:
+            pass
+
+        hypercorn_config = HypercornConfig()
+        hypercorn_config.bind = [f"0.0.0.0:{self.public_port}"]
+        server_task = asyncio.create_task(serve(self.asgi_app, hypercorn_config, shutdown_trigger=stop_event.wait))
+        health_task = asyncio.create_task(self.health_loop())
+        logger.info(f"supervisor: front router on port {self.public_port}, {len(self.workers)} workers")
+
+        await stop_event.wait()
+        logger.info("supervisor: shutdown signal received, stopping workers...")
+        self._stopping = True
+        health_task.cancel()
+        await asyncio.gather(*(w.stop(timeout=config.WORKER_STOP_TIMEOUT) for w in self.workers), return_exceptions=True)
+        try:
+            await asyncio.wait_for(server_task, timeout=5.0)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            server_task.cancel()
+        await self._client.aclose()
+
+
+async def run_supervisor(num_workers: int) -> None:
+    public_port = int(os.environ.get("PORT", 8080))
+    base_port = config.WORKER_BASE_PORT or (public_port + 1)
+    await Supervisor(num_workers, public_port, base_port).run()
@@ -5,10 +5,9 @@ import random
 import httpx
 import re
 from telegram.constants import ChatAction, ParseMode
-from telegram import Bot
 from telegram.ext import Application, ContextTypes
 from telegram.error import TelegramError, BadRequest, Forbidden # Added Forbidden
-from typing import List, Dict, Any, Optional, Union, Tuple
+from typing import List, Any, Optional, Union, Tuple
 from datetime import datetime, timedelta, timezone
 
 from sqlalchemy.exc import SQLAlchemyError, ProgrammingError # Added ProgrammingError
@@ -16,12 +15,13 @@ from sqlalchemy import func, select, update as sql_update
 
 from db import (
     get_all_active_chat_bot_instances, SessionLocal, User, ChatBotInstance, BotInstance,
-    get_db, PersonaConfig, get_context_for_chat_bot, add_message_to_context, get_next_api_key
+    get_db, PersonaConfig, get_context_for_chat_bot, add_message_to_context
 )
 from persona import Persona
 from utils import postprocess_response, extract_gif_links, escape_markdown_v2, format_visual_text
 from config import FREE_PERSONA_LIMIT, PAID_PERSONA_LIMIT, FREE_USER_MONTHLY_MESSAGE_LIMIT # <-- ИСПРАВЛЕННЫЙ ИМПОРТ
-from handlers import send_to_google_gemini, deduct_credits_for_interaction
+from handlers import call_gemini, deduct_credits_for_interaction
+from bot_registry import bot_registry
 
 logger = logging.getLogger(__name__)
 
@@ -48,9 +48,6 @@ async def proactive_messaging_task(application: Application) -> None:
         "often": 0.35,
     }
 
-    # Кэш для объектов Bot, чтобы не создавать их каждый раз
-    bot_cache: Dict[str, Bot] = {}
-
     while True:
         try:
             # лёгкий джиттер, чтобы не биться в ровную сетку
@@ -87,11 +84,10 @@ async def proactive_messaging_task(application: Application) -> None:
                             system_prompt, messages = persona_obj.format_conversation_starter_prompt(history)
 
                             # Получаем API-ключ из БД и ответ через Google Gemini
-                            api_key_obj = get_next_api_key(db, service='gemini')
-                            if not api_key_obj:
-                                logger.error("No active Gemini API keys available in DB (proactive task). Skipping this instance.")
+                            assistant_response_text, api_key_used = await call_gemini(system_prompt or "", messages, max_retries=0)
+                            if not api_key_used:
+                                logger.error("Gemini request not sent (no active API keys or provider unavailable) in proactive task. Skipping this instance.")
                                 continue
-                            assistant_response_text = await send_to_google_gemini(api_key_obj.api_key, system_prompt or "", messages)
                             if not assistant_response_text:
                                 continue
 
@@ -117,12 +113,8 @@ async def proactive_messaging_task(application: Application) -> None:
                                 if not bot_token:
                                     raise ValueError("нет токена привязанного бота для этого чата")
 
-                                # Используем кэш ботов
-                                target_bot_for_send = bot_cache.get(bot_token)
-                                if not target_bot_for_send:
-                                    target_bot_for_send = Bot(token=bot_token)
-                                    await target_bot_for_send.initialize()
-                                    bot_cache[bot_token] = target_bot_for_send
+                                # Используем общий реестр ботов
+                                target_bot_for_send = await bot_registry.get(bot_token)
 
                                 # нормализуем визуальный текст (строчные буквы, без эмодзи)
                                 visual_text = format_visual_text(assistant_response_text)
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import importlib.util
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+import config
+import gemini_cache
+import llm_clients
+
+_spec = importlib.util.spec_from_file_location(
+    "fake_gemini_server", Path(__file__).resolve().parents[1] / "scripts" / "fake_gemini_server.py"
+)
+fake = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fake)
+
+PROMPT_A = "Ты — дружелюбная персона, отвечай коротко. " * 40
+PROMPT_B = "Ты — та же персона, но в групповом чате. " * 40
+
+
+@pytest.fixture(scope="module")
+def server():
+    fake.Handler.options = argparse.Namespace(
+        base_latency_ms=0.0, us_per_token=0.0, min_cache_tokens=50, default_ttl=3600.0,
+    )
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), fake.Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/v1beta"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def gemini(server, monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_API_ROOT", server)
+    monkeypatch.setattr(config, "GEMINI_CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(config, "GEMINI_CONTEXT_CACHE_MIN_TOKENS", 50)
+    for state in (gemini_cache._entries, gemini_cache._creating, gemini_cache._failed_until,
+                  gemini_cache._doomed, gemini_cache.stats_counters, fake._caches):
+        state.clear()
+    for key in fake._stats:
+        fake._stats[key] = 0
+    yield
+
+
+def _run(coro):
+    async def scenario():
+        try:
+            return await coro
+        finally:
+            await llm_clients.close_all()
+    return asyncio.run(scenario())
+
+
+def _persona_entries(persona_id):
+    return [entry for entry in gemini_cache._entries.values() if entry.persona_id == persona_id]
+
+
+def test_create_then_hit():
+    async def scenario():
+        first = await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        second = await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        return first, second
+
+    first, second = _run(scenario())
+
+    assert first is not None and first == second
+    assert set(fake._caches) == {first}
+    assert fake._stats["cache_created"] == 1
+    assert gemini_cache.stats_counters["misses"] == 1
+    assert gemini_cache.stats_counters["hits"] == 1
+    (entry,) = _persona_entries(7)
+    assert entry.name == first and entry.hits == 1
+
+
+def test_small_prompt_is_not_cached():
+    assert _run(gemini_cache.cached_content_name("key-1", "коротко", 7)) is None
+    assert fake._caches == {}
+    assert gemini_cache.stats_counters["too_small"] == 1
+
+
+def test_provider_cache_miss_is_forgotten_and_recreated(server):
+    async def scenario():
+        name = await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        # кеш истёк или удалён другим процессом
+        fake._caches.pop(name)
+        client = llm_clients.get_client(llm_clients.PROVIDER_GEMINI)
+        resp = await client.post(
+            f"{server}/models/{config.GEMINI_MODEL_NAME_FOR_API}:generateContent",
+            json={"cachedContent": name, "contents": [{"role": "user", "parts": [{"text": "привет"}]}]},
+        )
+        assert gemini_cache.is_cache_miss(resp.status_code, resp.text)
+        gemini_cache.forget(name)
+        assert gemini_cache._entries == {}
+        return name, await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+
+    old_name, new_name = _run(scenario())
+
+    assert new_name is not None and new_name != old_name
+    assert set(fake._caches) == {new_name}
+    assert fake._stats["cache_misses"] == 1
+    assert gemini_cache.stats_counters["lost"] == 1
+
+
+def test_invalidate_persona_drops_entries_and_deletes_on_maintain():
+    async def scenario():
+        kept = await gemini_cache.cached_content_name("key-1", PROMPT_A, 8)
+        await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        await gemini_cache.cached_content_name("key-1", PROMPT_B, 7)
+        assert len(fake._caches) == 3
+        assert gemini_cache.invalidate_persona(7) == 2
+        assert _persona_entries(7) == []
+        # у провайдера кеши снимает только maintain()
+        assert len(fake._caches) == 3
+        await gemini_cache.maintain()
+        return kept
+
+    kept = _run(scenario())
+
+    assert set(fake._caches) == {kept}
+    assert fake._stats["cache_deleted"] == 2
+    assert [entry.name for entry in _persona_entries(8)] == [kept]
+
+
+def test_maintain_refreshes_entry_close_to_expiry():
+    async def scenario():
+        name = await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        (entry,) = _persona_entries(7)
+        entry.expires_at = time.monotonic() + config.GEMINI_CONTEXT_CACHE_REFRESH_BEFORE / 2
+        await gemini_cache.maintain()
+        return name, entry
+
+    name, entry = _run(scenario())
+
+    assert fake._stats["cache_refreshed"] == 1
+    assert set(fake._caches) == {name}
+    assert entry.expires_at - time.monotonic() > config.GEMINI_CONTEXT_CACHE_TTL - 60
+    assert gemini_cache.stats_counters["refreshed"] == 1
+
+
+def test_maintain_forgets_entry_the_provider_lost():
+    async def scenario():
+        name = await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        fake._caches.pop(name)
+        (entry,) = _persona_entries(7)
+        entry.expires_at = time.monotonic() + config.GEMINI_CONTEXT_CACHE_REFRESH_BEFORE / 2
+        await gemini_cache.maintain()
+
+    _run(scenario())
+
+    assert gemini_cache._entries == {}
+    assert gemini_cache.stats_counters["lost"] == 1
+
+
+def test_maintain_deletes_idle_entry():
+    async def scenario():
+        await gemini_cache.cached_content_name("key-1", PROMPT_A, 7)
+        (entry,) = _persona_entries(7)
+        entry.last_used = time.monotonic() - config.GEMINI_CONTEXT_CACHE_IDLE - 1
+        await gemini_cache.maintain()
+
+    _run(scenario())
+
+    assert gemini_cache._entries == {}
+    assert fake._caches == {}
+    assert fake._stats["cache_deleted"] == 1
+    assert gemini_cache.stats_counters["idle_dropped"] == 1
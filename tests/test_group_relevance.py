@@ -0,0 +1,20 @@
+from group_relevance import parse_batch_answer
+
+BATCH = [(101, "привет всем"), (102, "бот, ты тут?"), (103, "я пошёл")]
+
+
+def test_number_selects_message():
+    assert parse_batch_answer("2", BATCH) == 102
+    assert parse_batch_answer("ответить на 3.", BATCH) == 103
+
+
+def test_no_or_out_of_range_selects_nothing():
+    assert parse_batch_answer("нет", BATCH) is None
+    assert parse_batch_answer("4", BATCH) is None
+    assert parse_batch_answer("", BATCH) is None
+
+
+def test_answer_without_number_selects_nothing():
+    # «никогда» содержит «да»; ответ без номера не должен выбирать последнее сообщение
+    assert parse_batch_answer("никогда", BATCH) is None
+    assert parse_batch_answer("да", BATCH) is None
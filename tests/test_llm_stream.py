@@ -0,0 +1,79 @@
+import json
+import random
+import re
+from pathlib import Path
+
+import pytest
+
+from llm_stream import ArrayStreamParser, parse_llm_output
+
+CORPUS = [
+    json.loads(line)
+    for line in (Path(__file__).resolve().parents[1] / "scripts" / "llm_parser_corpus.jsonl").read_text(encoding="utf-8").splitlines()
+    if line.strip()
+]
+# символы, которые чаще всего ломают структуру JSON
+_NOISE = '[]{}",:\\\\\n `ё'
+# вход из одной разметки ``` / ```json может честно дать []
+_MARKUP_ONLY_RE = re.compile(r"^[\s`]*[A-Za-z0-9_+.-]*[\s`]*$")
+
+
+def _stream(text: str, rng: random.Random, max_step: int) -> ArrayStreamParser:
+    parser = ArrayStreamParser()
+    pos = 0
+    while pos < len(text):
+        step = rng.randint(1, max_step)
+        parser.feed(text[pos:pos + step])
+        pos += step
+    return parser
+
+
+def _mutate(text: str, rng: random.Random) -> str:
+    for _ in range(rng.randint(1, 4)):
+        op = rng.randrange(5)
+        pos = rng.randint(0, len(text))
+        if op == 0:
+            text = text[:pos]
+        elif op == 1:
+            text = text[:pos] + text[pos + 1:]
+        elif op == 2:
+            text = text[:pos] + rng.choice(_NOISE) + text[pos:]
+        elif op == 3:
+            end = min(len(text), pos + rng.randint(1, 20))
+            text = text[:end] + text[pos:end] + text[end:]
+        elif len(text) > 1:
+            i, j = sorted(rng.sample(range(len(text)), 2))
+            text = text[:i] + text[j] + text[i + 1:j] + text[i] + text[j + 1:]
+    return text
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[case["name"] for case in CORPUS])
+def test_corpus_case(case):
+    assert parse_llm_output(case["input"]) == case["expected"]
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[case["name"] for case in CORPUS])
+def test_corpus_case_streamed_in_random_chunks(case):
+    # стриминг не должен отдавать того, чего не вернул бы полный разбор
+    rng = random.Random(case["name"])
+    expected = parse_llm_output(case["input"])
+    for _ in range(20):
+        streamed = [item.strip() for item in _stream(case["input"], rng, 16).items if item.strip()]
+        assert streamed == expected[:len(streamed)]
+
+
+def test_fuzz_mutated_corpus():
+    rng = random.Random(1)
+    for _ in range(2000):
+        text = _mutate(rng.choice(CORPUS)["input"], rng)
+
+        whole = ArrayStreamParser()
+        whole.feed(text)
+        streamed = _stream(text, rng, 8)
+        assert (streamed.items, streamed.completed, streamed.broken, streamed.tail()) == \
+            (whole.items, whole.completed, whole.broken, whole.tail()), text
+
+        result = parse_llm_output(text)
+        assert isinstance(result, list), text
+        assert all(isinstance(item, str) and item.strip() for item in result), text
+        assert result or _MARKUP_ONLY_RE.match(text), text
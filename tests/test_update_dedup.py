@@ -0,0 +1,41 @@
+from update_dedup import STALE_SPAN_WINDOWS, UpdateIdWindow
+
+
+def _window(first: int, count: int, size: int = 64) -> UpdateIdWindow:
+    window = UpdateIdWindow(size)
+    for update_id in range(first, first + count):
+        assert window.check_and_mark(update_id) is False
+    return window
+
+
+def test_redelivery_inside_window_is_duplicate():
+    window = _window(1000, 10)
+    assert window.check_and_mark(1005) is True
+
+
+def test_late_redelivery_below_window_keeps_recent_marks():
+    window = _window(1000, 10)
+    assert window.check_and_mark(900) is True
+    assert window.check_and_mark(1005) is True
+    assert window.check_and_mark(1010) is False
+
+
+def test_forward_jump_resets_window():
+    window = _window(1000, 10)
+    assert window.check_and_mark(5000) is False
+    assert window.check_and_mark(5000) is True
+
+
+def test_large_backward_jump_resets_window():
+    # Telegram начал нумерацию заново (неделя без апдейтов) или токен перепривязали
+    window = _window(900_000_000, 10)
+    for update_id in range(12345, 12350):
+        assert window.check_and_mark(update_id) is False
+    assert window.check_and_mark(12347) is True
+
+
+def test_backward_jump_boundary():
+    size = 64
+    window = _window(10_000, 1, size)
+    assert window.check_and_mark(10_000 - size * STALE_SPAN_WINDOWS + 1) is True
+    assert window.check_and_mark(10_000 - size * STALE_SPAN_WINDOWS) is False
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Дедупликация повторных доставок вебхука по update_id.
+
+Telegram повторяет апдейт, если 200 пришёл поздно; без проверки повтор даёт
+второй вызов LLM и второе списание кредитов. Для каждого бота держим скользящее
+битовое окно последних update_id (фиксированный размер — O(1) памяти на бота).
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Насколько (в размерах окна) id может быть ниже окна, чтобы считаться поздним
+# повтором; дальше — это новая нумерация, и окно сбрасывается
+STALE_SPAN_WINDOWS = 4
+
+
+class UpdateIdWindow:
+    """Скользящее окно: бит i означает, что update_id == high - i уже видели."""
+
+    __slots__ = ("size", "mask", "high", "bits")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.mask = (1 << size) - 1
+        self.high: Optional[int] = None
+        self.bits = 0
+
+    def check_and_mark(self, update_id: int) -> bool:
+        """True, если update_id уже встречался; иначе помечает его и возвращает False."""
+        if (
+            self.high is None
+            or update_id - self.high >= self.size
+            or self.high - update_id >= self.size * STALE_SPAN_WINDOWS
+        ):
+            # Первый апдейт или большой скачок за пределы окна — сбрасываем окно.
+            # Назад нумерация прыгает, когда Telegram после недели без апдейтов
+            # начинает со случайного id или токен привязали к другому боту.
+            self.high = update_id
+            self.bits = 1
+            return False
+        if self.high - update_id >= self.size:
+            # Поздний повтор чуть старее окна: считаем уже виденным и окно не трогаем,
+            # иначе сброс стёр бы отметки последних апдейтов и пропустил их дубликаты
+            return True
+        if update_id > self.high:
+            self.bits = ((self.bits << (update_id - self.high)) | 1) & self.mask
+            self.high = update_id
+            return False
+        bit = 1 << (self.high - update_id)
+        if self.bits & bit:
+            return True
+        self.bits |= bit
+        return False
+
+    def forget(self, update_id: int) -> None:
+        """Снимает отметку (апдейт не был принят в обработку и придёт снова)."""
+        if self.high is None:
+            return
+        offset = self.high - update_id
+        if 0 <= offset < self.size:
+            self.bits &= ~(1 << offset)
+
+
+class UpdateDeduplicator:
+    def __init__(self, window_size: int):
+        self.window_size = max(64, window_size)
+        self._windows: Dict[Any, UpdateIdWindow] = {}
+        self.hits = 0    # дубликаты (отброшены)
+        self.misses = 0  # новые апдейты
+
+    def is_duplicate(self, bot_key: Any, update_id: Optional[int]) -> bool:
+        if update_id is None:
+            return False
+        window = self._windows.get(bot_key)
+        if window is None:
+            window = self._windows[bot_key] = UpdateIdWindow(self.window_size)
+        if window.check_and_mark(int(update_id)):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def forget(self, bot_key: Any, update_id: Optional[int]) -> None:
+        window = self._windows.get(bot_key)
+        if window is not None and update_id is not None:
+            window.forget(int(update_id))
+
+    def stats(self) -> Dict[str, int]:
+        return {"bots": len(self._windows), "hits": self.hits, "misses": self.misses}
+
+
+update_deduplicator = UpdateDeduplicator(config.UPDATE_DEDUP_WINDOW)
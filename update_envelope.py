@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Однопроходная предклассификация сырого JSON апдейта Telegram.
+
+classify_update() за один обход dict строит небольшой неизменяемый UpdateEnvelope
+(тип, чат, отправитель, команда, упоминания, ответ боту). По нему вебхук решает,
+отбрасывать ли апдейт ещё до Update.de_json, а хендлеры берут готовые признаки
+через current_envelope() вместо повторного разбора сообщения.
+"""
+
+import contextvars
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# Типы апдейтов
+KIND_TEXT = "text"
+KIND_COMMAND = "command"
+KIND_PHOTO = "photo"
+KIND_VOICE = "voice"
+KIND_CALLBACK = "callback"
+KIND_MY_CHAT_MEMBER = "my_chat_member"
+KIND_CHAT_MEMBER = "chat_member"
+KIND_OTHER = "other"  # сервисные сообщения, стикеры, документы и т.п. — хендлеров нет
+
+
+@dataclass(frozen=True)
+class UpdateEnvelope:
+    update_id: Optional[int]
+    kind: str
+    chat_id: Optional[int]
+    chat_type: Optional[str]
+    actor_id: Optional[int]
+    message_id: Optional[int] = None
+    command: Optional[str] = None          # '/start' без '@username'
+    command_target: Optional[str] = None   # username из '/cmd@username' (нижний регистр)
+    mentions: Tuple[str, ...] = ()         # '@username' в нижнем регистре
+    reply_to_bot: bool = False             # ответ на сообщение ЭТОГО бота
+    text_len: int = 0
+
+    @property
+    def is_command(self) -> bool:
+        return self.kind == KIND_COMMAND
+
+    @property
+    def is_private(self) -> bool:
+        return self.chat_type == 'private'
+
+    @property
+    def is_group(self) -> bool:
+        return self.chat_type in ('group', 'supergroup')
+
+    def mentions_username(self, username: Optional[str]) -> bool:
+        return bool(username) and f"@{username}".lower() in self.mentions
+
+
+_current_envelope: contextvars.ContextVar = contextvars.ContextVar("current_update_envelope", default=None)
+
+
+def set_current_envelope(envelope: Optional[UpdateEnvelope]) -> contextvars.Token:
+    return _current_envelope.set(envelope)
+
+
+def reset_current_envelope(token: contextvars.Token) -> None:
+    _current_envelope.reset(token)
+
+
+def current_envelope() -> Optional[UpdateEnvelope]:
+    """Конверт апдейта, который сейчас обрабатывается в этой задаче (None в polling-режиме)."""
+    return _current_envelope.get()
+
+
+def _entity_text(text: str, entity: dict) -> str:
+    # offset/length в entities считаются в UTF-16 code units
+    offset = entity.get('offset') or 0
+    length = entity.get('length') or 0
+    if text.isascii():
+        return text[offset:offset + length]
+    raw = text.encode('utf-16-le')
+    return raw[offset * 2:(offset + length) * 2].decode('utf-16-le', errors='ignore')
+
+
+def classify_update(update_data: dict, bot_id: Optional[int] = None) -> UpdateEnvelope:
+    """Строит UpdateEnvelope из сырого JSON апдейта. bot_id нужен для признака reply_to_bot."""
+    update_id = update_data.get('update_id')
+
+    msg = update_data.get('message') or update_data.get('edited_message')
+    if msg is not None:
+        chat = msg.get('chat') or {}
+        actor = msg.get('from') or {}
+        text = msg.get('text')
+        caption = msg.get('caption')
+        body = text if text is not None else (caption or '')
+        entities = msg.get('entities') if text is not None else msg.get('caption_entities')
+
+        kind = KIND_OTHER
+        command = None
+        command_target = None
+        mentions = []
+        if text is not None:
+            kind = KIND_TEXT
+        elif msg.get('photo'):
+            kind = KIND_PHOTO
+        elif msg.get('voice'):
+            kind = KIND_VOICE
+
+        for entity in entities or ():
+            etype = entity.get('type')
+            if etype == 'mention':
+                mentions.append(_entity_text(body, entity).lower())
+            elif etype == 'bot_command' and command is None and text is not None:
+                raw_cmd = _entity_text(body, entity).lower()
+                command, _, target = raw_cmd.partition('@')
+                command_target = target or None
+        if kind == KIND_TEXT and command is None and text.startswith('/'):
+            # команда без entity (как и раньше: text.startswith('/'))
+            first = text.split(maxsplit=1)[0].lower() if text.strip() else '/'
+            command, _, target = first.partition('@')
+            command_target = target or None
+        if command is not None and kind == KIND_TEXT:
+            kind = KIND_COMMAND
+
+        reply_to_bot = False
+        reply = msg.get('reply_to_message')
+        if reply and bot_id is not None:
+            reply_from = reply.get('from') or {}
+            try:
+                reply_to_bot = int(reply_from.get('id') or 0) == int(bot_id)
+            except (TypeError, ValueError):
+                reply_to_bot = False
+
+        return UpdateEnvelope(
+            update_id=update_id,
+            kind=kind,
+            chat_id=chat.get('id'),
+            chat_type=chat.get('type'),
+            actor_id=actor.get('id'),
+            message_id=msg.get('message_id'),
+            command=command,
+            command_target=command_target,
+            mentions=tuple(mentions),
+            reply_to_bot=reply_to_bot,
+            text_len=len(body),
+        )
+
+    cq = update_data.get('callback_query')
+    if cq is not None:
+        cq_msg = cq.get('message') or {}
+        chat = cq_msg.get('chat') or {}
+        return UpdateEnvelope(
+            update_id=update_id,
+            kind=KIND_CALLBACK,
+            chat_id=chat.get('id'),
+            chat_type=chat.get('type'),
+            actor_id=(cq.get('from') or {}).get('id'),
+            message_id=cq_msg.get('message_id'),
+        )
+
+    for key, kind in (('my_chat_member', KIND_MY_CHAT_MEMBER), ('chat_member', KIND_CHAT_MEMBER)):
+        member = update_data.get(key)
+        if member is not None:
+            chat = member.get('chat') or {}
+            return UpdateEnvelope(
+                update_id=update_id,
+                kind=kind,
+                chat_id=chat.get('id'),
+                chat_type=chat.get('type'),
+                actor_id=(member.get('from') or {}).get('id'),
+            )
+
+    return UpdateEnvelope(update_id=update_id, kind=KIND_OTHER, chat_id=None, chat_type=None, actor_id=None)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Ограниченный планировщик входящих апдейтов.
+
+- глобальный лимит одновременной обработки (config.MAX_CONCURRENT_UPDATES);
+- ограниченная общая глубина очереди и глубина очереди на чат;
+- одна последовательная "полоса" на chat_id: апдейты одного чата обрабатываются
+  строго по порядку, поэтому message_order в контексте не гоняется;
+- при переполнении submit() сразу возвращает отказ, вебхук отвечает 429/503,
+  и Telegram повторит доставку позже.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Результаты submit()
+ACCEPTED = "accepted"
+REJECTED_QUEUE_FULL = "queue_full"   # общая очередь переполнена -> 503
+REJECTED_LANE_FULL = "lane_full"     # очередь конкретного чата переполнена -> 429
+
+JobFactory = Callable[[], Awaitable[Any]]
+
+
+class UpdateScheduler:
+    """Планировщик с глобальным лимитом параллелизма и последовательными полосами по chat_id."""
+
+    def __init__(self, max_concurrent: int, max_queue_depth: int, max_lane_depth: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue_depth = max(1, max_queue_depth)
+        self.max_lane_depth = max(1, max_lane_depth)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # chat_id -> очередь (время постановки, фабрика корутины)
+        self._lanes: Dict[Any, Deque[Tuple[float, JobFactory]]] = {}
+        self._tasks: set = set()
+        self._pending = 0   # в очереди (ещё не начали выполняться)
+        self._running = 0   # выполняются сейчас
+        # Метрики
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected_queue_full = 0
+        self.rejected_lane_full = 0
+        self.max_depth_seen = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.wait_samples = 0
+
+    def _sem(self) -> asyncio.Semaphore:
+        # Создаём лениво, внутри работающего event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+    @property
+    def depth(self) -> int:
+        return self._pending + self._running
+
+    def submit(self, chat_id: Optional[Any], factory: JobFactory) -> str:
+        """Ставит апдейт в обработку. chat_id=None — без полосы (порядок не важен)."""
+        if self.depth >= self.max_queue_depth:
+            self.rejected_queue_full += 1
+            return REJECTED_QUEUE_FULL
+
+        if chat_id is None:
+            self._accept()
+            self._spawn(self._run_one(time.monotonic(), factory))
+            return ACCEPTED
+
+        lane = self._lanes.get(chat_id)
+        if lane is not None:
+            if len(lane) >= self.max_lane_depth:
+                self.rejected_lane_full += 1
+                return REJECTED_LANE_FULL
+            self._accept()
+            lane.append((time.monotonic(), factory))
+            return ACCEPTED
+
+        # Новая полоса: воркер живёт, пока в ней есть апдейты
+        lane = deque()
+        lane.append((time.monotonic(), factory))
+        self._lanes[chat_id] = lane
+        self._accept()
+        self._spawn(self._drain_lane(chat_id, lane))
+        return ACCEPTED
+
+    def _accept(self) -> None:
+        self.submitted += 1
+        self._pending += 1
+        if self.depth > self.max_depth_seen:
+            self.max_depth_seen = self.depth
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain_lane(self, chat_id: Any, lane: Deque[Tuple[float, JobFactory]]) -> None:
+        try:
+            while lane:
+                enqueued_at, factory = lane.popleft()
+                await self._run_one(enqueued_at, factory)
+        finally:
+            if self._lanes.get(chat_id) is lane:
+                del self._lanes[chat_id]
+
+    async def _run_one(self, enqueued_at: float, factory: JobFactory) -> None:
+        async with self._sem():
+            waited = time.monotonic() - enqueued_at
+            self._pending -= 1
+            self._running += 1
+            self.wait_samples += 1
+            self.wait_time_total += waited
+            if waited > self.wait_time_max:
+                self.wait_time_max = waited
+            try:
+                await factory()
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"update_scheduler: job failed: {e}", exc_info=True)
+            finally:
+                self._running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        avg_wait = (self.wait_time_total / self.wait_samples) if self.wait_samples else 0.0
+        return {
+            "depth": self.depth,
+            "pending": self._pending,
+            "running": self._running,
+            "lanes": len(self._lanes),
+            "max_depth_seen": self.max_depth_seen,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_lane_full": self.rejected_lane_full,
+            "wait_avg_ms": round(avg_wait * 1000, 1),
+            "wait_max_ms": round(self.wait_time_max * 1000, 1),
+        }
+
+    async def drain(self, timeout: float) -> None:
+        """Ждёт завершения уже принятых апдейтов (при остановке)."""
+        if not self._tasks:
+            return
+        logger.info(f"update_scheduler: draining {len(self._tasks)} tasks (timeout={timeout}s)")
+        done, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+
+update_scheduler = UpdateScheduler(
+    max_concurrent=config.MAX_CONCURRENT_UPDATES,
+    max_queue_depth=config.UPDATE_QUEUE_MAX_DEPTH,
+    max_lane_depth=config.UPDATE_LANE_MAX_DEPTH,
+)
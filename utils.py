@@ -10,7 +10,8 @@ MIN_SENSIBLE_LEN = 50   # Минимальная длина для разумн
 import logging
 import config
 import math
-import tiktoken # Token counting (OpenAI-compatible encodings)
+from functools import lru_cache
+# tiktoken импортируется лениво (_get_encoding): импорт и загрузка BPE-таблиц заметно тормозят старт
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +47,30 @@ def format_visual_text(text: Optional[str]) -> str:
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
+@lru_cache(maxsize=16)
+def _get_encoding(model_identifier: str):
+    """Кодировка tiktoken для модели (импорт и загрузка — при первом вызове, дальше из кеша)."""
+    import tiktoken  # Token counting (OpenAI-compatible encodings)
+    try:
+        return tiktoken.encoding_for_model(model_identifier)
+    except KeyError:
+        # Меняем уровень на INFO, так как это ожидаемое поведение для некоторых моделей
+        logger.info(
+            f"Model '{model_identifier}' not found by tiktoken's predefined list. "
+            f"Using 'cl100k_base' encoding as a reliable fallback."
+        )
+        return tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=2048)
+def _count_tokens_cached(text_content: str, encoding_name: str) -> int:
+    """Токены текста; один и тот же текст (строка контекста, ответ при списании) считается один раз."""
+    import tiktoken
+    return len(tiktoken.get_encoding(encoding_name).encode(text_content))
+
+def warm_up_tokenizer(model_identifier: str = config.GEMINI_MODEL_NAME_FOR_API) -> None:
+    """Загружает кодировку заранее (фоновая инициализация после старта веб-сервера)."""
+    _get_encoding(model_identifier)
+
 def count_openai_compatible_tokens(text_content: str, model_identifier: str = config.GEMINI_MODEL_NAME_FOR_API) -> int:
     """
     Counts the number of tokens in the text_content using tiktoken,
@@ -63,18 +88,9 @@ def count_openai_compatible_tokens(text_content: str, model_identifier: str = co
         return 0
 
     try:
-        try:
-            encoding = tiktoken.encoding_for_model(model_identifier)
-        except KeyError:
-            # Меняем уровень на INFO, так как это ожидаемое поведение для некоторых моделей
-            logger.info(
-                f"Model '{model_identifier}' not found by tiktoken's predefined list. "
-                f"Using 'cl100k_base' encoding as a reliable fallback."
-            )
-            encoding = tiktoken.get_encoding("cl100k_base")
-
-        num_tokens = len(encoding.encode(text_content))
-        return num_tokens
+        encoding = _get_encoding(model_identifier)
+        # кеш по имени кодировки: разные модели с одной кодировкой не считают один текст дважды
+        return _count_tokens_cached(text_content, encoding.name)
     except Exception as e:
         logger.error(f"Error counting tokens with tiktoken for model {model_identifier}: {e}", exc_info=True)
         # Fallback: очень грубая оценка, если tiktoken не сработает